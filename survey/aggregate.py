@@ -1,30 +1,274 @@
 #!/usr/bin/env python
+"""
+  Aggregates the output of dprocess.sh.
 
-import json
-import sys
-import fileinput
+  Scans every file under resultstats/ in parallel, counting lines and records
+  by reading each file in large chunks, and merges the per-host records
+  (<host>-records.jsonl, see records.py) with the rows of the agg CSV files
+  into one summary table with a row per host, written to
+  resultstats/agg/summary.csv.
+
+  With -rebuild, the agg csv and txt files are first regenerated from the
+  host records (dprocess.sh does this at the end of every run).
+
+  Usage: python aggregate.py [resultstats dir] [-rebuild] [-procs n]
+"""
+
+import csv
+import glob
+import multiprocessing
 import os
-import helper
+import sys
+
+import records
+
+
+path = "resultstats"
+summary_name = "summary.csv"
+chunk_size = 1 << 20
+
+# Agg CSV files merged into the summary, each keyed by its Domain column
+agg_csv_files = ["resourcecategorizationdata.csv", "syndata.csv",
+                 "synfetchresults.csv"]
+
+# Agg csv files written by process.py and their headers
+agg_headers = {
+    "syndata.csv": ["Domain", "Syn URL Sets", "Reduced URLs"],
+    "synfetchresults.csv": ["Domain", "Failed Reduced URL fetches",
+                            "Untested Reduced URLs",
+                            "Successful Reduced URL fetches no match",
+                            "Successful Reduced URL fetches with match"],
+    "resourcecategorizationdata.csv": [
+        "Domain", "Total Resources", "Consistent Resources",
+        "Content-Inconsistent Resources", "Synonym Resources",
+        "Inconsistent Resources", "Failed Resources", "Total Resource bytes",
+        "Consistent Resource bytes", "Content-Inconsistent Resource bytes",
+        "Synonym Resource bytes", "Inconsistent Resource bytes",
+        "Failed Resource bytes"]}
+
+categories = ["Total", "Consistent", "C_Inconsistent", "Synonym",
+              "Inconsistent", "Failed"]
+
+# Text versions of syndata.csv and synfetchresults.csv
+agg_text_files = ["syndata.txt", "synfetchresults.txt"]
+
+
+# Columns taken from each record stage: (stage, field, summary column name)
+record_columns = [("summary", "n_trials", "Fetches"),
+                  ("summary", "fails", "Failed fetches"),
+                  ("summary", "jaccard_urls", "URL Jaccard"),
+                  ("summary", "jaccard_hashes", "Hash Jaccard"),
+                  ("inconsistent_urls", "urls", "Inconsistent URLs"),
+                  ("inconsistent_resources", "urls", "Content-Inconsistent URLs"),
+                  ("synonyms", "sets", "Synonym sets"),
+                  ("similarity_table", "sets", "Similarity sets")]
+
+
+# Counts lines in a file reading it in large chunks; returns (path, bytes, lines)
+def count_lines(file_path):
+    lines = 0
+    size = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            lines += chunk.count('\n')
+    return (file_path, size, lines)
+
+
+def list_files(top):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for f in sorted(filenames):
+            files.append(os.path.join(dirpath, f))
+    return files
+
+
+def record_value(stages, stage, field):
+    if stage not in stages:
+        return ""
+    value = stages[stage].get(field, "")
+    # Dictionaries and lists are summarized by their size
+    if isinstance(value, (dict, list)):
+        return len(value)
+    return value
+
+
+# Reads a host's records file into a {column: value} dictionary
+def summarize_host_records(records_path):
+    stages = records.load_host_records(records_path)
+    row = {}
+    for stage, field, column in record_columns:
+        row[column] = record_value(stages, stage, field)
+    return records_path, row
+
+
+def read_agg_csv(csv_path):
+    with open(csv_path, 'rb') as f:
+        reader = csv.reader(f)
+        header = reader.next()
+        rows = {}
+        for row in reader:
+            if len(row) > 0:
+                rows[row[0]] = dict(zip(header[1:], row[1:]))
+    return header[1:], rows
+
+
+def write_summary(host_rows, csv_columns, out_path):
+    columns = ["Domain"] + [c for s, f, c in record_columns] + csv_columns
+    with open(out_path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for host in sorted(host_rows):
+            row = host_rows[host]
+            writer.writerow([host] + [row.get(c, "") for c in columns[1:]])
+
+
+def agg_rows(host, stages):
+    rows = {}
+    if "syndata" in stages:
+        s = stages["syndata"]
+        rows["syndata.csv"] = [host, s["syn_url_sets"], s["reduced_urls"]]
+    if "synfetch" in stages:
+        s = stages["synfetch"]
+        rows["synfetchresults.csv"] = [host, s["fails"], s["untested"],
+                                       s["succs_no_match"], s["succs_w_match"]]
+    if "categories" in stages:
+        a = stages["categories"]["averages"]
+        rows["resourcecategorizationdata.csv"] = \
+            [host] + [a[c]["n"] for c in categories] + [a[c]["b"] for c in categories]
+    return rows
+
+
+# The text versions of syndata.csv and synfetchresults.csv, as synurl.py writes them
+def agg_text(host, stages):
+    text = {}
+    if "syndata" in stages:
+        s = stages["syndata"]
+        text["syndata.txt"] = ("Host: " + host + "\n" +
+                               "Number of synonym url sets: " + str(s["syn_url_sets"]) + "\n" +
+                               "Number of reduced URLs: " + str(s["reduced_urls"]) + "\n" +
+                               "-" * 60 + "\n")
+    if "synfetch" in stages:
+        s = stages["synfetch"]
+        text["synfetchresults.txt"] = ("Host: " + host + "\n" +
+                                       "Fails: " + str(s["fails"]) + "\n" +
+                                       "Untested due to sanity fail: " + str(s["untested"]) + "\n" +
+                                       "Succs no match: " + str(s["succs_no_match"]) + "\n" +
+                                       "Succs w/ match: " + str(s["succs_w_match"]) + "\n" +
+                                       "-" * 38 + "\n")
+    return text
+
+
+# Rewrites the agg csv and txt files under top/agg from the records of the
+# given hosts (default: every host with records under top), in host order.
+# Each file is written under a temporary name and renamed into place
+def rebuild_agg_files(top, hosts=None):
+    if hosts is None:
+        paths = glob.glob(os.path.join(top, "*", "*" + records.records_suffix))
+        hosts = sorted(os.path.basename(p)[:-len(records.records_suffix)] for p in paths)
+    agg_dir = os.path.join(top, "agg")
+    if not os.path.isdir(agg_dir):
+        os.makedirs(agg_dir)
+    csv_files = {}
+    writers = {}
+    for name, header in agg_headers.items():
+        csv_files[name] = open(os.path.join(agg_dir, name + ".tmp"), 'wb')
+        writers[name] = csv.writer(csv_files[name])
+        writers[name].writerow(header)
+    text_files = dict((name, open(os.path.join(agg_dir, name + ".tmp"), 'w'))
+                      for name in agg_text_files)
+    n_hosts = 0
+    try:
+        for host in hosts:
+            path = records.host_records_path(top, host)
+            if not os.path.exists(path):
+                print "warning: no records for", host
+                continue
+            stages = records.load_host_records(path)
+            for name, row in agg_rows(host, stages).items():
+                writers[name].writerow(row)
+            for name, text in agg_text(host, stages).items():
+                text_files[name].write(text)
+            n_hosts += 1
+    finally:
+        for f in csv_files.values() + text_files.values():
+            f.close()
+    for name in csv_files.keys() + text_files.keys():
+        os.rename(os.path.join(agg_dir, name + ".tmp"), os.path.join(agg_dir, name))
+    print "Rebuilt agg files of", n_hosts, "hosts in", agg_dir
+
+
+def processResults(top, procs):
+    files = list_files(top)
+    pool = multiprocessing.Pool(procs)
+    try:
+        counts = pool.map(count_lines, files, chunksize=16)
+
+        records_files = [f for f in files if f.endswith(records.records_suffix)]
+        host_records = pool.map(summarize_host_records, records_files)
+    finally:
+        pool.close()
+        pool.join()
 
+    total_bytes = sum(c[1] for c in counts)
+    total_lines = sum(c[2] for c in counts)
+    record_lines = sum(c[2] for c in counts if c[0].endswith(records.records_suffix))
+    print "Files:", len(files)
+    print "Total lines in all result files:", total_lines
+    print "Total bytes in all result files:", total_bytes
+    print "Records:", record_lines, "in", len(records_files), "host record files"
 
-path = "/home/accts/swl25/cs490/cbrowse/survey/resultstats"
+    host_rows = {}
+    for records_path, row in host_records:
+        host = os.path.basename(records_path)[:-len(records.records_suffix)]
+        host_rows[host] = row
 
-def processResults():
-    totalLines = 0
+    # Merge agg CSV rows by domain; a column name appearing in more than one
+    # file keeps the first file's value
+    csv_columns = []
+    for name in agg_csv_files:
+        csv_path = os.path.join(top, "agg", name)
+        if not os.path.exists(csv_path):
+            continue
+        header, rows = read_agg_csv(csv_path)
+        csv_columns.extend(c for c in header if c not in csv_columns)
+        for host, row in rows.items():
+            host_row = host_rows.setdefault(host, {})
+            for c in header:
+                host_row.setdefault(c, row[c])
 
-    files = sorted(os.listdir(path))
-    for f in files:
-        helper.listReplace(files,f,("resultstats/"+f))
-        print f
-    
-    for line in fileinput.input(files):
-        totalLines += 1
+    agg_dir = os.path.join(top, "agg")
+    if not os.path.isdir(agg_dir):
+        os.makedirs(agg_dir)
+    out_path = os.path.join(agg_dir, summary_name)
+    write_summary(host_rows, csv_columns, out_path)
+    print "Wrote summary of", len(host_rows), "hosts to", out_path
 
-    print "Total lines in all result files:",totalLines
 
 def main():
-    print "Aggregating data from",path
-    processResults()
+    top = path
+    procs = multiprocessing.cpu_count()
+    rebuild = False
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '-procs' and len(args) > 0:
+            procs = int(args.pop(0))
+        elif arg == '-rebuild':
+            rebuild = True
+        elif arg.startswith('-'):
+            print "Usage: python aggregate.py [resultstats dir] [-rebuild] [-procs n]"
+            exit()
+        else:
+            top = arg
+    if rebuild:
+        rebuild_agg_files(top)
+    print "Aggregating data from", top
+    processResults(top, procs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+"""
+  Importable, lazy analysis of one host's fetches.
+
+  process.py computes every stage of the pipeline for a host, in order, and
+  prints as it goes (and refetches reduced URLs), which is what dprocess.sh
+  wants but not what a notebook or another tool wants. A HostAnalysis is
+  built from a host's results directory and computes each product with the
+  same functions as process.py, the first time it is asked for, then keeps
+  it:
+
+      data                    process.load_results of every fetch
+      host, n_trials, fail_count, n_succ_trials, latencies
+      jaccard_urls, jaccard_hashes
+      inconsistent_urls       {url: occurrences}
+      inconsistent_resources  {url: {hash: occurrences}}
+      synonym_sets            {(hash, size): {url: occurrences}}
+      synonym_scores          {(hash, size): score}
+      reducible_sets          the synonym sets scoring at least syn_score_thresh
+      similarity_table        urltable.create_sim_url_tab of the inconsistent URLs
+      reduced_urls            {(hash, size): [reduced url]} of the reducible sets
+      categories_by_fetch     [{category: {n, b}}] per successful fetch
+      categories              {category: {n, b}} averaged over the fetches
+
+  so reading a.categories never builds the similarity table. Nothing is
+  written, nothing is fetched unless verify() is called, and nothing is
+  printed unless verbose is set (it turns on helper.printd while reducing).
+  process.py's process_main is built on it, with low_memory and verbose
+  from its options.
+  with_thresholds() returns an analysis with other thresholds that shares
+  everything computed so far that doesn't depend on them.
+
+      import analysis
+      a = analysis.HostAnalysis("results/cnn.com")
+      print a.jaccard_urls, len(a.synonym_sets)
+      for a in analysis.all_hosts("results"):
+          ...
+"""
+
+import glob
+import os
+
+import helper
+import process
+import synurl
+import urltable
+
+
+# Products that don't depend on sim_thresh or syn_score_thresh
+threshold_free = ["data", "inconsistent_urls", "inconsistent_resources", "synonym_sets",
+                  "synonym_scores", "categories_by_fetch", "categories"]
+
+
+# Property computed on first access and then stored on the instance, which
+# hides the property from then on
+class lazy(object):
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.__name__] = value
+        return value
+
+
+class HostAnalysis(object):
+
+    # host_dir is results/<host>; targets, if given, are the results.json
+    # files to use instead of every fetch in it. low_memory is process.py's
+    # -lowmem (see process.load_results)
+    def __init__(self, host_dir, sim_thresh=None, syn_score_thresh=None, targets=None,
+                 low_memory=False, verbose=False):
+        self.host_dir = host_dir
+        self.low_memory = low_memory
+        self.verbose = verbose
+        if targets is None:
+            targets = sorted(glob.glob(os.path.join(host_dir, "*", "results.json")),
+                             key=lambda t: int(os.path.basename(os.path.dirname(t))))
+        if len(targets) == 0:
+            raise ValueError("no results.json under " + host_dir)
+        self.targets = targets
+        self.sim_thresh = process.sim_thresh if sim_thresh is None else sim_thresh
+        self.syn_score_thresh = process.syn_score_thresh if syn_score_thresh is None \
+            else syn_score_thresh
+
+    def __repr__(self):
+        return "HostAnalysis(%r, %d fetches)" % (self.host_dir, len(self.targets))
+
+    # Which products have been computed so far
+    def computed(self):
+        return sorted(k for k, v in type(self).__dict__.items()
+                      if isinstance(v, lazy) and k in self.__dict__)
+
+    def with_thresholds(self, sim_thresh=None, syn_score_thresh=None):
+        other = HostAnalysis(self.host_dir, sim_thresh, syn_score_thresh, self.targets,
+                             self.low_memory, self.verbose)
+        for name in threshold_free:
+            if name in self.__dict__:
+                other.__dict__[name] = self.__dict__[name]
+        return other
+
+    @lazy
+    def data(self):
+        return process.load_results(self.targets, self.low_memory)
+
+    @property
+    def host(self):
+        return process.host_of_target(self.targets[0])
+
+    @property
+    def n_trials(self):
+        return len(self.targets)
+
+    @property
+    def fail_count(self):
+        return self.data["fail_count"]
+
+    @property
+    def n_succ_trials(self):
+        return self.n_trials - self.fail_count
+
+    @property
+    def latencies(self):
+        return self.data["latencies"]
+
+    @property
+    def jaccard_urls(self):
+        return self.data["jaccard_urls"]
+
+    @property
+    def jaccard_hashes(self):
+        return self.data["jaccard_hashes"]
+
+    @lazy
+    def inconsistent_urls(self):
+        return process.extract_inconsistent_urls(self.data["url_occ_dict"], self.n_trials,
+                                                 self.fail_count)
+
+    @lazy
+    def inconsistent_resources(self):
+        return process.extract_inconsistent_resources(self.data["url_hash_dict"])
+
+    @lazy
+    def synonym_sets(self):
+        return synurl.extract_synonym_urls(self.data["hash_url_dict"])
+
+    @lazy
+    def synonym_scores(self):
+        return dict((h, synurl.score_synonym_set(urls))
+                    for (h, urls) in self.synonym_sets.iteritems())
+
+    @lazy
+    def reducible_sets(self):
+        (scores, reducible) = synurl.select_synonym_sets(self.synonym_sets,
+                                                         self.syn_score_thresh)
+        self.__dict__.setdefault("synonym_scores", scores)
+        return reducible
+
+    @lazy
+    def similarity_table(self):
+        urls = self.inconsistent_urls
+        return urltable.create_sim_url_tab(urls.keys(), self.sim_thresh, urls)
+
+    @lazy
+    def reduced_urls(self):
+        saved = helper.debug
+        helper.debug = self.verbose
+        try:
+            return dict((h, urltable.reduce_syn_urls(urls, self.sim_thresh))
+                        for (h, urls) in self.reducible_sets.iteritems())
+        finally:
+            helper.debug = saved
+
+    @lazy
+    def categories_by_fetch(self):
+        return self._categorize(False, None, None)
+
+    # categories_by_fetch, also writing each fetch's counts and sizes as CSV
+    # to num_file and size_file (process.py's resbyfetch files)
+    def write_categories_by_fetch(self, num_file, size_file):
+        stats = self._categorize(True, num_file, size_file)
+        self.__dict__["categories_by_fetch"] = stats
+        return stats
+
+    def _categorize(self, write_to_file, num_file, size_file):
+        return process.categorize_resources_by_fetch(
+            self.data["res_lists"], self.data["url_occ_dict"], self.data["res_fail_dict"],
+            self.synonym_sets, self.inconsistent_resources, self.n_succ_trials,
+            write_to_file, num_file, size_file)
+
+    @lazy
+    def categories(self):
+        return process.average_resource_stats(self.categories_by_fetch, self.n_succ_trials,
+                                              None, self.host)
+
+    # Refetches the reduced URLs (synurl.fetch_reduced_urls) without writing
+    # the agg files; returns {(hash, size): (syn urls, {reduced url: (success,
+    # matching url)})}. Not memoized: it goes to the network
+    def verify(self, refetch_all=False, sink=None):
+        syn_url_dict = dict((h, (self.reducible_sets[h], self.reduced_urls[h]))
+                            for h in self.reducible_sets)
+        return synurl.fetch_reduced_urls(self.host, syn_url_dict, None, None,
+                                         process.sanity_retry_count,
+                                         process.reduced_retry_count, refetch_all, sink)
+
+
+# A HostAnalysis for every host under results_dir, in name order
+def all_hosts(results_dir="results", **thresholds):
+    for host in sorted(os.listdir(results_dir)):
+        host_dir = os.path.join(results_dir, host)
+        if len(glob.glob(os.path.join(host_dir, "*", "results.json"))) > 0:
+            yield HostAnalysis(host_dir, **thresholds)
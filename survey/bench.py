@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+"""
+  Benchmark harness for the processing code.
+
+  Generates a synthetic results/ tree laid out exactly like the output of
+  map.sh (results/<host>/<fetch_num>/results.json), then times the full
+  process.py pipeline over it along with the individual functions that
+  dominate its running time:
+
+      split_url        urltable.split_url on every resource URL
+      check_urls_sim   urltable.check_urls_sim on pairs of split URLs
+      reduce_syn_urls  urltable.reduce_syn_urls on every synonym URL set
+      trie_insert      urltrie.insert_url of every resource URL
+      jaccard          process.jaccard on the URL sets of every host
+      pipeline         process.process_main on every host, no refetching
+
+  The corpus is controlled by the number of hosts, fetches per host and
+  resources per fetch, plus the fraction of resources that are duplicated
+  within a fetch, that are synonyms (same contents, URL carries a session id
+  or timestamp that changes every fetch) and that are randomized (cache-buster
+  parameter and different contents every fetch). A fixed seed makes the
+  corpus, and therefore the numbers, reproducible.
+
+  Each benchmark runs in its own forked process so that the reported peak
+  memory (growth of the max RSS while the benchmark runs) isn't polluted by
+  the benchmarks before it. Results can be saved as a baseline and later runs
+  are reported relative to it.
+
+  Usage:
+      python bench.py gen <outdir> [corpus options]
+      python bench.py run [corpus options] [-only name ...] [-save] [-baseline file]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import helper
+import urltable
+import urltrie
+import process
+
+
+default_baseline = "bench_baseline.json"
+
+words = ["static", "img", "js", "css", "assets", "ads", "widgets", "beacon",
+         "pixel", "track", "media", "cdn", "content", "news", "sports", "v2",
+         "lib", "common", "images", "thumbs", "api", "social", "embed"]
+exts = [".js", ".css", ".png", ".gif", ".jpg", ".html", ""]
+param_names = ["id", "lang", "v", "size", "ref", "w", "h", "type", "client",
+               "format", "channel", "slot", "page"]
+
+
+def rand_hex(rng, n):
+    return "%0*x" % (n, rng.getrandbits(4*n))
+
+
+# A resource "template" describes how a resource behaves across fetches;
+# kind is one of 'consistent', 'synonym' or 'random'
+def make_template(rng, host, kind):
+    netloc = rng.choice(["www." + host, "static." + host,
+                         "img%d.%s" % (rng.randint(1, 4), host),
+                         "cdn%d.example.net" % rng.randint(1, 20),
+                         "ads.tracker%d.com" % rng.randint(1, 20)])
+    path = "/".join(rng.choice(words) for i in xrange(rng.randint(1, 4)))
+    path += "/" + rand_hex(rng, 8) + rng.choice(exts)
+    params = ["%s=%s" % (rng.choice(param_names), rng.choice(words))
+              for i in xrange(rng.randint(0, 3))]
+    size = rng.choice([43, rng.randint(100, 2000), rng.randint(2000, 60000)])
+    return {"kind": kind, "netloc": netloc, "path": path, "params": params,
+            "hash": rand_hex(rng, 40), "size": size,
+            "rand_param": rng.choice(["_", "sid", "cb", "ts", "rnd"])}
+
+
+def template_url(rng, t):
+    params = list(t["params"])
+    if t["kind"] == "synonym" or t["kind"] == "random":
+        if t["rand_param"] in ("_", "ts"):
+            val = str(rng.randint(1420000000000, 1430000000000))
+        else:
+            val = rand_hex(rng, 16)
+        params.append(t["rand_param"] + "=" + val)
+    url = "http://" + t["netloc"] + "/" + t["path"]
+    if len(params) > 0:
+        url += "?" + "&".join(params)
+    return url
+
+
+def make_host_results(rng, host, opts):
+    templates = []
+    for i in xrange(opts.resources):
+        x = rng.random()
+        if x < opts.syn_rate:
+            kind = "synonym"
+        elif x < opts.syn_rate + opts.rand_rate:
+            kind = "random"
+        else:
+            kind = "consistent"
+        templates.append(make_template(rng, host, kind))
+
+    fetches = []
+    for n in xrange(opts.fetches):
+        result = {"url": host, "status": "success",
+                  "page": {"hash": rand_hex(rng, 40),
+                           "latency": rng.randint(2000, 20000)},
+                  "resources": []}
+        if rng.random() < opts.fail_rate:
+            result["status"] = "fail"
+            result["page"] = None
+            fetches.append(result)
+            continue
+        for t in templates:
+            h = t["hash"]
+            if t["kind"] == "random":
+                h = rand_hex(rng, 40)
+            r = {"url": template_url(rng, t), "hash": h, "size": t["size"]}
+            result["resources"].append(r)
+            if rng.random() < opts.dup_rate:
+                result["resources"].append(dict(r))
+        fetches.append(result)
+    return fetches
+
+
+# Writes a synthetic results/ tree under outdir, along with the resultstats
+# directories that process.py expects to exist
+def generate_corpus(outdir, opts):
+    rng = random.Random(opts.seed)
+    for d in ["results", "resultstats/temp", "resultstats/agg"]:
+        if not os.path.isdir(os.path.join(outdir, d)):
+            os.makedirs(os.path.join(outdir, d))
+
+    hosts = []
+    for i in xrange(opts.hosts):
+        host = "site%03d.com" % i
+        hosts.append(host)
+        for n, result in enumerate(make_host_results(rng, host, opts)):
+            fetch_dir = os.path.join(outdir, "results", host, str(n+1))
+            os.makedirs(os.path.join(fetch_dir, "pages"))
+            with open(os.path.join(fetch_dir, "results.json"), 'w') as f:
+                json.dump(result, f, separators=(',', ':'))
+    return hosts
+
+
+# Returns {host: [results.json paths relative to outdir]}, with paths in the
+# form process.py expects (results/<host>/<n>/results.json)
+def corpus_targets(outdir):
+    targets = {}
+    for host in sorted(os.listdir(os.path.join(outdir, "results"))):
+        fetch_nums = sorted(os.listdir(os.path.join(outdir, "results", host)),
+                            key=int)
+        targets[host] = ["results/%s/%s/results.json" % (host, n)
+                         for n in fetch_nums]
+    return targets
+
+
+def load_corpus(outdir):
+    corpus = {}
+    for host, paths in corpus_targets(outdir).items():
+        corpus[host] = []
+        for p in paths:
+            with open(os.path.join(outdir, p)) as f:
+                corpus[host].append(json.load(f))
+    return corpus
+
+
+def corpus_urls(corpus):
+    urls = []
+    for host in sorted(corpus):
+        for result in corpus[host]:
+            urls.extend(r['url'] for r in result['resources'])
+    return urls
+
+
+def corpus_syn_sets(corpus):
+    syn_sets = []
+    for host in sorted(corpus):
+        hash_urls = {}
+        for result in corpus[host]:
+            for r in result['resources']:
+                hash_urls.setdefault(r['hash'], set()).add(r['url'])
+        syn_sets.extend(sorted(urls) for urls in hash_urls.values()
+                        if len(urls) > 1)
+    return syn_sets
+
+
+### Benchmarks: each takes the corpus directory and returns a function that
+### runs the timed section and returns the number of operations performed.
+### Input preparation happens outside the timed section.
+
+def bench_split_url(outdir):
+    urls = corpus_urls(load_corpus(outdir))
+    def run():
+        for url in urls:
+            urltable.split_url(url)
+        return len(urls)
+    return run
+
+
+def bench_check_urls_sim(outdir):
+    split = [urltable.split_url(url) for url in corpus_urls(load_corpus(outdir))]
+    by_len = {}
+    for s in split:
+        by_len.setdefault(len(s), []).append(s)
+    pairs = []
+    for group in by_len.values():
+        pairs.extend(zip(group, group[1:]))
+    def run():
+        for a, b in pairs:
+            urltable.check_urls_sim(a, b, process.sim_thresh)
+        return len(pairs)
+    return run
+
+
+def bench_reduce_syn_urls(outdir):
+    syn_sets = corpus_syn_sets(load_corpus(outdir))
+    def run():
+        for urls in syn_sets:
+            urltable.reduce_syn_urls(urls, process.sim_thresh)
+        return len(syn_sets)
+    return run
+
+
+def bench_trie_insert(outdir):
+    urls = corpus_urls(load_corpus(outdir))
+    def run():
+        trie = {}
+        for url in urls:
+            trie = urltrie.insert_url(url, trie, True)
+        return len(urls)
+    return run
+
+
+def bench_jaccard(outdir):
+    corpus = load_corpus(outdir)
+    url_sets = [[set(r['url'] for r in result['resources'])
+                 for result in corpus[host] if result['status'] == 'success']
+                for host in sorted(corpus)]
+    def run():
+        for sets in url_sets:
+            process.jaccard(sets)
+        return len(url_sets)
+    return run
+
+
+def bench_pipeline(outdir):
+    targets = corpus_targets(outdir)
+    n_resources = len(corpus_urls(load_corpus(outdir)))
+    os.chdir(outdir)
+    process.fetch_synonyms = False
+    def run():
+        # process_main prints its whole report; send it nowhere
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            for host in sorted(targets):
+                process.process_main(["process.py", "0"] + targets[host])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return n_resources
+    return run
+
+
+benchmarks = [("split_url", bench_split_url),
+              ("check_urls_sim", bench_check_urls_sim),
+              ("reduce_syn_urls", bench_reduce_syn_urls),
+              ("trie_insert", bench_trie_insert),
+              ("jaccard", bench_jaccard),
+              ("pipeline", bench_pipeline)]
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(setup, outdir, repeat, queue):
+    # Debug output would otherwise be timed along with the real work
+    helper.debug = False
+    run = setup(outdir)
+    rss_before = max_rss_kb()
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        ops = run()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    queue.put({"ops": ops, "secs": best,
+               "peak_kb": max_rss_kb() - rss_before})
+
+
+# Runs one benchmark in a forked process; returns its result dictionary
+def run_benchmark(setup, outdir, repeat):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_child,
+                                   args=(setup, outdir, repeat, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if result["secs"] > 0:
+        result["ops_per_sec"] = result["ops"] / result["secs"]
+    else:
+        result["ops_per_sec"] = 0.0
+    return result
+
+
+def corpus_params(opts):
+    return {"hosts": opts.hosts, "fetches": opts.fetches,
+            "resources": opts.resources, "dup_rate": opts.dup_rate,
+            "syn_rate": opts.syn_rate, "rand_rate": opts.rand_rate,
+            "fail_rate": opts.fail_rate, "seed": opts.seed}
+
+
+def print_results(results, baseline):
+    fmt = "%-16s %10s %9s %12s %10s %9s"
+    print fmt % ("benchmark", "ops", "secs", "ops/sec", "peak KB", "vs base")
+    print "-"*71
+    for name, r in results:
+        rel = ""
+        if baseline is not None and name in baseline["results"]:
+            base_ops = baseline["results"][name]["ops_per_sec"]
+            if base_ops > 0:
+                rel = "%.2fx" % (r["ops_per_sec"] / base_ops)
+        print fmt % (name, r["ops"], "%.3f" % r["secs"],
+                     "%.1f" % r["ops_per_sec"], r["peak_kb"], rel)
+
+
+def run_main(opts):
+    baseline = None
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        if baseline["corpus"] != corpus_params(opts):
+            print "warning: baseline was recorded with a different corpus:"
+            print "\t", baseline["corpus"]
+
+    outdir = opts.dir
+    if outdir is None:
+        outdir = tempfile.mkdtemp(prefix="cbrowse-bench-")
+    outdir = os.path.abspath(outdir)
+    baseline_path = os.path.abspath(opts.baseline)
+    try:
+        if not os.path.isdir(os.path.join(outdir, "results")):
+            print "Generating corpus in", outdir
+            generate_corpus(outdir, opts)
+
+        results = []
+        for name, setup in benchmarks:
+            if opts.only and name not in opts.only:
+                continue
+            results.append((name, run_benchmark(setup, outdir, opts.repeat)))
+        print_results(results, baseline)
+    finally:
+        if opts.dir is None and not opts.keep:
+            shutil.rmtree(outdir)
+
+    if opts.save:
+        with open(baseline_path, 'w') as f:
+            json.dump({"corpus": corpus_params(opts),
+                       "results": dict(results)}, f, indent=1, sort_keys=True)
+        print "Saved baseline to", baseline_path
+
+
+def add_corpus_args(parser):
+    parser.add_argument("-hosts", type=int, default=10)
+    parser.add_argument("-fetches", type=int, default=10)
+    parser.add_argument("-resources", type=int, default=100,
+                        help="resources per fetch")
+    parser.add_argument("-dup-rate", dest="dup_rate", type=float, default=0.05,
+                        help="fraction of resources requested twice per fetch")
+    parser.add_argument("-syn-rate", dest="syn_rate", type=float, default=0.15,
+                        help="fraction of synonym resources")
+    parser.add_argument("-rand-rate", dest="rand_rate", type=float, default=0.10,
+                        help="fraction of cache-busted resources")
+    parser.add_argument("-fail-rate", dest="fail_rate", type=float, default=0.0,
+                        help="fraction of failed fetches")
+    parser.add_argument("-seed", type=int, default=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cbrowse benchmark harness")
+    sub = parser.add_subparsers(dest="cmd")
+
+    gen = sub.add_parser("gen", help="generate a synthetic results/ tree")
+    gen.add_argument("outdir")
+    add_corpus_args(gen)
+
+    run = sub.add_parser("run", help="run the benchmarks")
+    add_corpus_args(run)
+    run.add_argument("-dir", default=None,
+                     help="corpus directory (generated if it has no results/)")
+    run.add_argument("-keep", action="store_true",
+                     help="don't delete the temporary corpus")
+    run.add_argument("-only", nargs="+", default=None,
+                     choices=[name for name, setup in benchmarks])
+    run.add_argument("-repeat", type=int, default=3,
+                     help="report the best of this many runs")
+    run.add_argument("-baseline", default=default_baseline)
+    run.add_argument("-save", action="store_true",
+                     help="save these results as the new baseline")
+
+    opts = parser.parse_args()
+    if opts.cmd == "gen":
+        hosts = generate_corpus(opts.outdir, opts)
+        print "Generated", len(hosts), "hosts in", opts.outdir
+    else:
+        run_main(opts)
+
+
+if __name__ == '__main__':
+    main()
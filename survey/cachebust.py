@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+  Cross-site cache-buster parameter detector.
+
+  Makes one streaming pass over every results.json in the survey and, for
+  each (netloc, path template, parameter) seen in a resource URL, keeps:
+
+      fetches     number of fetches the parameter appeared in
+      occurrences number of resource URLs it appeared in
+      distinct    estimated number of distinct values (sketch.HyperLogLog,
+                  fixed memory however many values there are)
+      novelty     of its occurrences in a host's fetches after the first it
+                  appeared in, the fraction whose value no earlier fetch of
+                  that host had
+      entropy     mean per-character Shannon entropy of the values, in bits
+      hosts       number of surveyed hosts it appeared under
+
+  The path template is the path with every segment containing a digit
+  replaced by '#', so that dated or versioned paths fall together. The
+  parameter is the name of a query, ;param or fragment parameter, prefixed
+  with '?', ';' or '#' respectively.
+
+  A parameter that takes a new, random-looking value in (nearly) every fetch
+  is almost certainly a cache-buster, session id or timestamp, even in URLs
+  that are otherwise consistent. Distinct values per fetch can't tell it
+  from a parameter with many stable values (one per resource, say), but
+  novelty can: parameters seen in at least min_fetches fetches with novelty
+  >= buster_novelty and entropy >= min_entropy are flagged. The table is
+  ranked by novelty and then by entropy and written as csv.
+
+  Novelty needs the values of the host being scanned; hosts are scanned one
+  at a time and only hashes of their values are kept, until the host is done.
+
+  Usage: python cachebust.py [-results dir] [-out file.csv] [-top n]
+                             [-min-fetches n] [-novelty r] [-entropy bits]
+"""
+
+import argparse
+import collections
+import csv
+import glob
+import json
+import math
+import os
+import re
+import urlparse
+
+import sketch
+
+
+buster_novelty = 0.9
+min_entropy = 2.0
+min_fetches = 3
+hll_precision = 8
+
+digit_re = re.compile('[0-9]')
+
+
+def path_template(path):
+    segs = [seg for seg in path.split('/') if seg != '']
+    return '/' + '/'.join('#' if digit_re.search(seg) else seg for seg in segs)
+
+
+# Per-character Shannon entropy of a string, in bits
+def char_entropy(value):
+    if len(value) == 0:
+        return 0.0
+    counts = collections.Counter(value)
+    n = float(len(value))
+    return -sum((c/n) * math.log(c/n, 2) for c in counts.values())
+
+
+# Generates (parameter, value) pairs for the parameters of a URL
+def url_params(params, query, fragment):
+    for (prefix, text, sep) in [(';', params, ';'), ('?', query, '&'),
+                                ('#', fragment, '&')]:
+        if text == '':
+            continue
+        for item in text.split(sep):
+            if item == '':
+                continue
+            if '=' in item:
+                (name, value) = item.split('=', 1)
+            else:
+                (name, value) = ('', item)
+            yield (prefix + name, value)
+
+
+class ParamStats(object):
+
+    __slots__ = ["fetches", "occurrences", "entropy_sum", "hosts", "values",
+                 "later", "novel", "last_fetch", "last_host", "host_fetches",
+                 "seen", "current"]
+
+    def __init__(self):
+        self.fetches = 0
+        self.occurrences = 0
+        self.entropy_sum = 0.0
+        self.hosts = 0
+        self.values = sketch.HyperLogLog(hll_precision)
+        # Occurrences after a host's first fetch, and those with a new value
+        self.later = 0
+        self.novel = 0
+        self.last_fetch = None
+        self.last_host = None
+        # Within the current host: fetches so far, hashes of the values of
+        # its earlier fetches and of the current one
+        self.host_fetches = 0
+        self.seen = None
+        self.current = None
+
+    def add(self, value, host, fetch_id):
+        self.occurrences += 1
+        self.entropy_sum += char_entropy(value)
+        self.values.add(value)
+        if host != self.last_host:
+            self.hosts += 1
+            self.last_host = host
+            self.host_fetches = 0
+            self.seen = set()
+            self.current = set()
+        if fetch_id != self.last_fetch:
+            self.fetches += 1
+            self.last_fetch = fetch_id
+            self.host_fetches += 1
+            self.seen |= self.current
+            self.current = set()
+        h = hash(value)
+        if self.host_fetches > 1:
+            self.later += 1
+            if h not in self.seen:
+                self.novel += 1
+        self.current.add(h)
+
+    # Drops the current host's values
+    def end_host(self):
+        self.seen = None
+        self.current = None
+
+    def novelty(self):
+        if self.later == 0:
+            return 0.0
+        return float(self.novel) / self.later
+
+
+# One pass over results_dir/<host>/<n>/results.json; returns
+# {(netloc, path template, parameter): ParamStats}
+def scan(results_dir):
+    stats = {}
+    fetch_id = 0
+    for host in sorted(os.listdir(results_dir)):
+        touched = set()
+        # In fetch order, which novelty is measured against
+        targets = sorted(glob.glob(os.path.join(results_dir, host, "*", "results.json")),
+                         key=lambda t: int(os.path.basename(os.path.dirname(t))))
+        for target in targets:
+            with open(target) as f:
+                results = json.load(f)
+            if results['status'] != 'success':
+                continue
+            fetch_id += 1
+            for r in results['resources']:
+                (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(r['url'])
+                template = path_template(path)
+                for (name, value) in url_params(params, query, fragment):
+                    key = (netloc, template, name)
+                    if key not in stats:
+                        stats[key] = ParamStats()
+                    stats[key].add(value, host, fetch_id)
+                    touched.add(key)
+        for key in touched:
+            stats[key].end_host()
+    return stats
+
+
+def rank(stats, min_fetches):
+    rows = []
+    for (netloc, template, name), s in stats.items():
+        distinct = min(s.values.count(), s.occurrences)
+        ratio = float(distinct) / s.fetches
+        novelty = s.novelty()
+        entropy = s.entropy_sum / s.occurrences
+        buster = s.fetches >= min_fetches and novelty >= buster_novelty and \
+            entropy >= min_entropy
+        rows.append([netloc, template, name, s.fetches, s.occurrences,
+                     int(round(distinct)), round(ratio, 3), round(novelty, 3),
+                     round(entropy, 3), s.hosts, int(buster)])
+    rows.sort(key=lambda row: (-row[10], -row[7], -row[8], row[0], row[1], row[2]))
+    return rows
+
+
+header = ["Netloc", "Path template", "Parameter", "Fetches", "Occurrences",
+          "Distinct values (est)", "Distinct/fetches", "Novelty", "Entropy (bits/char)",
+          "Hosts", "Cache-buster"]
+
+
+def main():
+    global buster_novelty, min_entropy
+    parser = argparse.ArgumentParser(description="cache-buster parameter detector")
+    parser.add_argument("-results", default="results")
+    parser.add_argument("-out", default="resultstats/agg/cachebusters.csv")
+    parser.add_argument("-top", type=int, default=20)
+    parser.add_argument("-min-fetches", dest="min_fetches", type=int, default=min_fetches)
+    parser.add_argument("-novelty", type=float, default=buster_novelty,
+                        help="fraction of later occurrences with a new value")
+    parser.add_argument("-entropy", type=float, default=min_entropy,
+                        help="mean bits per character of the values")
+    opts = parser.parse_args()
+    buster_novelty = opts.novelty
+    min_entropy = opts.entropy
+
+    stats = scan(opts.results)
+    rows = rank(stats, opts.min_fetches)
+    with open(opts.out, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow([unicode(x).encode('utf-8') for x in row])
+
+    n_busters = sum(row[10] for row in rows)
+    print n_busters, "of", len(rows), "parameters flagged as cache-busters; table in", opts.out
+    fmt = "%-28s %-30s %-14s %7s %8s %6s %7s %6s"
+    print fmt % ("netloc", "path", "param", "fetches", "distinct", "ratio", "novelty", "bits")
+    for row in rows[:opts.top]:
+        print fmt % (row[0][:28], row[1][:30], row[2][:14], row[3], row[5], row[6], row[7],
+                     row[8])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+  Browser cache replay simulator.
+
+  Replays the fetches of each host, in fetch order, through a simulated
+  browser cache and reports how many requests and bytes it would have saved.
+  This puts a number on the consistency categories of process.py: a
+  Consistent resource hits in any cache from the second fetch on, while
+  Synonym resources only hit if the cache knows their URLs are equivalent.
+
+  The cache is an LRU limited to a number of entries and/or bytes, and is
+  emptied between hosts. The lookup key depends on the policy:
+
+      url        exact-URL cache, like a real browser cache
+      canonical  URLs in reducible synonym sets are looked up by the reduced
+                 URL (urltable.reduce_syn_urls) distilled from their set, any
+                 other URL by itself
+      rules      URLs are looked up by their canonical form under a compiled
+                 canonicalization rule set (canonrules.py, -rules file)
+      content    content-addressed cache keyed on (hash, size); an upper
+                 bound on what any URL canonicalization could achieve
+
+  A hit whose cached (hash, size) differs from what the fetch actually got
+  (a Content-Inconsistent URL, or two synonym sets sharing a template) is
+  counted as stale rather than as a hit, and saves no bytes. Failed resources
+  (size 0) are skipped, and a URL loaded more than once in a fetch counts
+  once, as in process.py: each host's fetches are read once, with
+  process.load_results, for both the replay and the synonym sets.
+
+  Usage: python cachesim.py [-results dir] [-policies p ...] [-rules rules.json]
+                            [-max-entries n] [-max-bytes n] [-out file.csv] [host ...]
+"""
+
+import argparse
+import collections
+import csv
+import glob
+import os
+
+import canonrules
+import helper
+import process
+import synurl
+import urltable
+
+
+policy_names = ["url", "canonical", "rules", "content"]
+
+
+class LRUCache(object):
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value, size):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.n_bytes += size
+        while ((self.max_entries is not None and len(self.entries) > self.max_entries)
+               or (self.max_bytes is not None and self.n_bytes > self.max_bytes)):
+            (old_key, (old_value, old_size)) = self.entries.popitem(last=False)
+            self.n_bytes -= old_size
+
+
+# True if every (text, type) segment of the reduced URL appears in the URL
+def covers(reduced_segs, url_segs):
+    remaining = collections.Counter((txt, ty) for (n, txt, ty) in url_segs)
+    for (n, txt, ty) in reduced_segs:
+        if remaining[(txt, ty)] == 0:
+            return False
+        remaining[(txt, ty)] -= 1
+    return True
+
+
+# Maps every URL of the host's reducible synonym sets to the reduced URL of
+# its set that covers it; URLs that no reduced URL covers are left out
+# data is the host's process.load_results
+def synonym_canon_map(data, sim_thresh, score_thresh):
+    syn_url_dict = synurl.extract_synonym_urls(data["hash_url_dict"])
+    (scores, reducible) = synurl.select_synonym_sets(syn_url_dict, score_thresh)
+    canon = {}
+    for key in reducible:
+        reduced = [(r, urltable.split_url(r))
+                   for r in urltable.reduce_syn_urls(reducible[key], sim_thresh)]
+        # Try the most specific reduced URLs first
+        reduced.sort(key=lambda (r, segs): -len(segs))
+        for url in reducible[key]:
+            url_segs = urltable.split_url(url)
+            for (r, segs) in reduced:
+                if covers(segs, url_segs):
+                    canon[url] = r
+                    break
+    return canon
+
+
+def cache_key(policy, r, canon, rules):
+    if policy == "url":
+        return r['url']
+    elif policy == "canonical":
+        return canon.get(r['url'], r['url'])
+    elif policy == "rules":
+        return rules.canonicalize(r['url'])
+    else:
+        return (r['hash'], r['size'])
+
+
+def new_stats():
+    return {"requests": 0, "hits": 0, "stale": 0, "bytes": 0, "bytes_saved": 0}
+
+
+# Replays a host's successful fetches (resource lists, in fetch order, as in
+# process.load_results's res_lists) through one cache per policy; returns
+# {policy: stats}
+# rules is a canonrules.Canonicalizer, only needed for the "rules" policy
+def simulate_host(res_lists, policies, canon, rules, max_entries, max_bytes):
+    caches = dict((p, LRUCache(max_entries, max_bytes)) for p in policies)
+    stats = dict((p, new_stats()) for p in policies)
+    for res in res_lists:
+        for r in res:
+            if r['size'] == 0:
+                continue
+            contents = (r['hash'], r['size'])
+            for p in policies:
+                s = stats[p]
+                s["requests"] += 1
+                s["bytes"] += r['size']
+                key = cache_key(p, r, canon, rules)
+                cached = caches[p].get(key)
+                if cached is not None and cached[0] == contents:
+                    s["hits"] += 1
+                    s["bytes_saved"] += r['size']
+                else:
+                    if cached is not None:
+                        s["stale"] += 1
+                    caches[p].put(key, contents, r['size'])
+    return stats
+
+
+# results/<host>/<n>/results.json paths of a host in fetch order
+def host_targets(results_dir, host):
+    targets = glob.glob(os.path.join(results_dir, host, "*", "results.json"))
+    return sorted(targets, key=lambda t: int(os.path.basename(os.path.dirname(t))))
+
+
+def ratio(x, y):
+    if y == 0:
+        return 0.0
+    return float(x)/y
+
+
+def stats_row(host, policy, s):
+    return [host, policy, s["requests"], s["hits"], s["stale"],
+            "%.4f" % ratio(s["hits"], s["requests"]), s["bytes"],
+            s["bytes_saved"], "%.4f" % ratio(s["bytes_saved"], s["bytes"])]
+
+
+header = ["Domain", "Policy", "Requests", "Hits", "Stale hits", "Hit rate",
+          "Bytes", "Bytes saved", "Byte hit rate"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="browser cache replay simulator")
+    parser.add_argument("hosts", nargs="*", help="hosts to replay (default all)")
+    parser.add_argument("-results", default="results")
+    parser.add_argument("-policies", nargs="+", default=None,
+                        choices=policy_names,
+                        help="default: all, rules only if -rules is given")
+    parser.add_argument("-rules", default=None, help="compiled canonicalization rules")
+    parser.add_argument("-max-entries", dest="max_entries", type=int, default=None)
+    parser.add_argument("-max-bytes", dest="max_bytes", type=int, default=None)
+    parser.add_argument("-out", default=None, help="write per-host rows as csv")
+    opts = parser.parse_args()
+
+    helper.debug = False
+    rules = None
+    if opts.rules is not None:
+        rules = canonrules.load_rules(opts.rules)
+    if opts.policies is None:
+        opts.policies = [p for p in policy_names if p != "rules" or rules is not None]
+    elif "rules" in opts.policies and rules is None:
+        parser.error("the rules policy needs -rules")
+    hosts = opts.hosts or sorted(os.listdir(opts.results))
+    rows = []
+    totals = dict((p, new_stats()) for p in opts.policies)
+    for host in hosts:
+        targets = host_targets(opts.results, host)
+        if len(targets) == 0:
+            continue
+        data = process.load_results(targets)
+        canon = {}
+        if "canonical" in opts.policies:
+            canon = synonym_canon_map(data, process.sim_thresh,
+                                      process.syn_score_thresh)
+        stats = simulate_host(data["res_lists"], opts.policies, canon, rules,
+                              opts.max_entries, opts.max_bytes)
+        for p in opts.policies:
+            rows.append(stats_row(host, p, stats[p]))
+            for k in totals[p]:
+                totals[p][k] += stats[p][k]
+
+    fmt = "%-10s %10s %10s %8s %9s %14s %14s %9s"
+    print fmt % ("policy", "requests", "hits", "stale", "hit rate", "bytes",
+                 "bytes saved", "byte hr")
+    for p in opts.policies:
+        row = stats_row("", p, totals[p])
+        print fmt % tuple(row[1:])
+
+    if opts.out is not None:
+        with open(opts.out, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+  Compiles verified URL reductions into canonicalization rules, and applies
+  them.
+
+  synurl.fetch_reduced_urls records, for every reduced URL it fetches,
+  whether the fetch brought back the synonym set's contents (the
+  "verification" records, see records.py). A verified reduced URL shows which
+  segments of the original synonym URLs don't matter. The compiler aligns each
+  synonym URL with its verified reduction and turns the dropped segments into
+  a rule:
+
+      netloc      the netloc the rule applies to (rules never drop netloc or
+                  scheme segments)
+      path        the path segments of the synonym URL, with the dropped ones
+                  replaced by wild_sym since their values vary
+      drop_path   indexes of the path segments to drop
+      drop_query, drop_params, drop_frag
+                  names of the query, ;params and fragment parameters to drop
+                  ('' stands for bare values without a name=)
+      support     number of verified synonym URLs the rule was learned from
+
+  Rules for the same netloc and path are merged. Canonicalizer applies a rule
+  set: a dictionary lookup on the netloc selects that netloc's rules, whose
+  path templates are precompiled into a single regular expression (an
+  alternation with one group per rule), so each URL costs one urlparse, one
+  dictionary lookup and at most one regex match.
+
+  Usage:
+      python canonrules.py compile [resultstats dir] [-out rules.json] [-min-support n]
+      python canonrules.py apply rules.json [urlfile]
+"""
+
+import glob
+import json
+import os
+import re
+import sys
+import time
+import urlparse
+
+import records
+import urltable
+
+
+rules_file = "resultstats/agg/canonrules.json"
+wild_sym = urltable.wild_sym
+
+# Python 2's re module supports at most 100 groups per pattern
+max_rules_per_pattern = 99
+
+drop_keys = {urltable.param_code: "drop_params",
+             urltable.query_code: "drop_query",
+             urltable.frag_code: "drop_frag"}
+
+
+def param_name(text):
+    if '=' in text:
+        return text.split('=', 1)[0]
+    return ''
+
+
+# Aligns the segments of a reduced URL with those of the URL it was reduced
+# from; returns the list of (index, text, type) segments of url that the
+# reduction dropped, or None if the reduced URL isn't a reduction of url
+def dropped_segments(url, reduced_url):
+    url_segs = urltable.split_url(url)
+    red_segs = [(txt, ty) for (n, txt, ty) in urltable.split_url(reduced_url)]
+    dropped = []
+    j = 0
+    for (n, txt, ty) in url_segs:
+        if j < len(red_segs) and red_segs[j] == (txt, ty):
+            j += 1
+        else:
+            dropped.append((n, txt, ty))
+    if j != len(red_segs):
+        return None
+    return dropped
+
+
+# Builds the rule saying how to get from url to its verified reduction, or
+# None if the reduction drops segments no rule can express
+def learn_rule(url, reduced_url):
+    dropped = dropped_segments(url, reduced_url)
+    if dropped is None or len(dropped) == 0:
+        return None
+    (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+    path_segs = [seg for seg in path.split('/') if seg != '']
+
+    url_segs = urltable.split_url(url)
+    first_path = len(url_segs)
+    for (n, txt, ty) in url_segs:
+        if ty == urltable.path_code:
+            first_path = n
+            break
+
+    rule = {"netloc": netloc, "path": list(path_segs), "drop_path": [],
+            "drop_query": [], "drop_params": [], "drop_frag": [], "support": 1}
+    for (n, txt, ty) in dropped:
+        if ty == urltable.path_code:
+            rule["drop_path"].append(n - first_path)
+            rule["path"][n - first_path] = wild_sym
+        elif ty in drop_keys:
+            name = param_name(txt)
+            if name not in rule[drop_keys[ty]]:
+                rule[drop_keys[ty]].append(name)
+        else:
+            return None
+    return rule
+
+
+def merge_rule(rules, rule):
+    key = (rule["netloc"], tuple(rule["path"]))
+    if key not in rules:
+        rules[key] = rule
+        return
+    old = rules[key]
+    old["support"] += rule["support"]
+    for k in ["drop_path", "drop_query", "drop_params", "drop_frag"]:
+        for x in rule[k]:
+            if x not in old[k]:
+                old[k].append(x)
+
+
+# Compiles rules from all verification records under the resultstats dir
+def compile_rules(top, min_support):
+    rules = {}
+    paths = glob.glob(os.path.join(top, "*", "*" + records.records_suffix))
+    for path in sorted(paths):
+        for record in records.read_records(path, "verification"):
+            for syn_set in record["sets"]:
+                for reduced_url, (success, match) in syn_set["reduced"].items():
+                    if not success or match == '':
+                        continue
+                    for url in syn_set["syn_urls"]:
+                        rule = learn_rule(url, reduced_url)
+                        if rule is not None:
+                            merge_rule(rules, rule)
+    out = [r for r in rules.values() if r["support"] >= min_support]
+    out.sort(key=lambda r: (r["netloc"], r["path"]))
+    return out
+
+
+def path_regex(path_segs):
+    parts = []
+    for seg in path_segs:
+        if seg == wild_sym:
+            parts.append('[^/]+')
+        else:
+            parts.append(re.escape(seg))
+    return '/'.join(parts)
+
+
+def drop_items(text, sep, names):
+    if text == '' or len(names) == 0:
+        return text
+    return sep.join(item for item in text.split(sep)
+                    if param_name(item) not in names)
+
+
+class Canonicalizer(object):
+
+    def __init__(self, rules):
+        self.by_netloc = {}
+        for rule in rules:
+            self.by_netloc.setdefault(rule["netloc"], []).append(rule)
+        # netloc -> list of (compiled alternation, rules in group order)
+        self.automata = {}
+        for netloc, netloc_rules in self.by_netloc.items():
+            # Exact paths before wildcard ones so the most specific rule wins
+            netloc_rules.sort(key=lambda r: r["path"].count(wild_sym))
+            chunks = []
+            for i in xrange(0, len(netloc_rules), max_rules_per_pattern):
+                chunk = netloc_rules[i:i+max_rules_per_pattern]
+                pattern = '^(?:' + '|'.join('(' + path_regex(r["path"]) + ')'
+                                            for r in chunk) + ')$'
+                prepared = [dict(r, drop_path=set(r["drop_path"]),
+                                 drop_query=set(r["drop_query"]),
+                                 drop_params=set(r["drop_params"]),
+                                 drop_frag=set(r["drop_frag"])) for r in chunk]
+                chunks.append((re.compile(pattern), prepared))
+            self.automata[netloc] = chunks
+
+    def match(self, netloc, path_str):
+        for (regex, chunk_rules) in self.automata.get(netloc, []):
+            m = regex.match(path_str)
+            if m is not None:
+                return chunk_rules[m.lastindex - 1]
+        return None
+
+    def canonicalize(self, url):
+        (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+        if netloc not in self.automata:
+            return url
+        path_segs = [seg for seg in path.split('/') if seg != '']
+        rule = self.match(netloc, '/'.join(path_segs))
+        if rule is None:
+            return url
+        if len(rule["drop_path"]) > 0:
+            kept = [seg for (i, seg) in enumerate(path_segs)
+                    if i not in rule["drop_path"]]
+            new_path = '/' + '/'.join(kept)
+            if path.endswith('/') and len(kept) > 0:
+                new_path += '/'
+            path = new_path
+        params = drop_items(params, ';', rule["drop_params"])
+        query = drop_items(query, '&', rule["drop_query"])
+        fragment = drop_items(fragment, '&', rule["drop_frag"])
+        return urlparse.urlunparse((scheme, netloc, path, params, query, fragment))
+
+
+def load_rules(path):
+    with open(path) as f:
+        return Canonicalizer(json.load(f))
+
+
+def compile_main(args):
+    top = "resultstats"
+    out = rules_file
+    min_support = 1
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '-out':
+            out = args.pop(0)
+        elif arg == '-min-support':
+            min_support = int(args.pop(0))
+        else:
+            top = arg
+    rules = compile_rules(top, min_support)
+    with open(out, 'w') as f:
+        json.dump(rules, f, indent=1, sort_keys=True)
+    print "Compiled", len(rules), "rules for", len(set(r["netloc"] for r in rules)),\
+        "netlocs into", out
+
+
+def apply_main(args):
+    canon = load_rules(args[0])
+    urlfile = sys.stdin
+    if len(args) > 1:
+        urlfile = open(args[1])
+    n = 0
+    changed = 0
+    start = time.time()
+    for line in urlfile:
+        url = line.rstrip('\n')
+        c_url = canon.canonicalize(url)
+        if c_url != url:
+            changed += 1
+        n += 1
+        print c_url
+    elapsed = time.time() - start
+    rate = 0.0
+    if elapsed > 0:
+        rate = n * 60.0 / elapsed
+    sys.stderr.write("%d urls, %d canonicalized, %.0f urls/minute\n" % (n, changed, rate))
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("compile", "apply") or \
+       (sys.argv[1] == "apply" and len(sys.argv) < 3):
+        print "Usage: python canonrules.py compile [resultstats dir] [-out rules.json] [-min-support n]"
+        print "       python canonrules.py apply rules.json [urlfile]"
+        exit()
+    if sys.argv[1] == "compile":
+        compile_main(sys.argv[2:])
+    else:
+        apply_main(sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,35 @@
 
 refetch=0
 setup=0
+restart=0
+procopts=""
 
-if [ $# -gt 2 ]
-then
-    echo "Usage: dprocess.sh ([-refetch]|[-setup])"
-fi
+usage="Usage: dprocess.sh ([-refetch]|[-setup]|[-restart]|[-notext]|[-lowmem]|[-http]|[-host-fetches n]|[-host-secs s]|[-fetches n]|[-secs s]|[-proxy host:port])"
 
-for arg in "$@"
+while [ $# -gt 0 ]
 do
+    arg=$1
+    shift
     if [ $arg = '-refetch' ]
     then
 	refetch=1
     elif [ $arg = '-setup' ]
     then
 	setup=1
+    elif [ $arg = '-restart' ]
+    then
+	restart=1
+    elif [ $arg = '-notext' ] || [ $arg = '-lowmem' ] || [ $arg = '-http' ]
+    then
+	procopts=$procopts" "$arg
+    elif [ $# -gt 0 ] && ([ $arg = '-host-fetches' ] || [ $arg = '-host-secs' ] || \
+			      [ $arg = '-fetches' ] || [ $arg = '-secs' ] || [ $arg = '-proxy' ])
+    then
+	# Refetch budgets (see synurl.py) and proxy (e.g. replay.py)
+	procopts=$procopts" "$arg" "$1
+	shift
     else
-	echo "Usage: dprocess.sh ([-refetch]|[-setup])"
+	echo $usage
     fi
 done
 
@@ -27,27 +40,18 @@ then
 fi
 
 outdir="resultstats"
-synfetchfile=$outdir"/agg/synfetchresults.txt"
-synfetchcsvfile=$outdir"/agg/synfetchresults.csv"
-syndatafile=$outdir"/agg/syndata.txt"
-syndatacsvfile=$outdir"/agg/syndata.csv"
-categoriescsvfile=$outdir"/agg/resourcecategorizationdata.csv"
-
-rm -iv $synfetchfile
-rm -iv $synfetchcsvfile
-rm -iv $syndatafile
-rm -iv $syndatacsvfile
-rm -iv $categoriescsvfile
-
-# Headers for shared CSV files
-echo "Domain,Syn URL Sets,Reduced URLs" > $syndatacsvfile
-echo "Domain,Failed Reduced URL fetches,Untested Reduced URLs,Successful Reduced URL fetches no match,\
-Successful Reduced URL fetches with match" > $synfetchcsvfile
-echo "Domain,Total Resources,Consistent Resources,Content-Inconsistent Resources,Synonym Resources,\
-Inconsistent Resources,Failed Resources,Total Resource bytes,Consistent Resource bytes,Content-Inconsistent\
- Resource bytes,Synonym Resource bytes,Inconsistent Resource bytes,Failed Resource bytes" > $categoriescsvfile
 
+# The refetch budget ledger carries the global budget across hosts and
+# interrupted runs; a fresh run starts a fresh budget
+if [ $restart -eq 1 ] || [ $refetch -eq 1 ]
+then
+    rm -f $outdir/agg/fetchbudget.json
+fi
 
+# Hosts finished by an earlier run have a <host>.done marker and are skipped,
+# unless -restart (or -refetch) is given. Rows aren't appended to the agg files
+# while processing (-noagg); they are rebuilt from every host's records at the
+# end, so an interrupted run can simply be started again.
 for hostdir in results/*; do
     targets=$(find $hostdir -name "results.json")
     re="results/(.*)"
@@ -63,10 +67,24 @@ for hostdir in results/*; do
 	    mkdir -v $sitedir"/fetched"
 	fi
 
+	donefile=$sitedir/$hostname".done"
+	if [ -f $donefile ]
+	then
+	    if [ $restart -eq 0 ] && [ $refetch -eq 0 ]
+	    then
+		echo "skipping "$hostdir" (done)"
+		continue
+	    fi
+	    rm $donefile
+	fi
+
 	outfile=$sitedir/$hostname"-detailed.txt"
 	echo "processing "$hostdir"..."
-	python process.py $refetch $targets > $outfile
+	python process.py -noagg $procopts $refetch $targets > $outfile".tmp" && \
+	    mv $outfile".tmp" $outfile
     else
 	echo "Script error; can't extract output directory name"
     fi
 done
+
+python aggregate.py -rebuild $outdir
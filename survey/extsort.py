@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+  Out-of-core processing of a whole survey.
+
+  process.py keeps a host's fetches in dicts, which is fine one host at a
+  time, but anything across hosts would need every host's dicts at once.
+  This computes the same per-host products for every host of a survey with
+  memory bounded by -run-records, by sorting tuples on disk and joining
+  sorted streams:
+
+      ingest    every resource of every successful fetch (duplicate URLs
+                dropped as helper.remove_dup_urls does) becomes
+                R = (host, url id, fetch, hash, size), and every URL once per
+                host N = (host, url id, url); url ids are numbered per host
+      pass 1    R sorted by (host, url id), merge-joined with N: a URL's
+                group gives its occurrences and hashes (url_occ_dict,
+                url_hash_dict), hence whether it's inconsistent
+                S = (host, url id, occurrences, contents inconsistent)
+                H = (host, hash, size, url, url id) for every non-failed load
+      pass 2    H sorted by (host, hash, size): each group is a hash_url_dict
+                entry, and a synonym set if it has several URLs and isn't a
+                trivial body (synurl.extract_synonym_urls)
+                T = (host, url id, size, synonym) for every load
+      pass 3    T sorted by (host, url id), merge-joined with S, puts each
+                load in its category as categorize_resources_by_fetch does
+
+  ExternalSorter buffers at most run_records tuples, writes each full buffer
+  sorted to a run file under -tmp and merges the runs (fan_in at a time,
+  in several rounds if there are more) when it's read. What stays in memory
+  besides is a few counters per host and, while a host is ingested, its url
+  ids.
+
+  Each host's averaged categories are appended, as process.py writes them to
+  resourcecategorizationdata.csv, to resultstats/agg/extcategories.csv, and
+  its synonym sets to resultstats/agg/extsynonyms.jsonl as
+  {"host", "hash", "size", "urls": {url: occurrences}}. -check runs
+  process.py's functions on every host and compares.
+
+  Usage: python extsort.py [-results dir] [-tmp dir] [-run-records n]
+                           [-fan-in n] [-out dir] [-check]
+"""
+
+import argparse
+import collections
+import glob
+import heapq
+import itertools
+import json
+import marshal
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import hashalg
+import helper
+import process
+import synurl
+
+
+run_records = 500000
+fan_in = 64
+categories = ["Total", "Consistent", "C_Inconsistent", "Synonym", "Inconsistent", "Failed"]
+
+
+def read_run(path):
+    with open(path, 'rb', 1 << 16) as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+
+def write_run(path, records):
+    with open(path, 'wb', 1 << 16) as f:
+        for record in records:
+            marshal.dump(record, f)
+
+
+# Sorts tuples of ints and strings that don't fit in memory: add() them, then
+# iterate over the sorter once. Runs are deleted as they are merged
+class ExternalSorter(object):
+
+    def __init__(self, tmp_dir, run_records=run_records, fan_in=fan_in):
+        self.tmp_dir = tmp_dir
+        self.run_records = run_records
+        self.fan_in = fan_in
+        self.buf = []
+        self.runs = []
+        self.n = 0
+        self.n_runs = 0
+
+    def add(self, record):
+        self.buf.append(record)
+        self.n += 1
+        if len(self.buf) >= self.run_records:
+            self._spill()
+
+    def _new_run(self):
+        (fd, path) = tempfile.mkstemp(suffix=".run", dir=self.tmp_dir)
+        os.close(fd)
+        self.n_runs += 1
+        return path
+
+    def _spill(self):
+        self.buf.sort()
+        path = self._new_run()
+        write_run(path, self.buf)
+        self.runs.append(path)
+        self.buf = []
+
+    def _merge(self, paths):
+        for record in heapq.merge(*[read_run(p) for p in paths]):
+            yield record
+        for p in paths:
+            os.remove(p)
+
+    def __iter__(self):
+        if len(self.runs) == 0:
+            self.buf.sort()
+            (buf, self.buf) = (self.buf, [])
+            return iter(buf)
+        if len(self.buf) > 0:
+            self._spill()
+        while len(self.runs) > self.fan_in:
+            path = self._new_run()
+            write_run(path, self._merge(self.runs[:self.fan_in]))
+            self.runs = self.runs[self.fan_in:] + [path]
+        (runs, self.runs) = (self.runs, [])
+        return self._merge(runs)
+
+
+# Joins two streams sorted on their first nkey fields, where right has at most
+# one record per key; yields (left record, right record or None)
+def merge_join(left, right, nkey):
+    right = iter(right)
+    r = next(right, None)
+    for l in left:
+        key = l[:nkey]
+        while r is not None and r[:nkey] < key:
+            r = next(right, None)
+        yield (l, r if r is not None and r[:nkey] == key else None)
+
+
+def host_targets(results_dir):
+    for host in sorted(os.listdir(results_dir)):
+        targets = glob.glob(os.path.join(results_dir, host, "*", "results.json"))
+        if len(targets) > 0:
+            yield (host, sorted(targets, key=lambda t: int(os.path.basename(os.path.dirname(t)))))
+
+
+def new_stats():
+    return dict((c, {"n": 0, "b": 0}) for c in categories)
+
+
+class HostCounts(object):
+
+    def __init__(self, host, n_trials):
+        self.host = host
+        self.n_trials = n_trials
+        self.fail_count = 0
+        self.urls = 0
+        self.inconsistent_urls = 0
+        self.inconsistent_resources = 0
+        self.synonym_sets = 0
+        self.stats = new_stats()
+
+    @property
+    def n_succ_trials(self):
+        return self.n_trials - self.fail_count
+
+
+def ingest(results_dir, r_sort, n_sort):
+    hosts = []
+    for (host_id, (host, targets)) in enumerate(host_targets(results_dir)):
+        counts = HostCounts(host, len(targets))
+        hosts.append(counts)
+        url_ids = {}
+        for (fetch, target) in enumerate(targets):
+            with open(target) as f:
+                results = hashalg.tag_results(json.load(f))
+            if results['status'] != 'success':
+                counts.fail_count += 1
+                continue
+            for r in helper.remove_dup_urls(results['resources']):
+                url = r['url']
+                if url not in url_ids:
+                    url_ids[url] = len(url_ids)
+                    n_sort.add((host_id, url_ids[url], url))
+                r_sort.add((host_id, url_ids[url], fetch, r['hash'], r['size']))
+    return hosts
+
+
+def url_pass(hosts, r_sort, n_sort, s_sort, h_sort):
+    loads = merge_join(r_sort, n_sort, 2)
+    for ((host_id, url_id), group) in itertools.groupby(loads, key=lambda (r, n): r[:2]):
+        counts = hosts[host_id]
+        occurrences = 0
+        hashes = set()
+        for (r, n) in group:
+            (fetch, h, size) = r[2:]
+            occurrences += 1
+            if size == 0:
+                counts.stats["Total"]["n"] += 1
+                counts.stats["Failed"]["n"] += 1
+                continue
+            hashes.add(h)
+            h_sort.add((host_id, h, size, n[2], url_id))
+        c_inconsistent = len(hashes) > 1
+        counts.urls += 1
+        if occurrences < counts.n_succ_trials:
+            counts.inconsistent_urls += 1
+        if c_inconsistent:
+            counts.inconsistent_resources += 1
+        s_sort.add((host_id, url_id, occurrences, c_inconsistent))
+
+
+def hash_pass(hosts, h_sort, t_sort, syn_file):
+    for ((host_id, h, size), group) in itertools.groupby(h_sort, key=lambda r: r[:3]):
+        group = list(group)
+        urls = collections.Counter(r[3] for r in group)
+        synonym = len(urls) > 1 and not synurl.is_trivial_body((h, size))
+        if synonym:
+            hosts[host_id].synonym_sets += 1
+            syn_file.write(json.dumps({"host": hosts[host_id].host, "hash": h, "size": size,
+                                       "urls": dict(urls)}) + "\n")
+        for r in group:
+            t_sort.add((host_id, r[4], size, synonym))
+
+
+def category_pass(hosts, t_sort, s_sort):
+    for ((host_id, url_id, size, synonym), s) in merge_join(t_sort, s_sort, 2):
+        counts = hosts[host_id]
+        (occurrences, c_inconsistent) = s[2:]
+        if synonym:
+            category = "Synonym"
+        elif c_inconsistent:
+            category = "C_Inconsistent"
+        elif occurrences == counts.n_succ_trials:
+            category = "Consistent"
+        else:
+            category = "Inconsistent"
+        for c in ("Total", category):
+            counts.stats[c]["n"] += 1
+            counts.stats[c]["b"] += size
+
+
+def run(results_dir, tmp_dir, out_dir, n_run, n_fan_in):
+    work_dir = tempfile.mkdtemp(prefix="extsort", dir=tmp_dir)
+    sorters = dict((name, ExternalSorter(work_dir, n_run, n_fan_in))
+                   for name in ("R", "N", "S", "H", "T"))
+    syn_path = os.path.join(out_dir, "extsynonyms.jsonl")
+    cat_path = os.path.join(out_dir, "extcategories.csv")
+    times = []
+    try:
+        start = time.time()
+        hosts = ingest(results_dir, sorters["R"], sorters["N"])
+        times.append(("ingest", time.time() - start))
+        url_pass(hosts, sorters["R"], sorters["N"], sorters["S"], sorters["H"])
+        times.append(("pass 1", time.time() - start))
+        with open(syn_path, 'w') as syn_file:
+            hash_pass(hosts, sorters["H"], sorters["T"], syn_file)
+        times.append(("pass 2", time.time() - start))
+        category_pass(hosts, sorters["T"], sorters["S"])
+        times.append(("pass 3", time.time() - start))
+    finally:
+        shutil.rmtree(work_dir)
+
+    open(cat_path, 'w').close()
+    averages = {}
+    for counts in hosts:
+        # The totals as a single fetch average the same as the fetches do
+        averages[counts.host] = process.average_resource_stats(
+            [counts.stats], counts.n_succ_trials, cat_path, counts.host)
+    for (name, sorter) in sorted(sorters.items()):
+        print "%s: %d tuples in %d runs" % (name, sorter.n, sorter.n_runs)
+    print "; ".join("%s %.1fs" % t for t in times)
+    print "%d hosts, %d urls, %d synonym sets; peak RSS %d MB" % \
+        (len(hosts), sum(c.urls for c in hosts), sum(c.synonym_sets for c in hosts),
+         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
+    print "Wrote", cat_path, "and", syn_path
+    return (hosts, averages, syn_path)
+
+
+# Compares with process.py's in-memory functions; returns the number of
+# hosts that differ
+def check(results_dir, hosts, averages, syn_path):
+    syn_sets = collections.defaultdict(dict)
+    with open(syn_path) as f:
+        for line in f:
+            s = json.loads(line)
+            syn_sets[s["host"]][(s["hash"], s["size"])] = s["urls"]
+    counts_by_host = dict((c.host, c) for c in hosts)
+    bad = 0
+    for (host, targets) in host_targets(results_dir):
+        data = process.load_results(targets)
+        n_succ = data["n_trials"] - data["fail_count"]
+        syn_url_dict = synurl.extract_synonym_urls(data["hash_url_dict"])
+        inconsistent = process.extract_inconsistent_resources(data["url_hash_dict"])
+        stats = process.categorize_resources_by_fetch(
+            data["res_lists"], data["url_occ_dict"], data["res_fail_dict"], syn_url_dict,
+            inconsistent, n_succ, False, None, None)
+        expected = process.average_resource_stats(stats, n_succ, None, host)
+        counts = counts_by_host[host]
+        got = (averages[host], syn_sets.get(host, {}), counts.inconsistent_resources,
+               counts.inconsistent_urls)
+        want = (expected, syn_url_dict, len(inconsistent),
+                len(process.extract_inconsistent_urls(data["url_occ_dict"], data["n_trials"],
+                                                      data["fail_count"])))
+        if got != want:
+            bad += 1
+            print "MISMATCH", host
+    print "check:", len(counts_by_host) - bad, "hosts match,", bad, "differ"
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description="out-of-core categorization of a survey")
+    parser.add_argument("-results", default="results")
+    parser.add_argument("-tmp", default=tempfile.gettempdir(),
+                        help="directory for the sorted runs")
+    parser.add_argument("-run-records", type=int, default=run_records,
+                        help="tuples held in memory per sorter")
+    parser.add_argument("-fan-in", type=int, default=fan_in, help="runs merged at a time")
+    parser.add_argument("-out", default=os.path.join(process.outdir, "agg"))
+    parser.add_argument("-check", action="store_true",
+                        help="compare with process.py's in-memory results")
+    opts = parser.parse_args()
+    (hosts, averages, syn_path) = run(opts.results, opts.tmp, opts.out, opts.run_records,
+                                      opts.fan_in)
+    if opts.check:
+        check(opts.results, hosts, averages, syn_path)
+
+
+if __name__ == '__main__':
+    main()
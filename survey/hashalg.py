@@ -0,0 +1,177 @@
+"""
+  Content hash algorithms of a survey.
+
+  survey.js and fetchsyn.js hash every resource body with SHA-1 (CryptoJS) by
+  default, which is slow in JavaScript for large bodies and runs on the
+  page's event loop. They can use another algorithm instead (map.sh with
+  SURVEY_HASH=murmur3; fetchsyn.js takes it as its third argument), which is
+  recorded in the result file:
+
+      {"url": ..., "hash_alg": "murmur3", "page": ..., "resources": [...]}
+
+  Result files without "hash_alg" (every older run) are SHA-1. So that
+  hashes of different algorithms never compare equal, tag_results rewrites
+  a result's resource hashes to "<alg>:<hex>" for every algorithm except
+  SHA-1, whose hashes stay bare: SHA-1 runs read exactly as before, and a
+  host whose fetches mix algorithms sees their contents as different rather
+  than the same. Everything that reads result files (process.py, synurl.py
+  for refetches, cachesim.py, extsort.py, invindex.py, replay.py) tags them
+  on load, and anything hashing a body itself (httpverify.py) uses the
+  algorithm of the hash it compares with. Page hashes aren't tagged: they
+  name the files under pages/. replay.py serves the tagged hash in its
+  X-Replay-Hash header, which the scripts record as is (marking a bare one
+  "sha1:" when they hash with another algorithm).
+
+  The algorithms, computed here over a body's bytes as the scripts compute
+  them over its UTF-8 encoding:
+
+      sha1      SHA-1, 40 hex digits
+      murmur3   MurmurHash3 x86_128 with seed 0, 32 hex digits (the 16
+                bytes of its four 32-bit words, little-endian)
+"""
+
+import binascii
+import hashlib
+import struct
+
+
+default = "sha1"
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _rotl32(x, r):
+    return ((x << r) | (x >> (32 - r))) & 0xffffffff
+
+
+def _fmix32(h):
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+def murmur3(data, seed=0):
+    c1 = 0x239b961b
+    c2 = 0xab0e9789
+    c3 = 0x38b34ae5
+    c4 = 0xa1e38b93
+    n = len(data)
+    n_blocks = n // 16
+    h1 = h2 = h3 = h4 = seed
+    words = struct.unpack_from('<%dI' % (4 * n_blocks), data)
+    for i in xrange(0, 4 * n_blocks, 4):
+        (k1, k2, k3, k4) = words[i:i + 4]
+
+        k1 = (_rotl32((k1 * c1) & 0xffffffff, 15) * c2) & 0xffffffff
+        h1 ^= k1
+        h1 = (((_rotl32(h1, 19) + h2) & 0xffffffff) * 5 + 0x561ccd1b) & 0xffffffff
+
+        k2 = (_rotl32((k2 * c2) & 0xffffffff, 16) * c3) & 0xffffffff
+        h2 ^= k2
+        h2 = (((_rotl32(h2, 17) + h3) & 0xffffffff) * 5 + 0x0bcaa747) & 0xffffffff
+
+        k3 = (_rotl32((k3 * c3) & 0xffffffff, 17) * c4) & 0xffffffff
+        h3 ^= k3
+        h3 = (((_rotl32(h3, 15) + h4) & 0xffffffff) * 5 + 0x96cd1c35) & 0xffffffff
+
+        k4 = (_rotl32((k4 * c4) & 0xffffffff, 18) * c1) & 0xffffffff
+        h4 ^= k4
+        h4 = (((_rotl32(h4, 13) + h1) & 0xffffffff) * 5 + 0x32ac3b17) & 0xffffffff
+
+    tail = bytearray(data[16 * n_blocks:])
+    k = [0, 0, 0, 0]
+    for i in xrange(len(tail)):
+        k[i // 4] |= tail[i] << (8 * (i % 4))
+    if len(tail) > 12:
+        h4 ^= (_rotl32((k[3] * c4) & 0xffffffff, 18) * c1) & 0xffffffff
+    if len(tail) > 8:
+        h3 ^= (_rotl32((k[2] * c3) & 0xffffffff, 17) * c4) & 0xffffffff
+    if len(tail) > 4:
+        h2 ^= (_rotl32((k[1] * c2) & 0xffffffff, 16) * c3) & 0xffffffff
+    if len(tail) > 0:
+        h1 ^= (_rotl32((k[0] * c1) & 0xffffffff, 15) * c2) & 0xffffffff
+
+    h1 ^= n
+    h2 ^= n
+    h3 ^= n
+    h4 ^= n
+    h1 = (h1 + h2 + h3 + h4) & 0xffffffff
+    h2 = (h2 + h1) & 0xffffffff
+    h3 = (h3 + h1) & 0xffffffff
+    h4 = (h4 + h1) & 0xffffffff
+    (h1, h2, h3, h4) = (_fmix32(h1), _fmix32(h2), _fmix32(h3), _fmix32(h4))
+    h1 = (h1 + h2 + h3 + h4) & 0xffffffff
+    h2 = (h2 + h1) & 0xffffffff
+    h3 = (h3 + h1) & 0xffffffff
+    h4 = (h4 + h1) & 0xffffffff
+    return binascii.hexlify(struct.pack('<4I', h1, h2, h3, h4))
+
+
+# Algorithm name -> (function of a byte string returning hex, digest bytes)
+algorithms = {"sha1": (sha1, 20), "murmur3": (murmur3, 16)}
+# One byte per algorithm for binary keys (invindex.py); never renumber
+alg_ids = {"sha1": 0, "murmur3": 1}
+key_size = 21
+
+
+def results_alg(results):
+    return results.get("hash_alg", default)
+
+
+# Tags h, a hash computed with alg; a hash already tagged keeps its own
+# algorithm ("sha1:<hex>", as the scripts mark a bare replay.py hash, is bare)
+def tag(alg, h):
+    if ':' in h:
+        return untag(h) if alg_of(h) == default else h
+    if alg == default:
+        return h
+    return alg + ":" + h
+
+
+def alg_of(tagged):
+    if ':' in tagged:
+        return tagged.split(':', 1)[0]
+    return default
+
+
+def untag(tagged):
+    return tagged.split(':', 1)[-1]
+
+
+# Hash of a body with the given algorithm, tagged
+def hash_body(data, alg=default):
+    return tag(alg, algorithms[alg][0](data))
+
+
+# Tags the resource hashes of a result file in place; returns it
+def tag_results(results):
+    alg = results_alg(results)
+    if alg != default:
+        for r in results.get("resources", []):
+            r["hash"] = tag(alg, r["hash"])
+    return results
+
+
+# Tagged hashes of the empty body in every algorithm
+def empty_hashes():
+    return set(hash_body("", alg) for alg in algorithms)
+
+
+# Fixed-size binary form of a tagged hash (algorithm id, then the digest
+# padded to 20 bytes), ordered by algorithm, and back
+def to_key(tagged):
+    alg = alg_of(tagged)
+    return chr(alg_ids[alg]) + binascii.unhexlify(untag(tagged)).ljust(key_size - 1, '\0')
+
+
+def from_key(key):
+    alg_id = ord(key[0])
+    for (alg, i) in alg_ids.items():
+        if i == alg_id:
+            return tag(alg, binascii.hexlify(key[1:1 + algorithms[alg][1]]))
+    raise ValueError("unknown hash algorithm id %d" % alg_id)
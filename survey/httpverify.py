@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+  Direct HTTP verification of reduced URLs.
+
+  Checking a reduced URL only needs the body at that URL, but
+  synurl.fetch_and_compare launches slimerjs to load it as a page and scans
+  every resource of the load. With synurl.verify_engine set to "http"
+  (process.py -http), the URL is first fetched directly over a pool of
+  keep-alive connections (one per scheme, host and port, reused across all
+  the reduced URLs of a host), following redirects. The body is hashed like
+  survey.js does, with the algorithm of the hash it's compared with
+  (hashalg.py): since the script hashes the body as the browser decoded it,
+  the hash of the raw bytes and of the bytes decoded as Latin-1 or as the
+  response's charset (re-encoded as UTF-8) all count.
+
+  The result has the format of fetchsyn.js's, so it is cached and compared
+  the same way, plus the redirect chain ([url, status] per hop) and
+  "engine": "http". Its only resource is the final URL, listed once per
+  candidate hash (and the X-Replay-Hash header's when fetching through a
+  proxy, i.e. replaying a survey with replay.py). The browser is only launched when the direct fetch is
+  inconclusive: a network or TLS error, too many redirects, a 5xx, a body over
+  max_body_size, or an HTML page other than an error page that doesn't match
+  (the browser would load its subresources, one of which might).
+
+  For testing without the network, "serve" serves recorded bodies from a
+  directory (the file at each URL path, and the redirects listed in
+  redirects.json as {path: location}) over keep-alive HTTP/1.1, and "check"
+  runs the verification of one URL:
+
+      python httpverify.py serve <dir> [-port 8000]
+      python httpverify.py check <hash> <url> ...
+"""
+
+import BaseHTTPServer
+import httplib
+import json
+import mimetypes
+import os
+import socket
+import sys
+import time
+import urllib
+import urlparse
+
+import hashalg
+
+
+max_redirects = 10
+max_body_size = 32 << 20
+request_timeout = 30
+user_agent = "Mozilla/5.0 (X11; Linux x86_64; rv:38.0) Gecko/20100101 Firefox/38.0"
+redirect_codes = (301, 302, 303, 307, 308)
+
+
+class ConnectionPool(object):
+
+    # With a proxy ("host:port"), every request goes to it with the absolute URL
+    def __init__(self, timeout=request_timeout, proxy=None):
+        self.timeout = timeout
+        self.proxy = None
+        if proxy is not None:
+            (host, port) = proxy.rsplit(':', 1)
+            self.proxy = ("http", host, int(port))
+        self.conns = {}
+        self.opened = 0
+        self.requests = 0
+
+    def _connect(self, key):
+        (scheme, host, port) = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        self.opened += 1
+        self.conns[key] = conn
+        return conn
+
+    def discard(self, key):
+        conn = self.conns.pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    # GETs path on the pooled connection for key; a reused connection the
+    # server has since closed is reopened once. Returns (response, body)
+    def get(self, key, path, headers):
+        for attempt in (0, 1):
+            reused = key in self.conns
+            conn = self.conns.get(key) or self._connect(key)
+            # Every request sent counts, answered or not (synurl's fetch budgets)
+            self.requests += 1
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                length = resp.getheader("content-length")
+                if length is not None and length.isdigit() and int(length) > max_body_size:
+                    self.discard(key)
+                    raise IOError("body over %d bytes" % max_body_size)
+                body = resp.read(max_body_size + 1)
+            except (httplib.HTTPException, socket.error):
+                self.discard(key)
+                if reused and attempt == 0:
+                    continue
+                raise
+            if len(body) > max_body_size:
+                self.discard(key)
+                raise IOError("body over %d bytes" % max_body_size)
+            if resp.will_close:
+                self.discard(key)
+            return (resp, body)
+
+    def close(self):
+        for key in self.conns.keys():
+            self.discard(key)
+
+
+def pool_key(parsed):
+    port = parsed.port
+    if port is None:
+        port = 443 if parsed.scheme == "https" else 80
+    return (parsed.scheme, parsed.hostname, port)
+
+
+# Hashes survey.js may have recorded for a body with alg: of the raw bytes,
+# and of the text the browser decoded (as the declared charset, or byte by
+# byte)
+def body_hashes(body, content_type, alg=hashalg.default):
+    hashes = [hashalg.hash_body(body, alg)]
+    charsets = ["latin-1"]
+    for param in content_type.split(';')[1:]:
+        (name, _, value) = param.strip().partition('=')
+        if name.lower() == "charset" and value:
+            charsets.insert(0, value.strip('"\''))
+    for charset in charsets:
+        try:
+            h = hashalg.hash_body(body.decode(charset).encode('utf-8'), alg)
+        except (LookupError, UnicodeError):
+            continue
+        if h not in hashes:
+            hashes.append(h)
+    return hashes
+
+
+# Fetches url, following redirects; returns (status, final url, chain,
+# response, body), where status is the final HTTP status or None if the fetch
+# failed (the chain's last entry then holds the error)
+def fetch(url, pool):
+    chain = []
+    headers = {"User-Agent": user_agent, "Accept": "*/*"}
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    for hop in xrange(max_redirects + 1):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            chain.append([url, "unsupported url"])
+            return (None, url, chain, None, None)
+        path = parsed.path or "/"
+        if parsed.params:
+            path += ";" + parsed.params
+        if parsed.query:
+            path += "?" + parsed.query
+        key = pool_key(parsed)
+        if pool.proxy is not None:
+            key = pool.proxy
+            path = parsed.scheme + "://" + parsed.netloc + path
+        try:
+            # Percent-encode what a browser would (non-ASCII and spaces)
+            (resp, body) = pool.get(key, urllib.quote(path, safe="%/;:@&=+$,!~*'()?[]"),
+                                    headers)
+        except (httplib.HTTPException, socket.error, IOError) as e:
+            chain.append([url, str(e) or e.__class__.__name__])
+            return (None, url, chain, None, None)
+        chain.append([url, resp.status])
+        location = resp.getheader("location")
+        if resp.status in redirect_codes and location:
+            url = urlparse.urljoin(url, location)
+            continue
+        return (resp.status, url, chain, resp, body)
+    chain.append([url, "too many redirects"])
+    return (None, url, chain, None, None)
+
+
+# Verifies url against the hash of the original resource; returns a result in
+# fetchsyn.js's format, or None if the browser has to decide
+def fetch_result(orig_h, url, pool):
+    (status, final_url, chain, resp, body) = fetch(url, pool)
+    if status is None or status >= 500:
+        return None
+    content_type = resp.getheader("content-type") or ""
+    alg = hashalg.alg_of(orig_h)
+    hashes = body_hashes(body, content_type, alg)
+    # replay.py serves placeholder bodies along with the recorded hash
+    # (tagged); only trusted through a proxy, since any live server could send it
+    replay_h = None
+    if pool.proxy is not None:
+        replay_h = resp.getheader("x-replay-hash")
+    if replay_h and replay_h not in hashes:
+        hashes.insert(0, replay_h)
+    # A 4xx means the resource isn't there whatever the browser would make of
+    # the error page
+    if orig_h not in hashes and status < 400 and \
+       content_type.split(';')[0].strip().lower() in ("text/html", "application/xhtml+xml"):
+        return None
+    return {"url": url, "status": "success", "page": None, "engine": "http",
+            "hash_alg": alg, "chain": chain,
+            "resources": [{"url": final_url, "hash": h, "size": len(body)} for h in hashes]}
+
+
+# Serves the files under root at their paths and the redirects in
+# root/redirects.json, keeping connections alive
+class RecordedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    root = "."
+    redirects = {}
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if self.path in self.redirects or path in self.redirects:
+            self.send_response(302)
+            self.send_header("Location", self.redirects.get(self.path,
+                                                            self.redirects.get(path)))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        root = os.path.abspath(self.root)
+        file_path = os.path.normpath(os.path.join(root, path.lstrip('/')))
+        # Only files inside root, not in a sibling directory sharing its prefix
+        if not file_path.startswith(root.rstrip(os.sep) + os.sep) or \
+           not os.path.isfile(file_path):
+            self.send_error(404)
+            return
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(file_path)[0] or
+                         "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def serve(root, port):
+    RecordedHandler.root = os.path.abspath(root)
+    redirects_path = os.path.join(root, "redirects.json")
+    if os.path.exists(redirects_path):
+        with open(redirects_path) as f:
+            RecordedHandler.redirects = json.load(f)
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", port), RecordedHandler)
+    print "Serving", root, "on port", port
+    server.serve_forever()
+
+
+def check(orig_h, urls):
+    pool = ConnectionPool()
+    start = time.time()
+    for url in urls:
+        result = fetch_result(orig_h, url, pool)
+        if result is None:
+            print "inconclusive", url
+            continue
+        matched = any(r["hash"] == orig_h for r in result["resources"])
+        print "match" if matched else "no match", url
+        for (hop, status) in result["chain"]:
+            print "\t", status, hop
+    sys.stderr.write("%d urls, %d requests over %d connections in %.2fs\n" %
+                     (len(urls), pool.requests, pool.opened, time.time() - start))
+    pool.close()
+
+
+def main():
+    usage = ["Usage: python httpverify.py serve <dir> [-port 8000]",
+             "       python httpverify.py check <hash> <url> ..."]
+    if len(sys.argv) < 3 or sys.argv[1] not in ("serve", "check") or \
+       (sys.argv[1] == "check" and len(sys.argv) < 4):
+        print "\n".join(usage)
+        exit()
+    if sys.argv[1] == "serve":
+        port = 8000
+        if '-port' in sys.argv:
+            port = int(sys.argv[sys.argv.index('-port') + 1])
+        serve(sys.argv[2], port)
+    else:
+        check(sys.argv[2], sys.argv[3:])
+
+
+if __name__ == '__main__':
+    main()
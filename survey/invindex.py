@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+  Survey-wide inverted index from resource contents to where they were loaded.
+
+  process.py looks for synonym URLs within one host, but the same CDN
+  libraries and ad scripts are loaded by many sites, often under different
+  URLs. This builds, in one pass over results/*/*/results.json, an index from
+  each resource's (hash, size) to every (host, fetch, url) that loaded it,
+  stored under resultstats/agg/invindex/ as:
+
+      hosts.txt     one host per line; a host id is its line number
+      urls.fcd      every distinct resource URL, sorted and front-coded
+                    (urldict.py); a url id is its rank
+      postings.bin  fixed-size records sorted by (hash, size, host, fetch, url):
+                    the hash as a 21-byte key (hashalg.to_key: its
+                    algorithm's id, then the digest), then size, host id,
+                    fetch number and url id as little-endian 32-bit
+                    unsigned ints
+
+  Since the postings are sorted and fixed-size, looking a hash up is a binary
+  search over the memory-mapped file; the sequential scans behind "shared"
+  and "synonyms" read it in order without loading it. Failed resources
+  (size 0) aren't indexed; the cross-site reports also leave out empty and
+  trivially small bodies (synurl.is_trivial_body). Since url ids follow the
+  URLs' order, the URLs under a prefix are a range of ids, which "urls"
+  reports on.
+
+  Usage:
+      python invindex.py build [-results dir] [-index dir]
+      python invindex.py hosts <hash> [-index dir]
+      python invindex.py shared [-min-hosts n] [-top n] [-index dir]
+      python invindex.py synonyms [-top n] [-index dir]
+      python invindex.py urls <url prefix> [-top n] [-index dir]
+"""
+
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import hashalg
+import synurl
+import urldict
+
+
+index_dir = "resultstats/agg/invindex"
+posting = struct.Struct('<%dsIIII' % hashalg.key_size)
+
+
+def host_fetches(results_dir, host):
+    targets = glob.glob(os.path.join(results_dir, host, "*", "results.json"))
+    return sorted((int(os.path.basename(os.path.dirname(t))), t) for t in targets)
+
+
+def write_lines(path, lines):
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(line.encode('utf-8') + '\n')
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [line[:-1].decode('utf-8') for line in f]
+
+
+def build(results_dir, out_dir):
+    hosts = sorted(os.listdir(results_dir))
+    url_ids = {}
+    loads = []
+    for host_id, host in enumerate(hosts):
+        for (fetch, target) in host_fetches(results_dir, host):
+            with open(target) as f:
+                results = hashalg.tag_results(json.load(f))
+            if results['status'] != 'success':
+                continue
+            for r in results['resources']:
+                if r['size'] == 0:
+                    continue
+                url_id = url_ids.setdefault(r['url'], len(url_ids))
+                loads.append((hashalg.to_key(r['hash']), r['size'], host_id, fetch, url_id))
+    # url ids are assigned in order of appearance above, then renumbered by
+    # rank in the URL dictionary
+    urls = urldict.URLDict.build(url_ids)
+    rank = [0] * len(url_ids)
+    for (i, url) in enumerate(urls):
+        rank[url_ids[url]] = i
+    del url_ids
+    postings = [posting.pack(h, size, host_id, fetch, rank[url_id])
+                for (h, size, host_id, fetch, url_id) in loads]
+    del loads
+    # Packed little-endian ints don't sort numerically, so sort on the tuples
+    postings.sort(key=posting.unpack)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    write_lines(os.path.join(out_dir, "hosts.txt"), hosts)
+    urls.save(os.path.join(out_dir, "urls.fcd"))
+    tmp_path = os.path.join(out_dir, "postings.bin.tmp")
+    with open(tmp_path, 'wb') as f:
+        for p in postings:
+            f.write(p)
+    os.rename(tmp_path, os.path.join(out_dir, "postings.bin"))
+    return (len(hosts), len(urls), len(postings))
+
+
+class InvertedIndex(object):
+
+    def __init__(self, path=index_dir):
+        self.path = path
+        self.hosts = read_lines(os.path.join(path, "hosts.txt"))
+        self.urls = urldict.URLDict.load(os.path.join(path, "urls.fcd"))
+        self.f = open(os.path.join(path, "postings.bin"), 'rb')
+        self.n = os.fstat(self.f.fileno()).st_size // posting.size
+        self.m = None
+        if self.n > 0:
+            self.m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def url(self, url_id):
+        return self.urls.url(url_id)
+
+    def _hash_at(self, i):
+        return self.m[i * posting.size:i * posting.size + hashalg.key_size]
+
+    # Index of the first posting whose hash is >= the given hash key
+    def _lower_bound(self, key):
+        lo = 0
+        hi = self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Postings of a (tagged) hex hash as (hash key, size, host, fetch, url id)
+    # tuples
+    def lookup(self, h):
+        key = hashalg.to_key(h)
+        out = []
+        i = self._lower_bound(key)
+        while i < self.n and self._hash_at(i) == key:
+            out.append(posting.unpack_from(self.m, i * posting.size))
+            i += 1
+        return out
+
+    # Sequential scan yielding ((tagged hex hash, size), [postings]) per content
+    def groups(self):
+        key = None
+        group = []
+        for i in xrange(self.n):
+            p = posting.unpack_from(self.m, i * posting.size)
+            if (p[0], p[1]) != key:
+                if key is not None:
+                    yield ((hashalg.from_key(key[0]), key[1]), group)
+                key = (p[0], p[1])
+                group = []
+            group.append(p)
+        if key is not None:
+            yield ((hashalg.from_key(key[0]), key[1]), group)
+
+    def close(self):
+        if self.m is not None:
+            self.m.close()
+        self.f.close()
+        if isinstance(self.urls.data, mmap.mmap):
+            self.urls.data.close()
+
+
+# Contents loaded by at least min_hosts hosts, each as
+# ((hash, size), n hosts, n distinct urls, bytes a shared cache would save)
+# where a shared content-addressed cache is assumed to serve every host's
+# first load of the content except the first host's
+def shared_contents(index, min_hosts):
+    shared = []
+    for (key, group) in index.groups():
+        if synurl.is_trivial_body(key):
+            continue
+        hosts = set(p[2] for p in group)
+        if len(hosts) < min_hosts:
+            continue
+        urls = set(p[4] for p in group)
+        shared.append((key, len(hosts), len(urls), key[1] * (len(hosts) - 1)))
+    shared.sort(key=lambda s: -s[3])
+    return shared
+
+
+# Bytes of each host's first load of every non-trivial content: what a
+# per-site cache has to fetch at least once
+def first_load_bytes(index):
+    total = 0
+    for (key, group) in index.groups():
+        if not synurl.is_trivial_body(key):
+            total += key[1] * len(set(p[2] for p in group))
+    return total
+
+
+def parse_index_opt(args):
+    path = index_dir
+    rest = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '-index' and len(args) > 0:
+            path = args.pop(0)
+        else:
+            rest.append(arg)
+    return (path, rest)
+
+
+def int_opt(args, name, default):
+    if name in args:
+        i = args.index(name)
+        value = int(args[i + 1])
+        del args[i:i + 2]
+        return value
+    return default
+
+
+def build_main(args):
+    results_dir = "results"
+    if '-results' in args:
+        i = args.index('-results')
+        results_dir = args[i + 1]
+        del args[i:i + 2]
+    (path, args) = parse_index_opt(args)
+    start = time.time()
+    (n_hosts, n_urls, n_postings) = build(results_dir, path)
+    print "Indexed", n_postings, "resource loads of", n_urls, "urls from", n_hosts,\
+        "hosts into", path, "in %.1fs" % (time.time() - start)
+
+
+def hosts_main(index, args):
+    start = time.time()
+    postings = index.lookup(args[0])
+    elapsed = time.time() - start
+    by_host = {}
+    for (h, size, host, fetch, url_id) in postings:
+        by_host.setdefault(host, []).append((fetch, url_id))
+    for host in sorted(by_host, key=lambda h: index.hosts[h]):
+        loads = by_host[host]
+        print index.hosts[host], len(set(f for f, u in loads)), "fetches"
+        for url_id in sorted(set(u for f, u in loads)):
+            print "\t", index.url(url_id)
+    sys.stderr.write("%d hosts, %d loads, lookup %.2f ms\n" %
+                     (len(by_host), len(postings), elapsed * 1000))
+
+
+def shared_main(index, args):
+    min_hosts = int_opt(args, '-min-hosts', 2)
+    top = int_opt(args, '-top', 20)
+    start = time.time()
+    shared = shared_contents(index, min_hosts)
+    first = first_load_bytes(index)
+    saved = sum(s[3] for s in shared)
+    print len(shared), "contents loaded by at least", min_hosts, "hosts"
+    print "First-load bytes per host:", first
+    print "Saved by a cross-site content-addressed cache: %d (%.2f%%)" % \
+        (saved, 100.0 * saved / max(first, 1))
+    fmt = "%-42s %9s %6s %5s %11s"
+    print fmt % ("hash", "size", "hosts", "urls", "saved")
+    for ((h, size), n_hosts, n_urls, s) in shared[:top]:
+        print fmt % (h, size, n_hosts, n_urls, s)
+    sys.stderr.write("scan %.0f ms\n" % ((time.time() - start) * 1000))
+
+
+# Contents loaded by more than one host under more than one URL
+def synonyms_main(index, args):
+    top = int_opt(args, '-top', 20)
+    found = []
+    for (key, group) in index.groups():
+        if synurl.is_trivial_body(key):
+            continue
+        hosts = set(p[2] for p in group)
+        urls = set(p[4] for p in group)
+        if len(hosts) > 1 and len(urls) > 1:
+            found.append((key, hosts, urls))
+    found.sort(key=lambda f: (-len(f[1]), -len(f[2])))
+    print len(found), "contents loaded by several hosts under different URLs"
+    for ((h, size), hosts, urls) in found[:top]:
+        print h, size, "bytes,", len(hosts), "hosts,", len(urls), "urls"
+        for url_id in sorted(urls)[:10]:
+            print "\t", index.url(url_id)
+        if len(urls) > 10:
+            print "\t...", len(urls) - 10, "more"
+
+
+# Loads, hosts and contents of the URLs starting with prefix
+def urls_main(index, args):
+    top = int_opt(args, '-top', 20)
+    (lo, hi) = index.urls.prefix_range(args[0].decode('utf-8'))
+    by_url = {}
+    hosts = set()
+    contents = set()
+    for i in xrange(index.n):
+        (h, size, host, fetch, url_id) = posting.unpack_from(index.m, i * posting.size)
+        if lo <= url_id < hi:
+            by_url[url_id] = by_url.get(url_id, 0) + 1
+            hosts.add(host)
+            contents.add((h, size))
+    print hi - lo, "urls,", sum(by_url.values()), "loads,", len(hosts), "hosts,", \
+        len(contents), "contents"
+    for url_id in sorted(by_url, key=lambda u: (-by_url[u], u))[:top]:
+        print "%6d" % by_url[url_id], index.url(url_id)
+
+
+def main():
+    usage = ["Usage: python invindex.py build [-results dir] [-index dir]",
+             "       python invindex.py hosts <hash> [-index dir]",
+             "       python invindex.py shared [-min-hosts n] [-top n] [-index dir]",
+             "       python invindex.py synonyms [-top n] [-index dir]",
+             "       python invindex.py urls <url prefix> [-top n] [-index dir]"]
+    commands = ("build", "hosts", "shared", "synonyms", "urls")
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or \
+       (sys.argv[1] in ("hosts", "urls") and len(sys.argv) < 3):
+        print "\n".join(usage)
+        exit()
+    command = sys.argv[1]
+    args = sys.argv[2:]
+    if command == "build":
+        build_main(args)
+        return
+    (path, args) = parse_index_opt(args)
+    index = InvertedIndex(path)
+    try:
+        if command == "hosts":
+            hosts_main(index, args)
+        elif command == "shared":
+            shared_main(index, args)
+        elif command == "urls":
+            urls_main(index, args)
+        else:
+            synonyms_main(index, args)
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
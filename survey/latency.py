@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+  Page load latency analysis.
+
+  survey.js records the page load time of every fetch (page.latency, in ms)
+  and process.py writes it to each host's "latency" record, next to the bytes
+  in each consistency category of every fetch ("categories_by_fetch", see
+  records.py). This reads those records for all hosts and reports, per host:
+
+      fetches             successful fetches with a latency
+      median, p90, p99    latency percentiles across fetches (ms)
+      mean, variance      latency mean and variance across fetches
+      r(total bytes)      correlation across the host's fetches between
+                          latency and total bytes, and likewise for the bytes
+                          of each category
+      non-cacheable share fraction of the bytes that are Synonym, Inconsistent
+                          or Contents Inconsistent, i.e. that a browser cache
+                          keyed on URLs can't serve from a previous fetch
+      attributable ms     median latency times the non-cacheable share: the
+                          part of the load time attributable to those bytes,
+                          assuming load time is proportional to bytes
+
+  Hosts are ranked by attributable ms. Across hosts, it also prints the
+  correlation of median latency with mean bytes in each category.
+
+  Usage: python latency.py [resultstats dir] [-out file.csv] [-top n]
+"""
+
+import csv
+import glob
+import math
+import os
+import sys
+
+import records
+
+
+categories = ["Total", "Consistent", "C_Inconsistent", "Synonym",
+              "Inconsistent", "Failed"]
+non_cacheable = ["C_Inconsistent", "Synonym", "Inconsistent"]
+out_file = "resultstats/agg/latency.csv"
+
+
+def mean(xs):
+    return float(sum(xs)) / len(xs)
+
+
+def variance(xs):
+    m = mean(xs)
+    return sum((x - m) ** 2 for x in xs) / len(xs)
+
+
+# Percentile p (0-100) of a sorted list, interpolating between closest ranks
+def percentile(sorted_xs, p):
+    if len(sorted_xs) == 1:
+        return float(sorted_xs[0])
+    pos = (len(sorted_xs) - 1) * p / 100.0
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(sorted_xs) - 1)
+    return sorted_xs[lo] + (sorted_xs[hi] - sorted_xs[lo]) * (pos - lo)
+
+
+# Pearson correlation; None when either side doesn't vary
+def correlation(xs, ys):
+    if len(xs) < 2:
+        return None
+    mx = mean(xs)
+    my = mean(ys)
+    sxy = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    sxx = sum((x - mx) ** 2 for x in xs)
+    syy = sum((y - my) ** 2 for y in ys)
+    if sxx == 0 or syy == 0:
+        return None
+    return sxy / math.sqrt(sxx * syy)
+
+
+# Latencies and per-category byte columns of a host's fetches, from its
+# records file; None if the records have no latency
+def load_host(records_path):
+    stages = records.load_host_records(records_path)
+    if "latency" not in stages or "categories_by_fetch" not in stages:
+        return None
+    latencies = stages["latency"]["latencies"]
+    fetches = stages["categories_by_fetch"]["fetches"]
+    if len(latencies) == 0 or len(latencies) != len(fetches):
+        return None
+    cat_bytes = dict((c, [f[c]["b"] for f in fetches]) for c in categories)
+    return (stages["latency"]["host"], latencies, cat_bytes)
+
+
+def host_stats(latencies, cat_bytes):
+    s = sorted(latencies)
+    stats = {"fetches": len(latencies),
+             "median": percentile(s, 50),
+             "p90": percentile(s, 90),
+             "p99": percentile(s, 99),
+             "mean": mean(latencies),
+             "variance": variance(latencies)}
+    for c in categories:
+        stats["r_" + c] = correlation(latencies, cat_bytes[c])
+        stats["bytes_" + c] = mean(cat_bytes[c])
+    total = sum(cat_bytes["Total"])
+    stats["share"] = 0.0
+    if total > 0:
+        stats["share"] = float(sum(sum(cat_bytes[c]) for c in non_cacheable)) / total
+    stats["attributable"] = stats["median"] * stats["share"]
+    return stats
+
+
+def fmt_r(r):
+    if r is None:
+        return ""
+    return "%.3f" % r
+
+
+header = (["Domain", "Fetches", "Median latency", "P90 latency", "P99 latency",
+           "Mean latency", "Latency variance"] +
+          ["r(%s bytes)" % c for c in categories] +
+          ["Non-cacheable byte share", "Attributable latency"])
+
+
+def stats_row(host, s):
+    return ([host, s["fetches"], "%.1f" % s["median"], "%.1f" % s["p90"],
+             "%.1f" % s["p99"], "%.1f" % s["mean"], "%.1f" % s["variance"]] +
+            [fmt_r(s["r_" + c]) for c in categories] +
+            ["%.4f" % s["share"], "%.1f" % s["attributable"]])
+
+
+def main():
+    top = "resultstats"
+    out = out_file
+    n_top = 20
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '-out' and len(args) > 0:
+            out = args.pop(0)
+        elif arg == '-top' and len(args) > 0:
+            n_top = int(args.pop(0))
+        elif arg.startswith('-'):
+            print "Usage: python latency.py [resultstats dir] [-out file.csv] [-top n]"
+            exit()
+        else:
+            top = arg
+
+    host_rows = []
+    paths = glob.glob(os.path.join(top, "*", "*" + records.records_suffix))
+    for path in sorted(paths):
+        loaded = load_host(path)
+        if loaded is None:
+            continue
+        (host, latencies, cat_bytes) = loaded
+        host_rows.append((host, host_stats(latencies, cat_bytes)))
+    if len(host_rows) == 0:
+        print "No latency records under", top, "(rerun dprocess.sh)"
+        return
+    host_rows.sort(key=lambda (h, s): -s["attributable"])
+
+    with open(out, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for host, s in host_rows:
+            writer.writerow(stats_row(host, s))
+
+    print "Latency of", len(host_rows), "hosts written to", out
+    medians = [s["median"] for h, s in host_rows]
+    for c in categories:
+        r = correlation(medians, [s["bytes_" + c] for h, s in host_rows])
+        print "Across hosts, r(median latency, mean %s bytes) = %s" % (c, fmt_r(r) or "n/a")
+    print
+    fmt = "%-24s %7s %9s %9s %9s %7s %11s"
+    print fmt % ("host", "fetches", "median", "p90", "p99", "share", "attrib ms")
+    for host, s in host_rows[:n_top]:
+        print fmt % (host[:24], s["fetches"], "%.0f" % s["median"], "%.0f" % s["p90"],
+                     "%.0f" % s["p99"], "%.3f" % s["share"], "%.0f" % s["attributable"])
+
+
+if __name__ == '__main__':
+    main()
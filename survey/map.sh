@@ -24,6 +24,17 @@ home=$(pwd)
 cd $outdir
 
 outfile=results.json
+# SURVEY_PROXY=host:port fetches through a proxy, e.g. replay.py, whose
+# X-Replay-Hash headers survey.js then trusts (-replay)
+proxyopt=""
+replayopt=""
+if [[ -n $SURVEY_PROXY ]]; then
+  proxyopt="--proxy=$SURVEY_PROXY"
+  replayopt="-replay"
+fi
+# SURVEY_HASH=murmur3 hashes bodies with MurmurHash3 instead of SHA-1 (see
+# hashalg.py); the script records which in each results.json
+hashalg=${SURVEY_HASH:-sha1}
 while read url <&3; do
   echo "Processing $url..."
   if [[ -d $url ]]; then
@@ -34,7 +45,9 @@ while read url <&3; do
   for i in `seq 1 $loop`; do
 	mkdir $i && cd $i
 	mkdir pages # XXX: this is hardcoded in survey.js
-    slimerjs $home/$1 $url > $outfile &
+    # Under a watchdog so a hung browser can't stall the wait below
+    python $home/supervise.py -log $home/timeouts.jsonl -label $url -- \
+        slimerjs $proxyopt $home/$1 $url $hashalg $replayopt > $outfile &
 	cd ..
   done
   wait
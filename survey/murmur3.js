@@ -0,0 +1,96 @@
+/*
+ * MurmurHash3 x86_128 (seed 0) of the UTF-8 encoding of a string, as hex:
+ * the 16 bytes of its four 32-bit words, little-endian. Over ten times
+ * faster than CryptoJS.SHA1 on large bodies; hashalg.py computes the same in
+ * Python.
+ */
+
+function utf8Bytes(data) {
+	if (typeof TextEncoder !== 'undefined')
+		return new TextEncoder().encode(data);
+	var str = unescape(encodeURIComponent(data));
+	var bytes = new Uint8Array(str.length);
+	for (var i = 0; i < str.length; i++)
+		bytes[i] = str.charCodeAt(i);
+	return bytes;
+}
+
+function murmur3(data) {
+	var bytes = utf8Bytes(data);
+	var n = bytes.length;
+	var nBlocks = n >> 4;
+	var c1 = 0x239b961b, c2 = 0xab0e9789, c3 = 0x38b34ae5, c4 = 0xa1e38b93;
+	var h1 = 0, h2 = 0, h3 = 0, h4 = 0;
+	var k1, k2, k3, k4;
+	var p = 0;
+
+	for (var i = 0; i < nBlocks; i++, p += 16) {
+		k1 = bytes[p] | (bytes[p + 1] << 8) | (bytes[p + 2] << 16) | (bytes[p + 3] << 24);
+		k2 = bytes[p + 4] | (bytes[p + 5] << 8) | (bytes[p + 6] << 16) | (bytes[p + 7] << 24);
+		k3 = bytes[p + 8] | (bytes[p + 9] << 8) | (bytes[p + 10] << 16) | (bytes[p + 11] << 24);
+		k4 = bytes[p + 12] | (bytes[p + 13] << 8) | (bytes[p + 14] << 16) | (bytes[p + 15] << 24);
+
+		k1 = Math.imul(k1, c1); k1 = (k1 << 15) | (k1 >>> 17); k1 = Math.imul(k1, c2);
+		h1 ^= k1; h1 = (h1 << 19) | (h1 >>> 13); h1 = (h1 + h2) | 0;
+		h1 = (Math.imul(h1, 5) + 0x561ccd1b) | 0;
+
+		k2 = Math.imul(k2, c2); k2 = (k2 << 16) | (k2 >>> 16); k2 = Math.imul(k2, c3);
+		h2 ^= k2; h2 = (h2 << 17) | (h2 >>> 15); h2 = (h2 + h3) | 0;
+		h2 = (Math.imul(h2, 5) + 0x0bcaa747) | 0;
+
+		k3 = Math.imul(k3, c3); k3 = (k3 << 17) | (k3 >>> 15); k3 = Math.imul(k3, c4);
+		h3 ^= k3; h3 = (h3 << 15) | (h3 >>> 17); h3 = (h3 + h4) | 0;
+		h3 = (Math.imul(h3, 5) + 0x96cd1c35) | 0;
+
+		k4 = Math.imul(k4, c4); k4 = (k4 << 18) | (k4 >>> 14); k4 = Math.imul(k4, c1);
+		h4 ^= k4; h4 = (h4 << 13) | (h4 >>> 19); h4 = (h4 + h1) | 0;
+		h4 = (Math.imul(h4, 5) + 0x32ac3b17) | 0;
+	}
+
+	var rest = n - p;
+	var k = [0, 0, 0, 0];
+	for (var j = 0; j < rest; j++)
+		k[j >> 2] |= bytes[p + j] << (8 * (j & 3));
+	if (rest > 12) {
+		k4 = Math.imul(k[3], c4); k4 = (k4 << 18) | (k4 >>> 14); h4 ^= Math.imul(k4, c1);
+	}
+	if (rest > 8) {
+		k3 = Math.imul(k[2], c3); k3 = (k3 << 17) | (k3 >>> 15); h3 ^= Math.imul(k3, c4);
+	}
+	if (rest > 4) {
+		k2 = Math.imul(k[1], c2); k2 = (k2 << 16) | (k2 >>> 16); h2 ^= Math.imul(k2, c3);
+	}
+	if (rest > 0) {
+		k1 = Math.imul(k[0], c1); k1 = (k1 << 15) | (k1 >>> 17); h1 ^= Math.imul(k1, c2);
+	}
+
+	h1 ^= n; h2 ^= n; h3 ^= n; h4 ^= n;
+	h1 = (h1 + h2 + h3 + h4) | 0;
+	h2 = (h2 + h1) | 0;
+	h3 = (h3 + h1) | 0;
+	h4 = (h4 + h1) | 0;
+	h1 = fmix32(h1); h2 = fmix32(h2); h3 = fmix32(h3); h4 = fmix32(h4);
+	h1 = (h1 + h2 + h3 + h4) | 0;
+	h2 = (h2 + h1) | 0;
+	h3 = (h3 + h1) | 0;
+	h4 = (h4 + h1) | 0;
+
+	var hex = '';
+	var words = [h1, h2, h3, h4];
+	for (var w = 0; w < 4; w++) {
+		for (var b = 0; b < 32; b += 8) {
+			var byte = (words[w] >>> b) & 0xff;
+			hex += (byte < 16 ? '0' : '') + byte.toString(16);
+		}
+	}
+	return hex;
+}
+
+function fmix32(h) {
+	h ^= h >>> 16;
+	h = Math.imul(h, 0x85ebca6b);
+	h ^= h >>> 13;
+	h = Math.imul(h, 0xc2b2ae35);
+	h ^= h >>> 16;
+	return h;
+}
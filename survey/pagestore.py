@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+  Content-addressed, compressed store for the rendered pages of a survey.
+
+  survey.js writes every rendered page to results/<site>/<n>/pages/<hash>.html,
+  so identical renders are stored once per fetch and near-identical ones (the
+  same page with a different timestamp or ad slot) share almost all of their
+  bytes. This migrates those files into a single store:
+
+      pagestore/objects/<hash[:2]>/<hash>   one object per distinct page
+      pagestore/index.json                  {hash: {size, stored, base, paths}}
+
+  Each object is either the zlib-compressed page, or, if that is smaller, a
+  zlib-compressed line delta against the page of the previous fetch of the
+  same site (base is then that page's hash). A delta is a sequence of
+  copies ('C', start and count as two little-endian 32-bit ints: count lines
+  of the base page from line start) and literals ('L', a 32-bit length and
+  that many bytes of the new page). Delta chains are at most
+  max_chain pages long so opening a page never decompresses more than that.
+
+  open_page(hash) returns the page's bytes. Since the original path of each
+  copy is kept in the index, the pages/ files can be deleted after migration
+  (-delete) and restored from the store if needed.
+
+  Usage: python pagestore.py [-results dir] [-store dir] [-nodelta] [-delete]
+"""
+
+import argparse
+import glob
+import json
+import os
+import struct
+import zlib
+
+
+store_dir = "pagestore"
+index_name = "index.json"
+max_chain = 8
+compress_level = 9
+
+
+def object_path(store, h):
+    return os.path.join(store, "objects", h[:2], h)
+
+
+# Line-based delta of page against base; returns the delta as a list of
+# [start, count] copies and literal strings
+def make_delta(base, page):
+    base_lines = base.splitlines(True)
+    first_at = {}
+    for i, line in enumerate(base_lines):
+        first_at.setdefault(line, i)
+    delta = []
+    literal = []
+    # Current copy run: [start, count] or None
+    run = None
+    for line in page.splitlines(True):
+        if run is not None:
+            nxt = run[0] + run[1]
+            if nxt < len(base_lines) and base_lines[nxt] == line:
+                run[1] += 1
+                continue
+            delta.append(run)
+            run = None
+        if line in first_at:
+            if len(literal) > 0:
+                delta.append(''.join(literal))
+                literal = []
+            run = [first_at[line], 1]
+        else:
+            literal.append(line)
+    if run is not None:
+        delta.append(run)
+    if len(literal) > 0:
+        delta.append(''.join(literal))
+    return delta
+
+
+def encode_delta(delta):
+    out = []
+    for item in delta:
+        if isinstance(item, list):
+            out.append('C' + struct.pack('<II', item[0], item[1]))
+        else:
+            out.append('L' + struct.pack('<I', len(item)) + item)
+    return ''.join(out)
+
+
+def decode_delta(data):
+    delta = []
+    i = 0
+    while i < len(data):
+        if data[i] == 'C':
+            delta.append(list(struct.unpack('<II', data[i+1:i+9])))
+            i += 9
+        else:
+            (n,) = struct.unpack('<I', data[i+1:i+5])
+            delta.append(data[i+5:i+5+n])
+            i += 5 + n
+    return delta
+
+
+def apply_delta(base, delta):
+    base_lines = base.splitlines(True)
+    out = []
+    for item in delta:
+        if isinstance(item, list):
+            out.extend(base_lines[item[0]:item[0] + item[1]])
+        else:
+            out.append(item)
+    return ''.join(out)
+
+
+class PageStore(object):
+
+    def __init__(self, path=store_dir):
+        self.path = path
+        self.index_path = os.path.join(path, index_name)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def __contains__(self, h):
+        return h in self.index
+
+    def chain_length(self, h):
+        n = 0
+        while h is not None:
+            n += 1
+            h = self.index[h]["base"]
+        return n
+
+    def open_page(self, h):
+        entry = self.index[h]
+        with open(object_path(self.path, h), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if entry["base"] is None:
+            return data
+        return apply_delta(self.open_page(entry["base"]), decode_delta(data))
+
+    # Adds a page read from src_path; base is the hash of a stored page to
+    # try a delta against. Returns the number of bytes the object takes
+    # (0 if the page was already stored)
+    def add(self, h, page, src_path, base=None):
+        if h in self.index:
+            if src_path not in self.index[h]["paths"]:
+                self.index[h]["paths"].append(src_path)
+            return 0
+        data = zlib.compress(page, compress_level)
+        use_base = None
+        if base is not None and base in self.index and self.chain_length(base) < max_chain:
+            delta = encode_delta(make_delta(self.open_page(base), page))
+            delta_data = zlib.compress(delta, compress_level)
+            if len(delta_data) < len(data):
+                data = delta_data
+                use_base = base
+        obj_path = object_path(self.path, h)
+        if not os.path.isdir(os.path.dirname(obj_path)):
+            os.makedirs(os.path.dirname(obj_path))
+        with open(obj_path, 'wb') as f:
+            f.write(data)
+        self.index[h] = {"size": len(page), "stored": len(data), "base": use_base,
+                         "paths": [src_path]}
+        return len(data)
+
+    def save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, separators=(',', ':'), sort_keys=True)
+        os.rename(tmp_path, self.index_path)
+
+
+_default_store = None
+
+
+# Opens a stored page by hash from the default store
+def open_page(h, path=store_dir):
+    global _default_store
+    if _default_store is None or _default_store.path != path:
+        _default_store = PageStore(path)
+    return _default_store.open_page(h)
+
+
+# Page files of a site's fetches, in fetch order
+def site_pages(results_dir, site):
+    fetch_dirs = glob.glob(os.path.join(results_dir, site, "*", "pages"))
+    fetch_dirs.sort(key=lambda d: int(os.path.basename(os.path.dirname(d))))
+    pages = []
+    for d in fetch_dirs:
+        pages.extend(sorted(glob.glob(os.path.join(d, "*.html"))))
+    return pages
+
+
+def migrate(results_dir, store, use_delta, delete):
+    orig_bytes = 0
+    n_pages = 0
+    n_deleted = 0
+    for site in sorted(os.listdir(results_dir)):
+        prev = None
+        for page_path in site_pages(results_dir, site):
+            h = os.path.basename(page_path)[:-len(".html")]
+            with open(page_path, 'rb') as f:
+                page = f.read()
+            orig_bytes += os.path.getsize(page_path)
+            n_pages += 1
+            base = None
+            if use_delta:
+                base = prev
+            store.add(h, page, os.path.relpath(page_path, results_dir), base)
+            prev = h
+        store.save()
+        if delete:
+            for page_path in site_pages(results_dir, site):
+                h = os.path.basename(page_path)[:-len(".html")]
+                with open(page_path, 'rb') as f:
+                    page = f.read()
+                # Only delete what reads back identically from the store
+                if store.open_page(h) == page:
+                    os.remove(page_path)
+                    n_deleted += 1
+                else:
+                    print "warning: stored copy of", page_path, "differs, kept it"
+    return (n_pages, orig_bytes, n_deleted)
+
+
+def store_bytes(store):
+    total = os.path.getsize(store.index_path)
+    for entry in store.index.values():
+        total += entry["stored"]
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="content-addressed page store")
+    parser.add_argument("-results", default="results")
+    parser.add_argument("-store", default=store_dir)
+    parser.add_argument("-nodelta", dest="delta", action="store_false",
+                        help="compress pages on their own only")
+    parser.add_argument("-delete", action="store_true",
+                        help="delete the pages/ files once stored")
+    opts = parser.parse_args()
+
+    store = PageStore(opts.store)
+    (n_pages, orig_bytes, n_deleted) = migrate(opts.results, store, opts.delta,
+                                               opts.delete)
+    n_deltas = sum(1 for e in store.index.values() if e["base"] is not None)
+    stored = store_bytes(store)
+    print "Pages:", n_pages, "files,", len(store.index), "distinct,", n_deltas, "stored as deltas"
+    print "Page files:", orig_bytes, "bytes"
+    print "Store:", stored, "bytes (objects + index)"
+    if orig_bytes > 0:
+        print "Saving: %d bytes (%.1f%%)" % (orig_bytes - stored,
+                                             100.0 * (orig_bytes - stored) / orig_bytes)
+    if opts.delete:
+        print "Deleted", n_deleted, "page files"
+
+
+if __name__ == '__main__':
+    main()
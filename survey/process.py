@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import json
+import os
 import sys
 import subprocess
 import csv
@@ -9,9 +10,16 @@ import urltrie
 import urltable
 import synurl
 import helper
+import hashalg
+import records
+import sketch
+import analysis
 
 
 sim_thresh = 0.60
+# Synonym sets whose URLs score below this (see synurl.score_synonym_set) are
+# still counted as synonyms, but aren't reduced or refetched
+syn_score_thresh = 0.60
 sanity_retry_count = 10
 reduced_retry_count = 3
 refetch_all = False
@@ -19,6 +27,28 @@ num_file = "resultstats/temp/resbyfetch.csv"
 size_file = "resultstats/temp/sizeresbyfetch.csv"
 avg_categories_file = "resultstats/agg/resourcecategorizationdata.csv"
 
+# Every output file lives under outdir; see set_outdir
+outdir = "resultstats"
+
+# If False (-noagg), per-host rows aren't appended to the shared agg files;
+# they are rebuilt from the host records instead (aggregate.py -rebuild), so
+# an interrupted run never leaves half a host's rows behind
+agg_files = True
+
+# If False, skip the bulky text dumps (synonym sets, similarity table, reduced
+# URLs) in <host>-detailed.txt; the same data is always written as records
+text_dumps = True
+
+# If True (-lowmem), URL occurrences across fetches are tracked fetch by fetch
+# (sketch.FetchOccurrences) and counted only for URLs missing from some fetch,
+# instead of counting every URL
+low_memory = False
+
+# Set to False (-nofetch) to skip refetching reduced synonym URLs altogether,
+# e.g. on machines without slimerjs; bench.py uses it to time the rest of the
+# pipeline without a browser
+fetch_synonyms = True
+
 def jaccard(sets):
 	if len(sets) == 0:
 		return 0.0
@@ -36,36 +66,33 @@ def jaccard(sets):
 	return len(intersection) / float(len(union))
 
 
-def process_main(sys_args):
-        # Number of trials is (total number of args - 2) (for script name & refetch flag)
-	n_trials = len(sys_args)-2
-        
-        # False by default; if false, tries to read result of fetching reduced
-        # URLs from a file, if true, refetches all whether or not file exists
-        refetch = sys_args[1]
+# results/<site>/<fetch_num>/results.json -> <site>
+def host_of_target(target):
+        return os.path.basename(os.path.dirname(os.path.dirname(target)))
 
-        # arg 2 is the first results/<site>/<fetch_num>/results.json file
-        host = sys_args[2].split('/')[1] 
-        print (host+"\n"+"="*80+"\n")
 
-        # Instruction to synonym URL code to refetch all reduced URLs even if data corresponding
-        # to the fetch is found locally
-        # dprocess.sh will make it false by default unless invoked with the flag '-refetch'
-        if refetch == '1':
-                helper.printd("Refetching all files\n")
-                refetch_all = True
-        else:
-                refetch_all = False
+# Jaccard similarity of sets from the sizes of their intersection and union
+def jaccard_of(n_intersection, n_union):
+        if n_union == 0:
+                return 0.0
+        return n_intersection / float(n_union)
+
+
+# Reads the results.json file of every fetch of a host and builds the per-host
+# structures the rest of the pipeline works from; returns them in a dictionary
+# keyed by the variable names used in process_main
+# The fetches' URL and hash sets aren't kept: their jaccard similarities are
+# computed as the fetches are read. low_memory is -lowmem (see above)
+def load_results(targets, low_memory=False):
+        host = host_of_target(targets[0])
+        n_trials = len(targets)
 
 	fail_count = 0
 
-	# List of Hash sets
+	# Union and intersection of the hash sets of the successful fetches
 	# Each resource is associated with a hash, each attempt with a set of resource hashes
-	hash_sets = []
-	
-	# List of URL sets
-	# Each successful attempt is associated with a set of resource URLs
-	url_sets = []
+	hash_union = set()
+	hash_intersection = None
 
 	# Dictionary mapping each URL to the number of occurrences
 	# For a site that returns exactly the same resources with every attempt,
@@ -73,6 +100,8 @@ def process_main(sys_args):
 	# Handles multiple occurrences of the same URL within a single result
 	# page by using tuple (url, unique) as the key, where unique is incremented
 	url_occ_dict = {}
+        if low_memory:
+                url_occ_dict = sketch.FetchOccurrences()
 
 	# Map each resource URL to a list of hashes it returns
 	# We will be interested in resources that return multiple different hashes
@@ -82,6 +111,7 @@ def process_main(sys_args):
 	# Map each resourse hash to a list of URLs that return it:
         # This mapping is the inverse of the above, but is even more interesting for
         # the purpose of URL canonicalization
+        # Keyed on (hash, size) so colliding hashes of different bodies stay apart
         hash_url_dict = {}
 
         # Resource fail dict
@@ -94,15 +124,19 @@ def process_main(sys_args):
         # A resource is represented as a dictionary {"url","hash","size"}
         res_lists = []
 
+        # Page load latency (ms) of each successful fetch, in the order of res_lists
+        latencies = []
+
 	# Iterate over all of the fetches for a given URL.
 	# We're particularly interested in whether they
 	# saw different URLs or different contents at
 	# the same URL. Computes the Jaccard similarities
 	# for both.
-	for target in sys_args[2:]:
-		host = target.split('/')[1]
+	for target in targets:
+		host = host_of_target(target)
 		with open(target) as data_file:
-			results = json.load(data_file)
+			# Resource hashes are tagged with their algorithm (hashalg.py)
+			results = hashalg.tag_results(json.load(data_file))
 			assert results['url'] == host
 			
 			if results['status'] != 'success':
@@ -113,38 +147,105 @@ def process_main(sys_args):
                         # Ultimately, we would like to change this
 			res = helper.remove_dup_urls(results['resources'])
 			urls = [r['url'] for r in res]
-			hashes = [r['hash'] for r in res]
-			url_sets.append(set(urls))
-			hash_sets.append(set(hashes))
+			hashes = set(r['hash'] for r in res)
+			hash_union |= hashes
+			if hash_intersection is None:
+				hash_intersection = hashes
+			else:
+				hash_intersection &= hashes
                         res_lists.append(res)
+                        latencies.append(results['page']['latency'])
 
-			update_url_occurrences(url_occ_dict, urls)
+                        if low_memory:
+                                url_occ_dict.add_fetch(urls)
+                        else:
+                                update_url_occurrences(url_occ_dict, urls)
                         update_url_hashes(url_hash_dict, hash_url_dict, res)
                         update_res_fails(res_fail_dict, res)
 
+        # A URL is in every URL set if it occurs in every successful fetch
+        n_succ_trials = n_trials - fail_count
+        if low_memory:
+                n_urls_in_all = url_occ_dict.n_in_all()
+        else:
+                n_urls_in_all = sum(1 for n in url_occ_dict.itervalues() if n == n_succ_trials)
+        jaccard_urls = jaccard_of(n_urls_in_all, len(url_occ_dict))
+        jaccard_hashes = jaccard_of(len(hash_intersection or ()), len(hash_union))
+
+        return {"host" : host, "n_trials" : n_trials, "fail_count" : fail_count,
+                "jaccard_urls" : jaccard_urls, "jaccard_hashes" : jaccard_hashes,
+                "url_occ_dict" : url_occ_dict, "url_hash_dict" : url_hash_dict,
+                "hash_url_dict" : hash_url_dict, "res_fail_dict" : res_fail_dict,
+                "res_lists" : res_lists, "latencies" : latencies}
+
+
+def process_main(sys_args):
+        # Number of trials is (total number of args - 2) (for script name & refetch flag)
+	n_trials = len(sys_args)-2
+        
+        # False by default; if false, tries to read result of fetching reduced
+        # URLs from a file, if true, refetches all whether or not file exists
+        refetch = sys_args[1]
+
+        # arg 2 is the first results/<site>/<fetch_num>/results.json file
+        host = host_of_target(sys_args[2])
+        print (host+"\n"+"="*80+"\n")
+
+        # Instruction to synonym URL code to refetch all reduced URLs even if data corresponding
+        # to the fetch is found locally
+        # dprocess.sh will make it false by default unless invoked with the flag '-refetch'
+        if refetch == '1':
+                helper.printd("Refetching all files\n")
+                refetch_all = True
+        else:
+                refetch_all = False
+
+        # Every stage is computed by a HostAnalysis (analysis.py), so this report
+        # and the importable analysis are the same pipeline
+        targets = sys_args[2:]
+        a = analysis.HostAnalysis(os.path.dirname(os.path.dirname(targets[0])), sim_thresh,
+                                  syn_score_thresh, targets, low_memory, helper.debug)
+        fail_count = a.fail_count
 	
         ### The following blocks write a ton of information to the file
         ### 'resultstats/<host>/<host>-detalied.txt'
 						
+        sink = records.open_host_sink(outdir, host)
+
+        jaccard_urls = a.jaccard_urls
+        jaccard_hashes = a.jaccard_hashes
+        sink.write(host, "summary", n_trials=n_trials, fails=fail_count,
+                   jaccard_urls=jaccard_urls, jaccard_hashes=jaccard_hashes)
 	fmt = '%24s: urls=%.3f hashes=%.3f fails=%02d'
-	print fmt % (host, jaccard(url_sets), jaccard(hash_sets), fail_count),
+	print fmt % (host, jaccard_urls, jaccard_hashes, fail_count),
 	print "\n","="*80,"\n",
 
 	print "Inconsistent URLs:"
-	inconsistent_url_dict = extract_inconsistent_urls(url_occ_dict,n_trials,fail_count)
+	inconsistent_url_dict = a.inconsistent_urls
+        sink.write(host, "inconsistent_urls", urls=inconsistent_url_dict)
         print "<Omitted>"
 	#print_dict(inconsistent_url_dict)
 	print "\n","="*80,"\n",
 
 	print "Inconsistent Resources:"
-	inconsistent_res_dict = extract_inconsistent_resources(url_hash_dict)
+	inconsistent_res_dict = a.inconsistent_resources
+        sink.write(host, "inconsistent_resources", urls=inconsistent_res_dict)
         print "<Omitted>"
 	#print_dict(inconsistent_res_dict)
 	print "\n","="*80,"\n",
 
         print "Synonym URLs:"
-        synonym_url_dict = synurl.extract_synonym_urls(hash_url_dict)
-        print_dict(synonym_url_dict)
+        synonym_url_dict = a.synonym_sets
+        reducible_syn_dict = a.reducible_sets
+        syn_scores = a.synonym_scores
+        sink.write(host, "synonyms",
+                   sets=[{"hash": h[0], "size": h[1], "score": syn_scores[h],
+                          "urls": synonym_url_dict[h]}
+                         for h in sorted(synonym_url_dict.keys())])
+        if text_dumps:
+                print_dict(synonym_url_dict)
+        else:
+                print "<Omitted>"
         print "\n","="*80
 
         # Interesting, but somewhat unhelpful data structure for sorting URLs
@@ -153,9 +254,13 @@ def process_main(sys_args):
 	#print "\n","="*80,"\n",
 
 	print "Tabulated URLs:"
-	inconsistent_url_tab = urltable.create_sim_url_tab(inconsistent_url_dict.keys(),
-							   sim_thresh)
-	urltable.print_sim_url_tab(inconsistent_url_tab)
+	inconsistent_url_tab = a.similarity_table
+        sink.write(host, "similarity_table",
+                   sets=[urltable.tab_url_record(tab_url) for tab_url in inconsistent_url_tab])
+        if text_dumps:
+                urltable.print_sim_url_tab(inconsistent_url_tab)
+        else:
+                print "<Omitted>"
         print "\n","="*80
 
 
@@ -164,16 +269,29 @@ def process_main(sys_args):
         ### of the original synonym URLs
 
         print "Reduced Synonym URLs:"
-        share_file = "resultstats/temp/synhash"
-        syn_data_file = "resultstats/agg/syndata.txt"
-        syn_fetch_file = "resultstats/agg/synfetchresults.txt"
-        syn_csv_data_file = "resultstats/agg/syndata.csv"
-        syn_csv_fetch_file = "resultstats/agg/synfetchresults.csv"
-        synurl.reduce_synonym_urls(synonym_url_dict, sim_thresh)
-        synurl.print_reduced_urls(synonym_url_dict, False)
-        synurl.write_syn_url_data(host, synonym_url_dict, syn_data_file, syn_csv_data_file, False)
-        synurl.fetch_reduced_urls(host, synonym_url_dict, syn_fetch_file, syn_csv_fetch_file,\
-                                  sanity_retry_count, reduced_retry_count, refetch_all)
+        syn_data_file = outdir+"/agg/syndata.txt"
+        syn_fetch_file = outdir+"/agg/synfetchresults.txt"
+        syn_csv_data_file = outdir+"/agg/syndata.csv"
+        syn_csv_fetch_file = outdir+"/agg/synfetchresults.csv"
+        # Only sets of related URLs are worth reducing and refetching
+        print len(reducible_syn_dict), "of", len(synonym_url_dict), "synonym sets reducible"
+        # The sets with their reductions, as synurl.reduce_synonym_urls leaves
+        # them (built in the synonym sets' order, which the dumps follow)
+        reducible_syn_dict = dict((h, (reducible_syn_dict[h], a.reduced_urls[h]))
+                                  for h in synonym_url_dict if h in reducible_syn_dict)
+        if text_dumps:
+                synurl.print_reduced_urls(reducible_syn_dict, False)
+        else:
+                print "<Omitted>"
+        if not agg_files:
+                syn_data_file = syn_fetch_file = None
+                syn_csv_data_file = syn_csv_fetch_file = None
+        synurl.write_syn_url_data(host, reducible_syn_dict, syn_data_file, syn_csv_data_file, False,
+                                  sink)
+        if fetch_synonyms:
+                synurl.fetch_reduced_urls(host, reducible_syn_dict, syn_fetch_file, syn_csv_fetch_file,\
+                                          sanity_retry_count, reduced_retry_count, refetch_all,
+                                          sink)
 
         ### The following block looks back at the resource lists for each fetch and sorts
         ### every resource into one of the following categories for each fetch:
@@ -183,11 +301,17 @@ def process_main(sys_args):
         ###   - synonym: contents appear multiple times fetches but URL varies
         ###   - Inconsistent: not a synonym URL, doesn't appear in all fetches
 
-        n_succ_trials = n_trials - fail_count
-        stats_by_fetch = categorize_resources_by_fetch(res_lists, url_occ_dict, res_fail_dict, 
-                                                       synonym_url_dict, inconsistent_res_dict, n_succ_trials,
-                                                       True, num_file, size_file)
-        average_resource_stats(stats_by_fetch, n_succ_trials, avg_categories_file, host)
+        n_succ_trials = a.n_succ_trials
+        stats_by_fetch = a.write_categories_by_fetch(num_file, size_file)
+        sink.write(host, "categories_by_fetch", fetches=stats_by_fetch)
+        sink.write(host, "latency", latencies=a.latencies)
+        categories_file = avg_categories_file
+        if not agg_files:
+                categories_file = None
+        avg_stats = average_resource_stats(stats_by_fetch, n_succ_trials, categories_file, host)
+        sink.write(host, "categories", averages=avg_stats)
+        sink.close()
+        records.mark_host_done(outdir, host)
 
 # Maps any resource URL encountered to # of occurrences across all trials
 # To be consistent across all trials, total # of occurrences should be
@@ -231,8 +355,9 @@ def update_url_hashes(url_hash_dict, hash_url_dict, res):
 			new_h_dict[h] = 1
 			url_hash_dict[url] = new_h_dict
 
-                if h in hash_url_dict:
-                        urls = hash_url_dict[h]
+                h_key = (h, sz)
+                if h_key in hash_url_dict:
+                        urls = hash_url_dict[h_key]
                         if url in urls:
                                 urls[url] += 1
                         else:
@@ -240,7 +365,7 @@ def update_url_hashes(url_hash_dict, hash_url_dict, res):
                 else:
                         new_url_dict = {}
                         new_url_dict[url] = 1
-                        hash_url_dict[h] = new_url_dict
+                        hash_url_dict[h_key] = new_url_dict
 	#return url_hash_dict
 
 # Record the number of times a resource fails; this will allow resources to be categorized
@@ -316,7 +441,7 @@ def categorize_resources_by_fetch(res_lists, url_occ_dict, res_fail_dict,
                                 fetch_stats["Failed"]["n"] += 1
 
                         # Synonym
-                        elif r_hash in syn_url_dict:
+                        elif (r_hash, r_sz) in syn_url_dict:
                                 fetch_stats["Synonym"]["n"] += 1
                                 fetch_stats["Synonym"]["b"] += r_sz
 
@@ -353,7 +478,7 @@ def categorize_resources_by_fetch(res_lists, url_occ_dict, res_fail_dict,
 
 
 # Compute the average number of URLs in each category across all trials and write
-# result to an aggregate data file
+# result to an aggregate data file (unless out_file is None)
 def average_resource_stats(stats_by_fetch, n_succ_trials, out_file, host):
         tot_sum = 0
         cons_sum = 0
@@ -415,6 +540,8 @@ def average_resource_stats(stats_by_fetch, n_succ_trials, out_file, host):
                 avg_stats["Failed"]["n"] = float(failed_sum)/n_succ_trials
                 avg_stats["Failed"]["b"] = float(b_failed_sum)/n_succ_trials
 
+        if out_file is None:
+                return avg_stats
         fout = open(out_file, 'a')
         csvwriter = csv.writer(fout)
         csvwriter.writerow([host,
@@ -424,6 +551,7 @@ def average_resource_stats(stats_by_fetch, n_succ_trials, out_file, host):
                             avg_stats["Total"]["b"], avg_stats["Consistent"]["b"],
                             avg_stats["C_Inconsistent"]["b"], avg_stats["Synonym"]["b"],
                             avg_stats["Inconsistent"]["b"], avg_stats["Failed"]["b"]])
+        fout.close()
 
         return avg_stats
 
@@ -454,11 +582,61 @@ def print_dict(d):
 	for k,v in sorted(d.items()):
 		print k, ": ", v
 
+# Moves every output of the pipeline (host records and fetched reduced URLs,
+# agg and temp files) under a different directory than resultstats, which is
+# expected to contain agg/ and temp/ like resultstats does
+def set_outdir(d):
+        global outdir, num_file, size_file, avg_categories_file
+        outdir = d
+        num_file = d+"/temp/resbyfetch.csv"
+        size_file = d+"/temp/sizeresbyfetch.csv"
+        avg_categories_file = d+"/agg/resourcecategorizationdata.csv"
+        synurl.outdir = d
+        synurl.aggdir = d+"/agg"
+
+# Strips leading option flags from the argument list, setting the corresponding
+# module options; returns the remaining arguments in the form process_main expects
+def parse_options(sys_args):
+        global text_dumps, low_memory, fetch_synonyms, agg_files
+        args = [sys_args[0]]
+        rest = sys_args[1:]
+        while len(rest) > 0 and rest[0].startswith('-'):
+                opt = rest.pop(0)
+                if opt == '-notext':
+                        text_dumps = False
+                elif opt == '-lowmem':
+                        low_memory = True
+                elif opt == '-outdir' and len(rest) > 0:
+                        set_outdir(rest.pop(0))
+                elif opt == '-nofetch':
+                        fetch_synonyms = False
+                elif opt == '-noagg':
+                        agg_files = False
+                elif opt == '-http':
+                        synurl.verify_engine = "http"
+                elif opt == '-proxy' and len(rest) > 0:
+                        synurl.set_proxy(rest.pop(0))
+                elif opt == '-host-fetches' and len(rest) > 0:
+                        synurl.host_fetch_budget = int(rest.pop(0))
+                elif opt == '-host-secs' and len(rest) > 0:
+                        synurl.host_time_budget = float(rest.pop(0))
+                elif opt == '-fetches' and len(rest) > 0:
+                        synurl.global_fetch_budget = int(rest.pop(0))
+                elif opt == '-secs' and len(rest) > 0:
+                        synurl.global_time_budget = float(rest.pop(0))
+                else:
+                        print 'Unknown option', opt
+                        exit()
+        return args + rest
+
 def main():
 	if len(sys.argv) < 2:
-		print 'Usage: python process.py dir'
+		print 'Usage: python process.py [-notext] [-lowmem] [-nofetch] [-noagg] [-http] [-proxy host:port]'
+		print '                         [-outdir dir]'
+		print '                         [-host-fetches n] [-host-secs s] [-fetches n] [-secs s]'
+		print '                         refetch results.json...'
 		exit()
-	sys_args = sys.argv
+	sys_args = parse_options(sys.argv)
 
 	process_main(sys_args)
 
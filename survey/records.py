@@ -0,0 +1,121 @@
+"""
+  Structured output for the processing pipeline.
+
+  Everything process.py learns about a host used to be printed into
+  <host>-detailed.txt or appended as hand-assembled CSV rows, which then had
+  to be parsed back for the reports. Instead, each stage of the pipeline emits
+  a record: one JSON object per line of the form
+
+      {"host": <host>, "stage": <stage name>, <stage-specific fields>...}
+
+  Records for a host are written to resultstats/<host>/<host>-records.jsonl
+  through a single buffered RecordWriter, so downstream tools can read typed
+  data back with read_records instead of scraping text. The stages written by
+  process.py are:
+
+      summary                 n_trials, fails, jaccard_urls, jaccard_hashes
+      inconsistent_urls       urls: {url: occurrences}
+      inconsistent_resources  urls: {url: {hash: occurrences}}
+      synonyms                sets: [{hash, urls: {url: occurrences}}]
+      similarity_table        sets: [{template, urls, variations: {seg #: [...]},
+                                      top: {seg #: [[variation, count]...]},
+                                      distinct: {seg #: estimate}}]
+      syndata                 syn_url_sets, reduced_urls (as syndata.csv)
+      reduced                 sets: [{hash, reduced: [url...]}]
+      verification            sets: [{hash, payoff, syn_urls, reduced: {url: [success, match]}}]
+      skipped                 sets: [{hash, size, payoff, reduced, reason}]
+                              (sets left unverified by the refetch budget)
+      synfetch                fails, untested, succs_no_match, succs_w_match
+                              (as synfetchresults.csv), skipped, fetches,
+                              seconds
+      categories_by_fetch     fetches: [{category: {n, b}}] (as resbyfetch.csv)
+      latency                 latencies: [ms] (page load time of each
+                              successful fetch, in the order of fetches above)
+      categories              averages: {category: {n, b}}
+                              (as resourcecategorizationdata.csv)
+
+  A new records file is written under a temporary name and only renamed into
+  place by close(), so a host's records are either complete or absent. Once
+  process.py has finished a host it leaves a <host>.done marker next to them
+  (mark_host_done); dprocess.sh skips hosts that have one.
+"""
+
+import json
+import os
+
+
+records_suffix = "-records.jsonl"
+done_suffix = ".done"
+buffer_size = 1 << 16
+
+
+class RecordWriter(object):
+
+    # In mode 'w' records go to path.tmp until close(); appending ('a') writes
+    # to path directly
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self.write_path = path
+        if mode == 'w':
+            self.write_path = path + ".tmp"
+        self.f = open(self.write_path, mode, buffer_size)
+
+    def write(self, host, stage, **fields):
+        fields["host"] = host
+        fields["stage"] = stage
+        self.f.write(json.dumps(fields, separators=(',', ':')))
+        self.f.write("\n")
+
+    def close(self):
+        self.f.close()
+        if self.write_path != self.path:
+            os.rename(self.write_path, self.path)
+
+
+# Path of the records file for a host under the given output directory
+def host_records_path(outdir, host):
+    return os.path.join(outdir, host, host + records_suffix)
+
+
+# Opens the record writer for a host, creating its output directory if needed
+def open_host_sink(outdir, host):
+    host_dir = os.path.join(outdir, host)
+    if not os.path.isdir(host_dir):
+        os.makedirs(host_dir)
+    return RecordWriter(host_records_path(outdir, host))
+
+
+def host_done_path(outdir, host):
+    return os.path.join(outdir, host, host + done_suffix)
+
+
+def host_done(outdir, host):
+    return os.path.exists(host_done_path(outdir, host))
+
+
+# Marks a host as completely processed
+def mark_host_done(outdir, host):
+    path = host_done_path(outdir, host)
+    with open(path + ".tmp", 'w') as f:
+        f.write(host_records_path(outdir, host) + "\n")
+    os.rename(path + ".tmp", path)
+
+
+# Generates the records in a file, optionally only those of the given stage
+def read_records(path, stage=None):
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if stage is None or record["stage"] == stage:
+                yield record
+
+
+# Returns {stage: record} for a host's records file; if a stage was written
+# more than once the last record wins
+def load_host_records(path):
+    stages = {}
+    for record in read_records(path):
+        stages[record["stage"]] = record
+    return stages
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+  Offline replay of a recorded survey.
+
+  Verifying reduced URLs against the live web gives different answers from
+  one run to the next (the sanity test failures in the README), so fetch
+  engines and scheduling can't be compared or load-tested reliably. This
+  serves a survey's recorded results back as an HTTP forward proxy: it
+  indexes every resource URL of results/*/*/results.json with the (hash,
+  size) it was loaded with, and answers a request for it with
+
+      the stored rendered page (pages/ or the page store, see pagestore.py)
+      for a site's top-level URL (with and without www.) and the first
+      resource of a fetch, its document unless that was a redirect, and
+      otherwise a placeholder body of the recorded size,
+
+  with the recorded hash (tagged with its algorithm, see hashalg.py) in an
+  X-Replay-Hash header. fetchsyn.js, survey.js and httpverify.py take that
+  header as the body's hash when they fetch through a proxy (and ignore it
+  otherwise, since a live server could send it), so verification through
+  the replay sees the recorded contents. A URL loaded with several
+  contents is served with its most frequent one, or with the one of fetch n
+  with -fetch n.
+
+  URLs are matched without their scheme: httpverify.py sends https URLs to
+  the proxy as absolute http requests. slimerjs, though, tunnels https
+  through CONNECT, which would take intercepting TLS with a certificate the
+  browser trusts; CONNECT is refused (501, counted as "connect" in the
+  stats), so through the browser https resources, about 5.5% of the loads
+  on the alexa sample, aren't replayed and fail.
+
+  A URL that wasn't recorded is a 404. With -lenient it is matched instead
+  like a server ignoring what a reduced URL left out: to the recorded URL of
+  the same site that contains all of its segments (urltable.split_url) in
+  order, with the fewest other segments, then the most loads. Every reduced
+  URL is such a subsequence of a URL of its synonym set, so with -lenient
+  every reduction verifies: it is for load testing the fetchers, not for
+  testing verification outcomes.
+
+  -latency and -jitter delay every response (in ms), and -fail and -reset
+  answer that fraction of requests with a 503 or a dropped connection. Both
+  are drawn from a hash of the seed, the URL and how often it has been
+  requested since the server started, so a run against a fresh server is
+  repeatable whatever the order of concurrent requests. GET /__replay/stats
+  returns the counts of hits, lenient hits, misses, refused CONNECTs and
+  injected failures as JSON.
+
+  Usage: python replay.py [-results dir] [-store dir] [-port 8080] [-lenient] [-fetch n]
+                          [-latency ms] [-jitter ms] [-fail rate] [-reset rate] [-seed s]
+
+  Point the fetchers at it with process.py -proxy 127.0.0.1:8080 (slimerjs
+  and httpverify.py) and SURVEY_PROXY=127.0.0.1:8080 ./map.sh ...
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import glob
+import hashlib
+import json
+import mimetypes
+import os
+import SocketServer
+import threading
+import time
+import urlparse
+
+import hashalg
+import pagestore
+import urltable
+
+
+stats_path = "/__replay/stats"
+
+
+# Scheme-less form of a URL that recorded and requested URLs are matched on
+def url_key(url):
+    parsed = urlparse.urlparse(url)
+    key = parsed.netloc.lower() + (parsed.path or "/")
+    if parsed.params:
+        key += ";" + parsed.params
+    if parsed.query:
+        key += "?" + parsed.query
+    return key
+
+
+# Sites are bucketed by the last two labels of the netloc for lenient matching
+def site_of(key):
+    netloc = key.split('/', 1)[0].split(':')[0]
+    return ".".join(netloc.split('.')[-2:])
+
+
+def segments(key):
+    return [(txt, ty) for (n, txt, ty) in urltable.split_url("http://" + key)[1:]]
+
+
+def is_subsequence(short, full):
+    it = iter(full)
+    return all(seg in it for seg in short)
+
+
+class ReplayIndex(object):
+
+    def __init__(self, results_dir, store_dir, fetch=None):
+        self.results_dir = results_dir
+        self.store_dir = store_dir
+        # url key -> {"contents": Counter of (hash, size), "by_fetch": {n: (hash, size)},
+        #             "page": page hash or None}
+        self.urls = {}
+        self.sites = collections.defaultdict(list)
+        self.page_paths = {}
+        self.fetch = fetch
+        self._lenient = {}
+
+    def _entry(self, key):
+        if key not in self.urls:
+            self.urls[key] = {"contents": collections.Counter(), "by_fetch": {}, "page": None}
+            self.sites[site_of(key)].append(key)
+        return self.urls[key]
+
+    def build(self):
+        for target in glob.glob(os.path.join(self.results_dir, "*", "*", "results.json")):
+            fetch = int(os.path.basename(os.path.dirname(target)))
+            with open(target) as f:
+                results = hashalg.tag_results(json.load(f))
+            if results['status'] != 'success':
+                continue
+            page = results.get('page') or {}
+            page_hash = page.get('hash')
+            if page_hash is not None:
+                path = os.path.join(os.path.dirname(target), "pages", page_hash + ".html")
+                if os.path.exists(path):
+                    self.page_paths[page_hash] = path
+                for site_url in (results['url'], "www." + results['url']):
+                    self._entry(url_key("http://" + site_url + "/"))["page"] = page_hash
+            for i, r in enumerate(results['resources']):
+                entry = self._entry(url_key(r['url']))
+                entry["contents"][(r['hash'], r['size'])] += 1
+                entry["by_fetch"][fetch] = (r['hash'], r['size'])
+                if i == 0 and r['size'] > 0:
+                    entry["page"] = page_hash
+        return len(self.urls)
+
+    # (hash, size) to serve for a url key
+    def content(self, key):
+        entry = self.urls[key]
+        if self.fetch is not None and self.fetch in entry["by_fetch"]:
+            return entry["by_fetch"][self.fetch]
+        return min(entry["contents"].items(), key=lambda (c, n): (-n, c))[0]
+
+    def lenient(self, key):
+        if key not in self._lenient:
+            segs = segments(key)
+            best = None
+            for cand in self.sites.get(site_of(key), []):
+                cand_segs = segments(cand)
+                if len(cand_segs) < len(segs) or not is_subsequence(segs, cand_segs):
+                    continue
+                rank = (len(cand_segs) - len(segs), -sum(self.urls[cand]["contents"].values()),
+                        cand)
+                if best is None or rank < best[0]:
+                    best = (rank, cand)
+            self._lenient[key] = best[1] if best is not None else None
+        return self._lenient[key]
+
+    def page_body(self, page_hash):
+        if page_hash in self.page_paths:
+            with open(self.page_paths[page_hash], 'rb') as f:
+                return f.read()
+        try:
+            return pagestore.open_page(page_hash, self.store_dir)
+        except (IOError, KeyError):
+            return None
+
+
+# Deterministic bytes of the given size standing in for an unrecorded body
+def placeholder(h, size):
+    unit = "replay " + h + "\n"
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+# Number in [0, 1) drawn from the seed and the given values
+def draw(seed, *values):
+    digest = hashlib.sha1(" ".join(str(v) for v in (seed,) + values)).hexdigest()
+    return int(digest[:13], 16) / float(1 << 52)
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    index = None
+    options = None
+    lock = threading.Lock()
+    stats = collections.Counter()
+    requests_per_url = collections.Counter()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _send(self, code, body, headers=()):
+        self.send_response(code)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == stats_path:
+            with self.lock:
+                body = json.dumps(dict(self.stats))
+            self._send(200, body, [("Content-Type", "application/json")])
+            return
+        url = self.path
+        if not urlparse.urlparse(url).scheme:
+            url = "http://" + self.headers.get("host", "") + self.path
+        key = url_key(url)
+        opts = self.options
+        with self.lock:
+            self.requests_per_url[key] += 1
+            nth = self.requests_per_url[key]
+            self.stats["requests"] += 1
+        delay = opts.latency + opts.jitter * draw(opts.seed, "latency", key, nth)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        r = draw(opts.seed, "fail", key, nth)
+        if r < opts.fail:
+            self._count("failed")
+            self._send(503, "replay: injected failure\n", [("Content-Type", "text/plain")])
+            return
+        if r < opts.fail + opts.reset:
+            self._count("reset")
+            self.close_connection = 1
+            return
+
+        match = key
+        if key not in self.index.urls:
+            match = None
+            if opts.lenient:
+                with self.lock:
+                    match = self.index.lenient(key)
+            if match is None:
+                self._count("misses")
+                self._send(404, "replay: not recorded\n", [("Content-Type", "text/plain")])
+                return
+            self._count("lenient")
+        else:
+            self._count("hits")
+        (h, size) = self.index.content(match)
+        page_hash = self.index.urls[match]["page"]
+        body = None
+        content_type = None
+        if page_hash is not None:
+            body = self.index.page_body(page_hash)
+            content_type = "text/html; charset=utf-8"
+        if body is None:
+            body = placeholder(h, size)
+            content_type = mimetypes.guess_type(urlparse.urlparse(url).path)[0] or \
+                "application/octet-stream"
+        self._send(200, body, [("Content-Type", content_type), ("X-Replay-Hash", h),
+                               ("X-Replay-Url", match.encode('utf-8'))])
+
+    do_HEAD = do_GET
+
+    # https through the browser would need TLS interception; see above
+    def do_CONNECT(self):
+        self._count("connect")
+        self.close_connection = 1
+        self._send(501, "replay: https tunnels (CONNECT) aren't replayed\n",
+                   [("Content-Type", "text/plain")])
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a recorded survey over HTTP")
+    parser.add_argument("-results", default="results")
+    parser.add_argument("-store", default=pagestore.store_dir)
+    parser.add_argument("-port", type=int, default=8080)
+    parser.add_argument("-lenient", action="store_true",
+                        help="serve unrecorded URLs with the closest recorded one")
+    parser.add_argument("-fetch", type=int, default=None,
+                        help="serve the contents of this fetch where recorded")
+    parser.add_argument("-latency", type=float, default=0.0, help="ms added to every response")
+    parser.add_argument("-jitter", type=float, default=0.0, help="up to this many more ms")
+    parser.add_argument("-fail", type=float, default=0.0, help="fraction answered with 503")
+    parser.add_argument("-reset", type=float, default=0.0,
+                        help="fraction answered by closing the connection")
+    parser.add_argument("-seed", default="0")
+    opts = parser.parse_args()
+
+    start = time.time()
+    index = ReplayIndex(opts.results, opts.store, opts.fetch)
+    n = index.build()
+    print "Indexed", n, "urls in %.1fs" % (time.time() - start)
+    ReplayHandler.index = index
+    ReplayHandler.options = opts
+    server = ReplayServer(("127.0.0.1", opts.port), ReplayHandler)
+    print "Replaying", opts.results, "on port", opts.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
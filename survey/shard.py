@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+  Sharded processing across machines sharing a directory.
+
+  dprocess.sh processes every host into resultstats/, and process.py appends
+  each host's row to the agg files (resourcecategorizationdata.csv,
+  syndata.csv, synfetchresults.csv and the .txt versions), so two runs can't
+  safely share them. Instead, "run k/n" processes only the hosts whose name
+  hashes to k modulo n (crc32, so every machine agrees) into its own shard
+  directory, shards/<k>-of-<n>/, laid out like resultstats/ (per-host
+  directories with the records and detailed text, and agg/ and temp/). Its
+  shard.json describes the shard:
+
+      shard, shards   k and n
+      hosts           the hosts assigned to the shard
+      done            the hosts processed so far
+      options         the options process.py was run with
+      complete        true once every assigned host has been processed
+
+  Rerunning an interrupted shard skips the hosts it already finished (see
+  records.mark_host_done).
+
+  "merge" takes any number of shard directories (by default every shards/*),
+  checks that they belong to the same partition, copies their host
+  directories into resultstats/, and regenerates the agg files from the
+  host records (aggregate.rebuild_agg_files), followed by aggregate.py's
+  summary. Hosts missing from every shard
+  are reported.
+
+  Usage:
+      python shard.py run k/n [-shards dir] [-results dir] [-refetch] [-notext] [-lowmem] [-nofetch] [-http]
+                              [-host-fetches n] [-host-secs s] [-fetches n] [-secs s] [-proxy host:port]
+      python shard.py merge [-out resultstats] [-procs n] [shard dir ...]
+"""
+
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import zlib
+
+import aggregate
+import records
+
+
+shards_dir = "shards"
+manifest_name = "shard.json"
+
+def shard_of(host, n_shards):
+    return (zlib.crc32(host) & 0xffffffff) % n_shards
+
+
+def shard_name(k, n_shards):
+    return "%d-of-%d" % (k, n_shards)
+
+
+def read_manifest(shard_dir):
+    with open(os.path.join(shard_dir, manifest_name)) as f:
+        return json.load(f)
+
+
+def write_manifest(shard_dir, manifest):
+    path = os.path.join(shard_dir, manifest_name)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+# Processes the shard's hosts with process.py -noagg, skipping hosts already
+# marked done by an earlier, interrupted run of the same shard, then rebuilds
+# the shard's agg files from its host records
+def run_shard(k, n_shards, top, results_dir, refetch, options):
+    shard_dir = os.path.join(top, shard_name(k, n_shards))
+    hosts = [h for h in sorted(os.listdir(results_dir)) if shard_of(h, n_shards) == k]
+    for d in ["agg", "temp"]:
+        if not os.path.isdir(os.path.join(shard_dir, d)):
+            os.makedirs(os.path.join(shard_dir, d))
+    manifest = {"shard": k, "shards": n_shards, "hosts": hosts, "done": [],
+                "options": options, "complete": False}
+    manifest["done"] = [h for h in hosts if records.host_done(shard_dir, h)]
+    if len(manifest["done"]) > 0:
+        print "Resuming shard", shard_name(k, n_shards) + ":", len(manifest["done"]),\
+            "hosts already done"
+    write_manifest(shard_dir, manifest)
+
+    process_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "process.py")
+    for host in hosts:
+        if host in manifest["done"]:
+            continue
+        targets = sorted(glob.glob(os.path.join(results_dir, host, "*", "results.json")))
+        if len(targets) == 0:
+            continue
+        site_dir = os.path.join(shard_dir, host)
+        if not os.path.isdir(os.path.join(site_dir, "fetched")):
+            os.makedirs(os.path.join(site_dir, "fetched"))
+        print "processing", host, "..."
+        detailed = os.path.join(site_dir, host + "-detailed.txt")
+        with open(detailed + ".tmp", 'w') as out:
+            subprocess.call([sys.executable, process_py] + options +
+                            ["-noagg", "-outdir", shard_dir, str(refetch)] + targets,
+                            stdout=out)
+        if not records.host_done(shard_dir, host):
+            print "warning: processing", host, "failed"
+            continue
+        os.rename(detailed + ".tmp", detailed)
+        manifest["done"].append(host)
+        write_manifest(shard_dir, manifest)
+    aggregate.rebuild_agg_files(shard_dir, manifest["done"])
+    manifest["complete"] = len(manifest["done"]) == len(hosts)
+    write_manifest(shard_dir, manifest)
+    print "Shard", shard_name(k, n_shards), "processed", len(manifest["done"]), "of",\
+        len(hosts), "hosts"
+
+
+# Checks that the shards belong to one partition; returns the manifests
+def check_shards(shard_dirs):
+    manifests = [read_manifest(d) for d in shard_dirs]
+    n_values = set(m["shards"] for m in manifests)
+    if len(n_values) != 1:
+        print "error: shards from different partitions:", sorted(n_values)
+        exit(1)
+    n_shards = n_values.pop()
+    seen = {}
+    for d, m in zip(shard_dirs, manifests):
+        if m["shard"] in seen:
+            print "error: shard", m["shard"], "found twice:", seen[m["shard"]], d
+            exit(1)
+        seen[m["shard"]] = d
+        if not m["complete"]:
+            print "warning: shard", d, "is incomplete;", len(m["done"]), "of",\
+                len(m["hosts"]), "hosts processed"
+    missing = [k for k in xrange(n_shards) if k not in seen]
+    if len(missing) > 0:
+        print "warning: missing shards", missing, "of", n_shards
+    return manifests
+
+
+def merge(shard_dirs, out, procs):
+    manifests = check_shards(shard_dirs)
+    agg_dir = os.path.join(out, "agg")
+    if not os.path.isdir(agg_dir):
+        os.makedirs(agg_dir)
+
+    host_dirs = {}
+    assigned = set()
+    for d, m in zip(shard_dirs, manifests):
+        assigned.update(m["hosts"])
+        for host in m["done"]:
+            host_dirs[host] = os.path.join(d, host)
+    for host in sorted(host_dirs):
+        dest = os.path.join(out, host)
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(host_dirs[host], dest)
+
+    aggregate.rebuild_agg_files(out, sorted(host_dirs))
+
+    not_done = sorted(assigned - set(host_dirs))
+    print "Merged", len(host_dirs), "hosts from", len(shard_dirs), "shards into", out
+    if len(not_done) > 0:
+        print "warning:", len(not_done), "assigned hosts not processed:", " ".join(not_done)
+    aggregate.processResults(out, procs)
+
+
+def usage():
+    print "Usage: python shard.py run k/n [-shards dir] [-results dir] [-refetch] [-notext] [-lowmem] [-nofetch] [-http]"
+    print "                               [-host-fetches n] [-host-secs s] [-fetches n] [-secs s] [-proxy host:port]"
+    print "       python shard.py merge [-out resultstats] [-procs n] [shard dir ...]"
+    exit()
+
+
+def run_main(args):
+    try:
+        (k, n_shards) = [int(x) for x in args.pop(0).split('/')]
+    except ValueError:
+        usage()
+    if not 0 <= k < n_shards:
+        usage()
+    top = shards_dir
+    results_dir = "results"
+    refetch = 0
+    options = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '-shards' and len(args) > 0:
+            top = args.pop(0)
+        elif arg == '-results' and len(args) > 0:
+            results_dir = args.pop(0)
+        elif arg == '-refetch':
+            refetch = 1
+        elif arg in ('-notext', '-lowmem', '-nofetch', '-http'):
+            options.append(arg)
+        elif arg in ('-host-fetches', '-host-secs', '-fetches', '-secs', '-proxy') and \
+             len(args) > 0:
+            options.extend([arg, args.pop(0)])
+        else:
+            usage()
+    run_shard(k, n_shards, top, results_dir, refetch, options)
+
+
+def merge_main(args):
+    out = "resultstats"
+    procs = multiprocessing.cpu_count()
+    dirs = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '-out' and len(args) > 0:
+            out = args.pop(0)
+        elif arg == '-procs' and len(args) > 0:
+            procs = int(args.pop(0))
+        elif arg.startswith('-'):
+            usage()
+        else:
+            dirs.append(arg)
+    if len(dirs) == 0:
+        dirs = sorted(os.path.dirname(p) for p in
+                      glob.glob(os.path.join(shards_dir, "*", manifest_name)))
+    if len(dirs) == 0:
+        print "No shards to merge"
+        return
+    merge(dirs, out, procs)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("run", "merge") or \
+       (sys.argv[1] == "run" and len(sys.argv) < 3):
+        usage()
+    if sys.argv[1] == "run":
+        run_main(sys.argv[2:])
+    else:
+        merge_main(sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
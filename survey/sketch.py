@@ -0,0 +1,152 @@
+"""
+  Data structures used to keep memory bounded when processing large surveys;
+  all but FetchOccurrences are probabilistic.
+
+  FetchOccurrences answers the question process.py keeps asking, "does this
+  URL appear in all N fetches?", without a count for every URL: fetches are
+  added one at a time, and a URL that has been in every fetch so far is
+  exactly one of the latest fetch's URLs that isn't a candidate. Only the
+  candidates, URLs missing from some fetch, get exact occurrence counts, so
+  what is kept is one fetch's URLs plus the candidates however many fetches
+  there are, and the answers are exact. It can stand in for url_occ_dict in
+  extract_inconsistent_urls and categorize_resources_by_fetch, whose keys()
+  are then the (inconsistent) candidates only.
+
+  HyperLogLog estimates the number of distinct strings added to it in a fixed
+  2^precision bytes, with a relative error of about 1.04/sqrt(2^precision);
+  small counts fall back to linear counting and are close to exact.
+
+  CountMinSketch estimates how many times each string was added in a fixed
+  width x depth table of counters. Estimates never undercount; they overcount
+  by at most 2/width of the total count with probability 1 - (1/2)^depth.
+"""
+
+import array
+import hashlib
+import math
+import struct
+
+
+class FetchOccurrences(object):
+
+    def __init__(self):
+        self.n_fetches = 0
+        # Occurrences of the candidate URLs, those missing from some fetch
+        self.exact = {}
+        # URLs of the latest fetch
+        self.last = set()
+
+    # Add the set of URLs seen in one successful fetch
+    def add_fetch(self, urls):
+        urls = set(urls)
+        for url in self.last:
+            if url not in urls and url not in self.exact:
+                self.exact[url] = self.n_fetches
+        for url in urls:
+            if url in self.exact:
+                self.exact[url] += 1
+            elif url not in self.last and self.n_fetches > 0:
+                self.exact[url] = 1
+        self.last = urls
+        self.n_fetches += 1
+
+    def __getitem__(self, url):
+        return self.exact.get(url, self.n_fetches)
+
+    def __contains__(self, url):
+        return url in self.exact or url in self.last
+
+    def __len__(self):
+        return len(self.exact) + len(self.last) - sum(1 for url in self.last
+                                                      if url in self.exact)
+
+    # URLs of every fetch
+    def n_in_all(self):
+        return len(self) - len(self.exact)
+
+    def keys(self):
+        return self.exact.keys()
+
+
+def hash64(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('<Q', hashlib.sha1(key).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+
+    def __init__(self, precision=8):
+        self.precision = precision
+        self.n_registers = 1 << precision
+        self.registers = bytearray(self.n_registers)
+        if self.n_registers >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / self.n_registers)
+        elif self.n_registers == 64:
+            self.alpha = 0.709
+        elif self.n_registers == 32:
+            self.alpha = 0.697
+        else:
+            self.alpha = 0.673
+
+    def add(self, key):
+        h = hash64(key)
+        index = h & (self.n_registers - 1)
+        rest = h >> self.precision
+        # Rank of the first set bit in the remaining 64 - precision bits
+        rank = 1
+        max_rank = 64 - self.precision + 1
+        while rank < max_rank and not (rest & 1):
+            rest >>= 1
+            rank += 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        assert self.precision == other.precision
+        for i in xrange(self.n_registers):
+            if other.registers[i] > self.registers[i]:
+                self.registers[i] = other.registers[i]
+
+    def count(self):
+        m = self.n_registers
+        estimate = self.alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b"\x00")
+        if estimate <= 2.5 * m and zeros > 0:
+            return m * math.log(float(m) / zeros)
+        return estimate
+
+    def size_bytes(self):
+        return len(self.registers)
+
+
+class CountMinSketch(object):
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.rows = [array.array('I', [0]) * width for i in xrange(depth)]
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.sha1(key).digest()[:16])
+        for i in xrange(self.depth):
+            yield (h1 + i * h2) % self.width
+
+    # Returns the key's estimated count after adding
+    def add(self, key, count=1):
+        self.total += count
+        estimate = None
+        for row, pos in zip(self.rows, self._positions(key)):
+            row[pos] += count
+            if estimate is None or row[pos] < estimate:
+                estimate = row[pos]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[pos] for row, pos in zip(self.rows, self._positions(key)))
+
+    def size_bytes(self):
+        return sum(row.itemsize * len(row) for row in self.rows)
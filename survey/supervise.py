@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+  Watchdog for browser launches.
+
+  survey.js and fetchsyn.js give up on a page after 30 seconds, but only if
+  the browser itself is still responsive; a hung slimerjs used to block
+  synurl.fetch_and_compare (and map.sh's wait) forever. run() starts a
+  command in its own process group with an address-space limit, and if it
+  hasn't exited after a hard wall-clock timeout kills the whole group (the
+  browser and anything it spawned): SIGTERM first, SIGKILL after
+  kill_grace seconds.
+
+  Every timeout is appended as a JSON line to a log file:
+
+      {"time", "label" (usually the URL), "cmd", "timeout", "elapsed"}
+
+  Used as a command it wraps any command line and exits with the command's
+  status, or 124 if it timed out (like coreutils timeout):
+
+      python supervise.py [-timeout s] [-mem mb] [-log file] [-label name] -- cmd ...
+      python supervise.py -report [log file]
+"""
+
+import argparse
+import collections
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+
+timeout_secs = 90
+mem_limit_mb = 4096
+kill_grace = 5
+poll_interval = 0.1
+log_file = "timeouts.jsonl"
+timeout_status = 124
+
+
+def _limit_child(mem_limit_mb):
+    def preexec():
+        os.setsid()
+        if mem_limit_mb:
+            limit = mem_limit_mb << 20
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    return preexec
+
+
+def kill_group(proc):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            return
+        deadline = time.time() + kill_grace
+        while time.time() < deadline:
+            if proc.poll() is not None:
+                return
+            time.sleep(poll_interval)
+
+
+def log_timeout(log, label, cmd, timeout, elapsed):
+    if log is None:
+        return
+    entry = {"time": time.time(), "label": label, "cmd": cmd,
+             "timeout": timeout, "elapsed": round(elapsed, 1)}
+    with open(log, 'a') as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+# Runs cmd (a list) with a wall-clock timeout and memory limit (in MB, 0 for
+# none); returns (exit status, timed out). stdout is passed on to
+# subprocess.Popen
+def run(cmd, timeout=None, mem_limit=None, stdout=None, log=None, label=None):
+    if timeout is None:
+        timeout = timeout_secs
+    if mem_limit is None:
+        mem_limit = mem_limit_mb
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=stdout, preexec_fn=_limit_child(mem_limit))
+    while proc.poll() is None:
+        if time.time() - start > timeout:
+            kill_group(proc)
+            log_timeout(log, label, cmd, timeout, time.time() - start)
+            return (timeout_status, True)
+        time.sleep(poll_interval)
+    return (proc.returncode, False)
+
+
+# Timeouts per label in a log, most frequent first
+def timeout_counts(log):
+    counts = collections.Counter()
+    with open(log) as f:
+        for line in f:
+            if line.strip():
+                counts[json.loads(line)["label"]] += 1
+    return counts.most_common()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run a command under a watchdog")
+    parser.add_argument("-timeout", type=float, default=timeout_secs)
+    parser.add_argument("-mem", type=int, default=mem_limit_mb,
+                        help="address space limit in MB, 0 for none")
+    parser.add_argument("-log", default=log_file)
+    parser.add_argument("-label", default=None)
+    parser.add_argument("-report", action="store_true",
+                        help="print the timeouts in the log per label")
+    parser.add_argument("cmd", nargs=argparse.REMAINDER)
+    opts = parser.parse_args()
+    cmd = opts.cmd
+    if len(cmd) > 0 and cmd[0] == '--':
+        cmd = cmd[1:]
+
+    if opts.report:
+        log = opts.log
+        if len(cmd) > 0:
+            log = cmd[0]
+        for label, n in timeout_counts(log):
+            print "%5d %s" % (n, label)
+        return
+    if len(cmd) == 0:
+        parser.error("no command given")
+    label = opts.label
+    if label is None:
+        label = " ".join(cmd)
+    (status, timed_out) = run(cmd, opts.timeout, opts.mem, None, opts.log, label)
+    if timed_out:
+        sys.stderr.write("supervise: %s timed out after %gs\n" % (label, opts.timeout))
+    elif status < 0:
+        # Killed by a signal, reported like the shell does
+        status = 128 - status
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
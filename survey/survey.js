@@ -5,15 +5,18 @@
  *     "url": url,
  *     "status": "success"/"fail",
  *     "page": {
- *        "hash": <sha-1>
+ *        "hash": <hash>
  *     },
- *     "resources": [{"url": url, "hash": <sha-1>}]
+ *     "resources": [{"url": url, "hash": <hash>}],
+ *     "hash_alg": <alg>
  *   }
+ * where <alg> is the hash algorithm given after the other arguments, sha1
+ * (CryptoJS, the default) or murmur3 (murmur3.js, much faster on large
+ * bodies); see hashalg.py.
  * The script optionally writes the final rendered
  * HTML to <output>/<page.hash>.html.
  *
  * XXX configurable output directory
- * XXX support pluggable hash functions
  */
 
 function Page(hash, latency) {
@@ -39,22 +42,53 @@ function sha1(data) {
 	return hash.toString(CryptoJS.enc.hex);
 }
 
+// Hash algorithm -> [script to inject, function]
+const HASHES = {
+	'sha1': ['cryptojs/sha1.js', function(data) { return sha1(data); }],
+	'murmur3': ['murmur3.js', function(data) { return murmur3(data); }]
+};
+
+// A replay server (replay.py) serves placeholder bodies with the recorded
+// hash in a header, tagged with its algorithm unless it is SHA-1; a bare one
+// is marked as SHA-1 when hashing with another algorithm. Only trusted with
+// -replay, since any live server could send it
+function replayHash(response) {
+	for (var i = 0; i < response.headers.length; i++) {
+		if (response.headers[i].name.toLowerCase() === 'x-replay-hash') {
+			var hash = response.headers[i].value;
+			if (hashAlg !== 'sha1' && hash.indexOf(':') < 0)
+				hash = 'sha1:' + hash;
+			return hash;
+		}
+	}
+	return null;
+}
+
 // if we want to write the rendered page out for inpection later
 const WRITE_FS = true;
 if (WRITE_FS)
 	var fs = require('fs');
 
 var system = require('system');
-if(system.args.length < 2) {
-	console.log('Usage: slimerjs survey.js url');
+// -replay, given when fetching through replay.py, may come anywhere
+var args = system.args.filter(function(arg) { return arg !== '-replay'; });
+var replay = args.length < system.args.length;
+if(args.length < 2) {
+	console.log('Usage: slimerjs survey.js url [sha1|murmur3] [-replay]');
 	slimer.exit(1);
 } else {
-	var url = system.args[1];
-	if(!phantom.injectJs('cryptojs/sha1.js')) {
-		console.log('Unable to inject CryptoJS');
+	var url = args[1];
+	var hashAlg = args.length > 2 ? args[2] : 'sha1';
+	if(!(hashAlg in HASHES)) {
+		console.log('Unknown hash algorithm ' + hashAlg);
+		slimer.exit(1);
+	} else if(!phantom.injectJs(HASHES[hashAlg][0])) {
+		console.log('Unable to inject ' + HASHES[hashAlg][0]);
 		slimer.exit(1);
 	} else {
+		var hashBody = HASHES[hashAlg][1];
 		var result = new Result(url);
+		result.hash_alg = hashAlg;
 		var page = require('webpage').create();
 		page.captureContent = [ /.*/ ]; // everything
 		page.onError = function(message, stack) {};
@@ -62,7 +96,7 @@ if(system.args.length < 2) {
 			// XXX handle chunked responses
 			if(response.stage === 'end') {
 				var url = response.url;
-				var hash = sha1(response.body);
+				var hash = (replay && replayHash(response)) || hashBody(response.body);
 				var size = response.bodySize;
 				resource = new Resource(url, hash, size);
 				result.resources.push(resource);
@@ -81,7 +115,7 @@ if(system.args.length < 2) {
 			if(status !== 'success') {
 				fail();
 			} else {
-				var hash = sha1(page.content);
+				var hash = hashBody(page.content);
 				var endTime = new Date();
 				var latency = endTime - startTime;
 				result.page = new Page(hash, latency);
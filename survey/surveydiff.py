@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+  Diff of two survey runs.
+
+  Compares two runs host by host and reports what changed in each host's
+  resource categories, synonym sets, reduced URLs and verification outcomes,
+  instead of comparing the agg dumps (archive/sd_*.txt, sf_*.txt) by eye.
+  A run is any of
+
+      a resultstats directory   the per-host records (records.py); only the
+                                lines of the stages compared are parsed
+      a results directory       the raw fetches, analyzed per host with
+                                analysis.HostAnalysis (no verification), plus
+                                which URLs appeared, disappeared or changed
+                                contents
+      an agg file               syndata/synfetchresults text dumps (as in
+                                archive/) or agg csv files: their counts
+
+  and both runs must be of the same kind. Hosts, and within a host the
+  synonym sets (by hash and size), reduced URLs, verified URLs and resource
+  URLs, are matched by merge joins of the two runs' sorted lists, so a run
+  is read in one pass and hosts only present in one run are reported as such.
+
+  Verification outcomes are those of synurl.fetch_and_compare: match, no
+  match, failed or untested (sanity fail).
+
+  Only changed hosts are printed (-v lists the sets and URLs too), and with
+  -out every change is written as a (host, item, a, b) row.
+
+  Usage: python surveydiff.py <run a> <run b> [-v] [-out file] [-host h ...]
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+import aggregate
+import analysis
+import helper
+import records
+
+
+categories = aggregate.categories
+# Stages read from the records, and the substring that identifies their lines
+record_stages = ["categories", "synonyms", "reduced", "verification", "syndata", "synfetch"]
+stage_tags = ['"stage":"%s"' % s for s in record_stages]
+# Changes in averages smaller than this are rounding
+epsilon = 1e-6
+
+
+# Full outer join of two iterables of (key, value) sorted on unique keys;
+# yields (key, left value or None, right value or None)
+def outer_join(left, right):
+    left = iter(left)
+    right = iter(right)
+    l = next(left, None)
+    r = next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield (l[0], l[1], None)
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            yield (r[0], None, r[1])
+            r = next(right, None)
+        else:
+            yield (l[0], l[1], r[1])
+            l = next(left, None)
+            r = next(right, None)
+
+
+def sorted_items(d):
+    return sorted(d.iteritems())
+
+
+def outcome(result):
+    (success, match) = result
+    if success:
+        return "match" if match else "no match"
+    return "untested" if match == "sanity fail" else "failed"
+
+
+# The kind of run at path: "records", "results", "text" or "csv"
+def run_kind(path):
+    if not os.path.exists(path):
+        raise ValueError(path + " doesn't exist")
+    if os.path.isdir(path):
+        if len(glob.glob(os.path.join(path, "*", "*" + records.records_suffix))) > 0:
+            return "records"
+        if len(glob.glob(os.path.join(path, "*", "*", "results.json"))) > 0:
+            return "results"
+        raise ValueError(path + " has neither host records nor results.json files")
+    if path.endswith(".csv"):
+        return "csv"
+    return "text"
+
+
+# Per-host data of a records file: only lines of the compared stages are parsed
+def records_host(path):
+    stages = {}
+    with open(path) as f:
+        for line in f:
+            if any(tag in line for tag in stage_tags):
+                record = json.loads(line)
+                stages[record["stage"]] = record
+    data = {"counts": {}}
+    if "categories" in stages:
+        data["categories"] = stages["categories"]["averages"]
+    if "synonyms" in stages:
+        data["synonyms"] = dict(((s["hash"], s["size"]), sorted(s["urls"]))
+                                for s in stages["synonyms"]["sets"])
+    if "reduced" in stages:
+        data["reduced"] = dict(((s["hash"], s["size"]), sorted(s["reduced"]))
+                               for s in stages["reduced"]["sets"])
+    if "verification" in stages:
+        data["verification"] = dict(((s["hash"], s["size"], url), outcome(result))
+                                    for s in stages["verification"]["sets"]
+                                    for (url, result) in s["reduced"].iteritems())
+    for stage in ("syndata", "synfetch"):
+        for (field, value) in stages.get(stage, {}).iteritems():
+            if field not in ("host", "stage"):
+                data["counts"][stage + "." + field] = value
+    return data
+
+
+def results_host(host_dir):
+    a = analysis.HostAnalysis(host_dir)
+    url_hashes = a.data["url_hash_dict"]
+    return {"counts": {"fetches": a.n_trials, "failed fetches": a.fail_count},
+            "categories": a.categories,
+            "synonyms": dict((h, sorted(urls)) for (h, urls) in a.synonym_sets.iteritems()),
+            "reduced": dict((h, sorted(urls)) for (h, urls) in a.reduced_urls.iteritems()),
+            "urls": dict((url, sorted(hashes)) for (url, hashes) in url_hashes.iteritems())}
+
+
+# Blocks of "Key: value" lines starting with "Host: <host>", as synurl.py
+# writes syndata.txt and synfetchresults.txt
+def text_hosts(path):
+    hosts = {}
+    counts = None
+    with open(path) as f:
+        for line in f:
+            (key, sep, value) = line.strip().partition(": ")
+            if not sep:
+                continue
+            if key == "Host":
+                counts = hosts.setdefault(value, {})
+            elif counts is not None:
+                try:
+                    counts[key] = int(value)
+                except ValueError:
+                    counts[key] = value
+    return hosts
+
+
+# Rows of an agg csv file, named by its header line, or else by the
+# aggregate.agg_headers entry of its name or (for archived copies) its width
+# A host's last row wins, as process.py appends a row per run
+def csv_hosts(path):
+    with open(path, 'rb') as f:
+        rows = list(csv.reader(f))
+    header = aggregate.agg_headers.get(os.path.basename(path))
+    if len(rows) > 0 and rows[0][0] == "Domain":
+        header = rows.pop(0)
+    hosts = {}
+    for row in rows:
+        names = header
+        if names is None or len(names) != len(row):
+            names = ["Domain"] + ["column %d" % i for i in xrange(1, len(row))]
+            for h in aggregate.agg_headers.values():
+                if len(h) == len(row):
+                    names = h
+        hosts[row[0]] = dict(zip(names[1:], row[1:]))
+    return hosts
+
+
+# Generates (host, thunk returning the host's data) in host order
+def run_hosts(path, kind, only=None):
+    if kind in ("text", "csv"):
+        hosts = text_hosts(path) if kind == "text" else csv_hosts(path)
+        items = [(h, (lambda c: lambda: {"counts": c})(hosts[h])) for h in sorted(hosts)]
+    elif kind == "records":
+        paths = glob.glob(os.path.join(path, "*", "*" + records.records_suffix))
+        items = sorted((os.path.basename(p)[:-len(records.records_suffix)],
+                        (lambda p: lambda: records_host(p))(p)) for p in paths)
+    else:
+        dirs = [d for d in sorted(os.listdir(path))
+                if len(glob.glob(os.path.join(path, d, "*", "results.json"))) > 0]
+        items = [(d, (lambda p: lambda: results_host(p))(os.path.join(path, d)))
+                 for d in dirs]
+    for (host, load) in items:
+        if only is None or host in only:
+            yield (host, load)
+
+
+# Changes between two sorted {key: value} dicts: (added, removed, changed keys)
+def keyed_changes(a, b):
+    added = []
+    removed = []
+    changed = []
+    for (key, va, vb) in outer_join(sorted_items(a), sorted_items(b)):
+        if va is None:
+            added.append(key)
+        elif vb is None:
+            removed.append(key)
+        elif va != vb:
+            changed.append(key)
+    return (added, removed, changed)
+
+
+def fmt_key(key):
+    if isinstance(key, tuple):
+        return " ".join(unicode(k) for k in key)
+    return unicode(key)
+
+
+# Compares one host's data; returns ([(item, a, b)], [detail lines])
+def diff_host(a, b):
+    changes = []
+    details = []
+    # A stage only one run has is one change, not one per field
+    absent = set()
+    for (name, va, vb) in outer_join(sorted_items(a["counts"]), sorted_items(b["counts"])):
+        if va is None or vb is None:
+            stage = name.split('.')[0]
+            if stage not in absent:
+                absent.add(stage)
+                changes.append((stage, "absent" if va is None else "present",
+                                "absent" if vb is None else "present"))
+        elif va != vb:
+            changes.append((name, va, vb))
+
+    if "categories" in a and "categories" in b:
+        for c in categories:
+            for k in ("n", "b"):
+                (va, vb) = (a["categories"][c][k], b["categories"][c][k])
+                if abs(va - vb) > epsilon:
+                    changes.append(("%s %s" % (c, k), va, vb))
+
+    for (field, label) in (("synonyms", "synonym sets"), ("reduced", "reduced sets"),
+                           ("urls", "urls")):
+        if field not in a or field not in b:
+            continue
+        (added, removed, changed) = keyed_changes(a[field], b[field])
+        if len(added) + len(removed) + len(changed) == 0:
+            continue
+        changes.append((label, len(a[field]), len(b[field])))
+        for (what, keys) in (("added", added), ("removed", removed), ("changed", changed)):
+            if len(keys) > 0:
+                changes.append(("%s %s" % (label, what), 0, len(keys)))
+        for key in added:
+            details.append("+ %s %s" % (label, fmt_key(key)))
+        for key in removed:
+            details.append("- %s %s" % (label, fmt_key(key)))
+        for key in changed:
+            details.append("~ %s %s: %s -> %s" % (label, fmt_key(key), len(a[field][key]),
+                                                 len(b[field][key])))
+
+    if "verification" in a and "verification" in b:
+        transitions = {}
+        for (key, va, vb) in outer_join(sorted_items(a["verification"]),
+                                        sorted_items(b["verification"])):
+            if va != vb:
+                t = "%s -> %s" % (va or "absent", vb or "absent")
+                transitions[t] = transitions.get(t, 0) + 1
+                details.append("~ verification %s: %s" % (fmt_key(key), t))
+        for t in sorted(transitions):
+            changes.append(("verification " + t, 0, transitions[t]))
+    return (changes, details)
+
+
+def fmt_value(v):
+    if isinstance(v, float):
+        return "%.2f" % v
+    return unicode(v)
+
+
+def diff(path_a, path_b, verbose=False, out=None, only=None):
+    (kind_a, kind_b) = (run_kind(path_a), run_kind(path_b))
+    if kind_a != kind_b:
+        raise ValueError("can't diff a %s run with a %s run" % (kind_a, kind_b))
+    start = time.time()
+    writer = None
+    if out is not None:
+        f = open(out, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(["host", "item", "a", "b"])
+    n_hosts = 0
+    n_changed = 0
+    only_in = {"a": 0, "b": 0}
+    for (host, la, lb) in outer_join(run_hosts(path_a, kind_a, only),
+                                     run_hosts(path_b, kind_b, only)):
+        n_hosts += 1
+        if la is None or lb is None:
+            side = "b" if la is None else "a"
+            only_in[side] += 1
+            print host, "only in", path_b if la is None else path_a
+            if writer is not None:
+                writer.writerow([host, "only in " + side, "", ""])
+            continue
+        (changes, details) = diff_host(la(), lb())
+        if len(changes) == 0:
+            continue
+        n_changed += 1
+        print host
+        for (item, va, vb) in changes:
+            if item.endswith((" added", " removed", " changed")) or \
+               item.startswith("verification "):
+                print (u"\t%-40s %s" % (item, vb)).encode('utf-8')
+            else:
+                print (u"\t%-40s %s -> %s" % (item, fmt_value(va), fmt_value(vb))).encode('utf-8')
+            if writer is not None:
+                writer.writerow([host.encode('utf-8'), item.encode('utf-8'),
+                                 fmt_value(va).encode('utf-8'), fmt_value(vb).encode('utf-8')])
+        if verbose:
+            for line in details:
+                print ("\t\t" + line).encode('utf-8')
+    if writer is not None:
+        f.close()
+    sys.stderr.write("%d hosts (%s runs): %d changed, %d only in a, %d only in b; %.2fs\n" %
+                     (n_hosts, kind_a, n_changed, only_in["a"], only_in["b"],
+                      time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="diff two survey runs by host")
+    parser.add_argument("a", help="resultstats or results directory, or agg file")
+    parser.add_argument("b")
+    parser.add_argument("-v", action="store_true", help="list the changed sets and urls")
+    parser.add_argument("-out", default=None, help="csv of (host, item, a, b) changes")
+    parser.add_argument("-host", nargs="+", default=None, help="only these hosts")
+    opts = parser.parse_args()
+    helper.debug = False
+    only = set(opts.host) if opts.host is not None else None
+    try:
+        diff(opts.a, opts.b, opts.v, opts.out, only)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""
+  Sweep of the URL similarity threshold and segment weights.
+
+  process.sim_thresh and urltable.wt_arr decide how inconsistent URLs are
+  clustered into similarity sets (urltable.create_sim_url_tab), which synonym
+  sets are reducible (synurl.select_synonym_sets) and how many reduced URLs
+  they yield (urltable.reduce_syn_urls). Trying other values used to mean
+  rerunning dprocess.sh for every setting. This loads each host's results
+  once and compares every pair of its URLs once, segment by segment, into
+  three bitmasks over the segment positions:
+
+      E   the segment texts are equal
+      T   the segment types are equal
+      M   the segments match for url_sim_score: same type, and same text
+          or (for ';' params) the same parameter name
+
+  Only URLs with the same number of segments are ever compared (check_urls_sim
+  fails on any other pair), so pairs are only formed within those groups, and
+  only for the pairs the clustering actually looks at. Every similarity score
+  the pipeline computes is then a weighted popcount of one of these masks:
+
+      clustering    a similarity set is its first URL plus the mask of
+                    segments that haven't gone wild; a URL joins the set if
+                    M & fixed scores above the threshold, and fixed &= E
+      reduction     a reduced URL is its first URL plus the mask of removed
+                    segments R; a URL is merged into it if (M & ~R) scores
+                    above the threshold and T is all ones, and R |= ~E
+
+  so the clustering and reduction of every (threshold, weights) point of the
+  grid replays the pipeline's greedy passes on integers, with exactly its
+  results (-check verifies this against urltable for every point).
+
+  The table, one row per host and grid point, goes to
+  resultstats/agg/sweep.csv:
+
+      host, weights, sim_thresh, inconsistent_urls, sim_sets, syn_sets,
+      reducible_sets, reduced_urls
+
+  Usage: python sweep.py [-results dir] [-thresholds 0.4,0.5,...]
+                         [-weights 1,2,1,1,1,1 ...] [-out file] [-check] [host ...]
+"""
+
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+
+import helper
+import process
+import synurl
+import urltable
+
+
+default_thresholds = [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+# The pipeline's weights, uniform weights, and heavier netloc and path weights
+default_weights = [tuple(urltable.wt_arr), (1, 1, 1, 1, 1, 1),
+                   (1, 4, 1, 1, 1, 1), (1, 2, 2, 1, 1, 1)]
+out_file = "resultstats/agg/sweep.csv"
+n_types = len(urltable.wt_arr)
+
+
+def popcount(x):
+    return bin(x).count('1')
+
+
+# The split URLs of one host, and the pairwise segment masks between them
+class URLPairs(object):
+
+    def __init__(self):
+        self.ids = {}
+        self.lengths = []
+        self.texts = []
+        # Per URL, the mask of the positions of each segment type
+        self.type_masks = []
+        # Positions whose text a removed ("") segment still matches
+        self.empty_masks = []
+        self.masks = {}
+        self.n_pairs = 0
+        self._denoms = {}
+
+    def add(self, url):
+        if url in self.ids:
+            return self.ids[url]
+        split = urltable.split_url(url)
+        type_masks = [0] * n_types
+        empty = 0
+        for (n, txt, ty) in split:
+            type_masks[ty] |= 1 << n
+            if txt == "" or (ty == urltable.param_code and txt.split('=', 1)[0] == ""):
+                empty |= 1 << n
+        self.ids[url] = len(self.lengths)
+        self.lengths.append(len(split))
+        self.texts.append([(txt, ty) for (n, txt, ty) in split])
+        self.type_masks.append(type_masks)
+        self.empty_masks.append(empty)
+        return self.ids[url]
+
+    def full(self, i):
+        return (1 << self.lengths[i]) - 1
+
+    # (E, T, M) of two URLs with the same number of segments; computed once
+    def pair(self, i, j):
+        key = (i, j) if i < j else (j, i)
+        if key in self.masks:
+            return self.masks[key]
+        e = t = m = 0
+        for n, ((a_txt, a_ty), (b_txt, b_ty)) in enumerate(zip(self.texts[i],
+                                                               self.texts[j])):
+            bit = 1 << n
+            if a_txt == b_txt:
+                e |= bit
+            if a_ty == b_ty:
+                t |= bit
+                if a_txt == b_txt:
+                    m |= bit
+                elif a_ty == urltable.param_code and \
+                     a_txt.split('=', 1)[0] == b_txt.split('=', 1)[0]:
+                    m |= bit
+        self.masks[key] = (e, t, m)
+        self.n_pairs += 1
+        return self.masks[key]
+
+    # url_sim_score of URL i (as the table or reduced URL) given the mask of
+    # segments that match
+    def score(self, i, match, weights):
+        key = (i, weights)
+        if key not in self._denoms:
+            self._denoms[key] = sum(w * popcount(tm) for w, tm in
+                                    zip(weights, self.type_masks[i]))
+        num = 0
+        for w, tm in zip(weights, self.type_masks[i]):
+            if match & tm:
+                num += w * popcount(match & tm)
+        return float(num) / self._denoms[key]
+
+
+# urltable.create_sim_url_tab; returns the number of similarity sets
+def cluster(pairs, ids, sim_thresh, weights):
+    sets = []
+    for u in ids:
+        for s in sets:
+            first = s[0]
+            if pairs.lengths[first] != pairs.lengths[u]:
+                continue
+            (e, t, m) = pairs.pair(first, u)
+            if pairs.score(first, m & s[1], weights) >= sim_thresh:
+                s[1] &= e
+                break
+        else:
+            sets.append([u, pairs.full(u)])
+    return len(sets)
+
+
+# Segments of a reduced URL (removed ones are ""), for comparing reduced URLs
+# the way helper.listReplace does
+def reduced_key(pairs, base, removed):
+    return tuple(("" if removed >> n & 1 else txt, ty)
+                 for n, (txt, ty) in enumerate(pairs.texts[base]))
+
+
+# urltable.reduce_syn_urls; returns the number of reduced URLs
+def reduce_set(pairs, ids, sim_thresh, weights):
+    # [first URL, removed segments, key]
+    res = [[ids[0], 0, reduced_key(pairs, ids[0], 0)]]
+    for u in ids:
+        found = False
+        k = 0
+        while k < len(res):
+            (base, removed, key) = res[k]
+            k += 1
+            if pairs.lengths[base] != pairs.lengths[u]:
+                continue
+            (e, t, m) = pairs.pair(base, u)
+            full = pairs.full(base)
+            match = (m & ~removed) | (removed & t & pairs.empty_masks[u])
+            if pairs.score(base, match, weights) < sim_thresh or t != full:
+                continue
+            new_removed = removed | (full & ~e)
+            new = [base, new_removed, reduced_key(pairs, base, new_removed)]
+            # helper.listReplace replaces every reduced URL equal to this one
+            for r in res:
+                if r[2] == key:
+                    r[:] = new
+            found = True
+        if not found:
+            res.append([u, 0, reduced_key(pairs, u, 0)])
+    return len(res)
+
+
+# synurl.score_synonym_set
+def score_set(pairs, ids, weights):
+    if len(ids) < 2:
+        return 0.0
+    total = 0.0
+    for i in ids:
+        best = 0.0
+        for j in ids:
+            if i != j and pairs.lengths[i] == pairs.lengths[j]:
+                best = max(best, pairs.score(i, pairs.pair(i, j)[2], weights))
+        total += best
+    return total / len(ids)
+
+
+# The URLs process.py clusters and reduces for a host, in the order it does
+def load_host(results_dir, host):
+    targets = sorted(glob.glob(os.path.join(results_dir, host, "*", "results.json")))
+    if len(targets) == 0:
+        return None
+    data = process.load_results(targets)
+    inconsistent = process.extract_inconsistent_urls(data["url_occ_dict"], len(targets),
+                                                     data["fail_count"])
+    synonyms = synurl.extract_synonym_urls(data["hash_url_dict"])
+    return (inconsistent, synonyms)
+
+
+def sweep_host(inconsistent, synonyms, thresholds, weight_list):
+    pairs = URLPairs()
+    inc_ids = [pairs.add(url) for url in inconsistent.keys()]
+    syn_sets = []
+    for h in synonyms.keys():
+        # reduce_syn_urls iterates the set as a dict, the score sorts it
+        syn_sets.append(([pairs.add(url) for url in synonyms[h]],
+                         [pairs.add(url) for url in sorted(synonyms[h].keys())]))
+    rows = []
+    for weights in weight_list:
+        reducible = [ids for (ids, sorted_ids) in syn_sets
+                     if score_set(pairs, sorted_ids, weights) >= process.syn_score_thresh]
+        for t in thresholds:
+            reduced = sum(reduce_set(pairs, ids, t, weights) for ids in reducible)
+            rows.append((weights, t, len(inconsistent),
+                         cluster(pairs, inc_ids, t, weights),
+                         len(synonyms), len(reducible), reduced))
+    return (rows, pairs.n_pairs)
+
+
+# The same table computed by running urltable itself for every grid point
+def check_host(inconsistent, synonyms, thresholds, weight_list):
+    saved = urltable.wt_arr
+    rows = []
+    try:
+        for weights in weight_list:
+            urltable.wt_arr = list(weights)
+            (scores, reducible) = synurl.select_synonym_sets(synonyms,
+                                                             process.syn_score_thresh)
+            for t in thresholds:
+                tab = urltable.create_sim_url_tab(inconsistent.keys(), t)
+                reduced = sum(len(urltable.reduce_syn_urls(reducible[h], t))
+                              for h in reducible.keys())
+                rows.append((weights, t, len(inconsistent), len(tab),
+                             len(synonyms), len(reducible), reduced))
+    finally:
+        urltable.wt_arr = saved
+    return rows
+
+
+def weights_name(weights):
+    return "-".join(str(w) for w in weights)
+
+
+def parse_weights(s):
+    weights = tuple(int(w) for w in s.split(','))
+    if len(weights) != n_types:
+        raise argparse.ArgumentTypeError("need %d weights" % n_types)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sweep URL similarity settings")
+    parser.add_argument("-results", default="results")
+    parser.add_argument("-thresholds", default=",".join(str(t) for t in default_thresholds),
+                        help="comma-separated similarity thresholds")
+    parser.add_argument("-weights", type=parse_weights, nargs='+', default=None,
+                        help="segment weight vectors, one weight per segment type")
+    parser.add_argument("-out", default=out_file)
+    parser.add_argument("-check", action="store_true",
+                        help="also run urltable for every point and compare")
+    parser.add_argument("hosts", nargs='*')
+    opts = parser.parse_args()
+    thresholds = [float(t) for t in opts.thresholds.split(',')]
+    weight_list = opts.weights or default_weights
+    hosts = opts.hosts or sorted(os.listdir(opts.results))
+    helper.debug = False
+
+    table = []
+    n_pairs = 0
+    sweep_secs = 0.0
+    check_secs = 0.0
+    mismatches = 0
+    for host in hosts:
+        loaded = load_host(opts.results, host)
+        if loaded is None:
+            continue
+        (inconsistent, synonyms) = loaded
+        start = time.time()
+        (rows, n) = sweep_host(inconsistent, synonyms, thresholds, weight_list)
+        sweep_secs += time.time() - start
+        n_pairs += n
+        table.extend((host,) + row for row in rows)
+        if opts.check:
+            start = time.time()
+            expected = check_host(inconsistent, synonyms, thresholds, weight_list)
+            check_secs += time.time() - start
+            for (got, want) in zip(rows, expected):
+                if got != want:
+                    mismatches += 1
+                    print "mismatch:", host, got, "urltable:", want
+
+    with open(opts.out, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(["host", "weights", "sim_thresh", "inconsistent_urls", "sim_sets",
+                         "syn_sets", "reducible_sets", "reduced_urls"])
+        for (host, weights, t, n_inc, n_sets, n_syn, n_red, n_urls) in table:
+            writer.writerow([host, weights_name(weights), t, n_inc, n_sets, n_syn, n_red,
+                             n_urls])
+
+    # Totals over all hosts, one line per grid point
+    print "%-14s %6s %9s %10s %9s" % ("weights", "thresh", "sim sets", "reducible",
+                                      "reduced")
+    for weights in weight_list:
+        for t in thresholds:
+            rows = [r for r in table if r[1] == weights and r[2] == t]
+            print "%-14s %6.2f %9d %10d %9d" % (weights_name(weights), t,
+                                                sum(r[4] for r in rows),
+                                                sum(r[6] for r in rows),
+                                                sum(r[7] for r in rows))
+    n_points = len(thresholds) * len(weight_list)
+    sys.stderr.write("%d hosts x %d settings in %.1fs (%d URL pairs compared)\n" %
+                     (len(set(r[0] for r in table)), n_points, sweep_secs, n_pairs))
+    if opts.check:
+        sys.stderr.write("urltable for every setting: %.1fs, %d mismatches\n" %
+                         (check_secs, mismatches))
+    print "Wrote", opts.out
+
+
+if __name__ == '__main__':
+    main()
@@ -2,26 +2,110 @@
 
 import urltable
 import helper
+import hashalg
+import httpverify
+import supervise
 
 import sys
+import os
 import json
-import subprocess
 import csv
+import time
 
 
 outdir = "resultstats"
 aggdir = outdir+"/agg"
 
+# Bodies that can't tell anything about a URL: hashes of known-empty contents
+# (the empty string, in every hash algorithm) and anything smaller than
+# min_body_size bytes, which covers 1x1 tracking gifs and empty json/js
+# responses
+empty_hashes = hashalg.empty_hashes()
+min_body_size = 64
+
+# Hard limits for each browser launch (fetchsyn.js gives up on a page itself
+# after 30 seconds, but not if the browser hangs)
+fetch_timeout = 90
+fetch_mem_limit = supervise.mem_limit_mb
+
+# Budgets for refetching reduced URLs, None for no limit: fetches (browser
+# launches, plus the HTTP requests of the "http" verify_engine) and seconds
+# spent per host, and the same over every host of a run. What a run has spent
+# is kept in the ledger file aggdir/ledger_name, so the global budget holds
+# across the process.py invocations of dprocess.sh (delete the ledger to start
+# a new budget; dprocess.sh -restart does). Budgets are checked before each
+# synonym set, so a set that is started is always finished
+host_fetch_budget = None
+host_time_budget = None
+global_fetch_budget = None
+global_time_budget = None
+ledger_name = "fetchbudget.json"
+
+# Browser launches so far (fetch_to_cache); cached fetches cost nothing
+browser_launches = 0
+
+# "browser" verifies every URL with a slimerjs page load; "http" fetches it
+# directly first and only launches the browser if that is inconclusive (see
+# httpverify.py)
+verify_engine = "browser"
+http_pool = httpverify.ConnectionPool()
+
+# HTTP proxy ("host:port") both engines fetch through, e.g. replay.py
+fetch_proxy = None
+
+def set_proxy(proxy):
+        global fetch_proxy, http_pool
+        fetch_proxy = proxy
+        http_pool = httpverify.ConnectionPool(proxy=proxy)
+
+# True if a (hash, size) key identifies an empty or trivially small body
+def is_trivial_body(key):
+        (h, size) = key
+        return h in empty_hashes or size < min_body_size
+
 # make note of any different resources whose contents hash to the same value 
+# hash_url_dict is keyed on (hash, size) so that colliding hashes of bodies of
+# different sizes aren't merged; empty and trivial bodies are left out
 def extract_synonym_urls(hash_url_dict):
         synonym_url_dict = {}
         for h in hash_url_dict.keys():
                 url_dict = hash_url_dict[h]
-                if len(url_dict) > 1:
+                if len(url_dict) > 1 and not is_trivial_body(h):
                         synonym_url_dict[h] = url_dict
         return synonym_url_dict
 
 
+# Score a synonym set by how similar its URLs are to each other: the mean,
+# over all URLs, of the best urltable similarity score with another URL in the
+# set. Sets of unrelated URLs that happen to serve the same contents score
+# low; there's nothing in them for URL reduction to find
+def score_synonym_set(url_dict):
+        split_urls = [urltable.split_url(url) for url in sorted(url_dict.keys())]
+        if len(split_urls) < 2:
+                return 0.0
+        total = 0.0
+        for i in xrange(0,len(split_urls)):
+                best = 0.0
+                for j in xrange(0,len(split_urls)):
+                        if i != j:
+                                best = max(best, urltable.url_sim_score(split_urls[i],
+                                                                         split_urls[j]))
+                total += best
+        return total/len(split_urls)
+
+
+# Returns ({key: score} for all synonym sets, dictionary of the sets scoring at
+# least min_score); only the latter are worth reducing and refetching
+def select_synonym_sets(syn_url_dict, min_score):
+        scores = {}
+        selected = {}
+        for h in syn_url_dict.keys():
+                scores[h] = score_synonym_set(syn_url_dict[h])
+                if scores[h] >= min_score:
+                        selected[h] = syn_url_dict[h]
+        return (scores, selected)
+
+
 # Reduce sets of synonym URLs and store the results in a table mapping hash to
 # a tuple that contains the original synonym url list and the reduced version
 def reduce_synonym_urls(syn_url_dict, sim_thresh):
@@ -37,7 +121,7 @@ def print_reduced_urls(syn_url_dict, show_sets):
         for h in syn_url_dict.keys():
                 syn_url_list = syn_url_dict[h][0]
                 reduced_urls = syn_url_dict[h][1]
-                print h,":"
+                print h[0],"(",h[1],"bytes):"
                 for red_url in reduced_urls:
                         print "\t",red_url
                 if show_sets:
@@ -47,36 +131,105 @@ def print_reduced_urls(syn_url_dict, show_sets):
 # Write data on the number of synonym URL sets and total number of reduced URLs
 # for each host to 2 common files: one basic text file (more human readable)
 # and one csv file
-def write_syn_url_data(host, syn_url_dict, txt_out_file, csv_out_file, full_urls):
+# If sink is a records.RecordWriter, the same data goes to the host's records;
+# with out files of None, only to the records
+def write_syn_url_data(host, syn_url_dict, txt_out_file, csv_out_file, full_urls,
+                       sink=None):
         total_reduced_urls = 0
         n_synonym_url_sets = len(syn_url_dict.keys())
 
-        fout = open(txt_out_file, 'a')
-        fout.write("Host: "+host+"\n")
-        fout.write("Number of synonym url sets: "+str(n_synonym_url_sets)+"\n")
-
-        fcsv = open(csv_out_file, 'ab')
-        csvwriter = csv.writer(fcsv)
-        
         for h in syn_url_dict.keys():
-                reduced_urls = syn_url_dict[h][1]
-                total_reduced_urls += len(reduced_urls)
-                
-                #fout.write("Number of reduced urls: "+str(len(reduced_urls))+"\n")
-                if full_urls:
-                        fout.write(str(h)+":\n")
-                        for url in reduced_urls:
-                                fout.write("\t"+url+"\n")
-
-        fout.write("Number of reduced URLs: "+str(total_reduced_urls)+"\n")
-        fout.write("-"*60+"\n")
-        
-        csvwriter.writerow([host, n_synonym_url_sets, total_reduced_urls])
-
+                total_reduced_urls += len(syn_url_dict[h][1])
+
+        if txt_out_file is not None:
+                fout = open(txt_out_file, 'a')
+                fout.write("Host: "+host+"\n")
+                fout.write("Number of synonym url sets: "+str(n_synonym_url_sets)+"\n")
+                for h in syn_url_dict.keys():
+                        #fout.write("Number of reduced urls: "+str(len(reduced_urls))+"\n")
+                        if full_urls:
+                                fout.write(str(h[0])+":\n")
+                                for url in syn_url_dict[h][1]:
+                                        fout.write("\t"+url+"\n")
+                fout.write("Number of reduced URLs: "+str(total_reduced_urls)+"\n")
+                fout.write("-"*60+"\n")
+                fout.close()
+
+        if csv_out_file is not None:
+                fcsv = open(csv_out_file, 'ab')
+                csvwriter = csv.writer(fcsv)
+                csvwriter.writerow([host, n_synonym_url_sets, total_reduced_urls])
+                fcsv.close()
+
+        if sink is not None:
+                sink.write(host, "syndata", syn_url_sets=n_synonym_url_sets,
+                           reduced_urls=total_reduced_urls)
+                sink.write(host, "reduced",
+                           sets=[{"hash": h[0], "size": h[1], "reduced": syn_url_dict[h][1]}
+                                 for h in sorted(syn_url_dict.keys())])
+
+
+
+# Expected payoff of verifying a synonym set: the bytes its resource took
+# over all fetches (size times occurrences of its URLs), which a working
+# reduced URL would make cacheable
+def set_payoff(key, syn_urls):
+        return key[1] * sum(syn_urls.values())
+
+
+# Keys of the synonym sets in the order to verify them: highest payoff first,
+# then larger sets
+def schedule_synonym_sets(syn_url_dict):
+        return sorted(syn_url_dict.keys(),
+                      key=lambda h: (-set_payoff(h, syn_url_dict[h][0]),
+                                     -len(syn_url_dict[h][0]), h))
+
+
+def read_ledger(path):
+        try:
+                with open(path) as f:
+                        return json.load(f)
+        except (IOError, ValueError):
+                return {"fetches": 0, "seconds": 0.0}
+
+
+class FetchBudget(object):
+
+        # Spending of this host, on top of what the ledger says the run spent
+        # before it
+        def __init__(self, ledger_path):
+                self.ledger_path = ledger_path
+                self.before = read_ledger(ledger_path)
+                self.fetches = 0
+                self.secs = 0.0
+
+        # Name of the budget that has run out, or None
+        def exhausted(self):
+                if host_fetch_budget is not None and self.fetches >= host_fetch_budget:
+                        return "host fetches"
+                if host_time_budget is not None and self.secs >= host_time_budget:
+                        return "host time"
+                if global_fetch_budget is not None and \
+                   self.before["fetches"] + self.fetches >= global_fetch_budget:
+                        return "global fetches"
+                if global_time_budget is not None and \
+                   self.before["seconds"] + self.secs >= global_time_budget:
+                        return "global time"
+                return None
+
+        def charge(self, fetches, secs):
+                self.fetches += fetches
+                self.secs += secs
+                ledger = {"fetches": self.before["fetches"] + self.fetches,
+                          "seconds": round(self.before["seconds"] + self.secs, 1)}
+                tmp_path = self.ledger_path+".tmp"
+                with open(tmp_path, 'w') as f:
+                        json.dump(ledger, f)
+                os.rename(tmp_path, self.ledger_path)
 
 
 def fetch_reduced_urls(host, syn_url_dict, txt_out_file, csv_out_file, sanity_retry,\
-                       reg_retry, refetch_all):
+                       reg_retry, refetch_all, sink=None):
 
         # Every reduced URL can fail, succeed but not match, or succeed and match
         # URLs can also remain untested if the sanity check for a set of reduced URLs fails
@@ -106,14 +259,24 @@ def fetch_reduced_urls(host, syn_url_dict, txt_out_file, csv_out_file, sanity_re
 
         res_syn_url_dict = {}
 
-        # Will be used as single txt output file for reduced url data from all sites
-        fout = open(txt_out_file, 'a')
-
-        # Output same data as csv file for convenient graphing
-        fcsv = open(csv_out_file, 'ab')
-        csvwriter = csv.writer(fcsv)
-
-        for h in syn_url_dict.keys():
+        # Most valuable sets first, so that whatever the budget leaves out
+        # matters least
+        budget = FetchBudget(aggdir+"/"+ledger_name)
+        skipped = []
+        for h in schedule_synonym_sets(syn_url_dict):
+                reason = budget.exhausted()
+                if reason is not None:
+                        skipped.append({"hash": h[0], "size": h[1],
+                                        "payoff": set_payoff(h, syn_url_dict[h][0]),
+                                        "reduced": len(syn_url_dict[h][1]),
+                                        "reason": reason})
+                        continue
+                launches = browser_launches
+                requests = http_pool.requests
+                start = time.time()
+
+                # Keys are (hash, size); fetched resources are matched on hash
+                orig_h = h[0]
                 syn_url_list = sorted(syn_url_dict[h][0].keys())
                                              
                 reduced_urls = syn_url_dict[h][1]
@@ -126,7 +289,7 @@ def fetch_reduced_urls(host, syn_url_dict, txt_out_file, csv_out_file, sanity_re
                 # definitely return same hash as original
                 sanity_url = syn_url_list[0] 
                 helper.printd("Sanity Test URL: "+sanity_url+"\n")
-                (f,unt,snm,swm) = fetch_and_compare(h,sanity_url,url_dir,reduced_url_map,\
+                (f,unt,snm,swm) = fetch_and_compare(orig_h,sanity_url,url_dir,reduced_url_map,\
                                                     fails,succs_no_match,succs_w_match,\
                                                     True,sanity_retry,refetch_all)
 
@@ -141,27 +304,97 @@ def fetch_reduced_urls(host, syn_url_dict, txt_out_file, csv_out_file, sanity_re
                         for url in reduced_urls:
                                 helper.printd("Reduced url: "+url+"\n")
                                 (fails,untested,succs_no_match,succs_w_match) = \
-                                        fetch_and_compare(h,url,url_dir,reduced_url_map,\
+                                        fetch_and_compare(orig_h,url,url_dir,reduced_url_map,\
                                                           fails,succs_no_match,succs_w_match,False,\
                                                           reg_retry,refetch_all)
                         
                 res_syn_url_dict[h] = (syn_url_list, reduced_url_map)
+                budget.charge(browser_launches - launches + http_pool.requests - requests,
+                              time.time() - start)
+
+        if len(skipped) > 0:
+                print "Budget exhausted (" + skipped[0]["reason"] + "):", len(skipped), "of",\
+                        len(syn_url_dict), "synonym sets not verified"
         
-        # TXT output
-        fout.write("Host: "+host+"\n")
-        fout.write("Fails: "+str(fails)+"\n")
-        fout.write("Untested due to sanity fail: "+str(sanity_untested)+"\n")
-        fout.write("Succs no match: "+str(succs_no_match)+"\n")
-        fout.write("Succs w/ match: "+str(succs_w_match)+"\n")
-        fout.write("--------------------------------------\n")
+        # TXT output; a single txt file for reduced url data from all sites
+        if txt_out_file is not None:
+                fout = open(txt_out_file, 'a')
+                fout.write("Host: "+host+"\n")
+                fout.write("Fails: "+str(fails)+"\n")
+                fout.write("Untested due to sanity fail: "+str(sanity_untested)+"\n")
+                fout.write("Succs no match: "+str(succs_no_match)+"\n")
+                fout.write("Succs w/ match: "+str(succs_w_match)+"\n")
+                fout.write("--------------------------------------\n")
+                fout.close()
 
-        # CSV output
-        csvwriter.writerow([host,fails,sanity_untested,succs_no_match,succs_w_match])
+        # Output same data as csv file for convenient graphing
+        if csv_out_file is not None:
+                fcsv = open(csv_out_file, 'ab')
+                csvwriter = csv.writer(fcsv)
+                csvwriter.writerow([host,fails,sanity_untested,succs_no_match,succs_w_match])
+                fcsv.close()
+
+        if sink is not None:
+                sink.write(host, "verification",
+                           sets=[{"hash": h[0], "size": h[1],
+                                  "payoff": set_payoff(h, syn_url_dict[h][0]),
+                                  "syn_urls": res_syn_url_dict[h][0],
+                                  "reduced": res_syn_url_dict[h][1]}
+                                 for h in sorted(res_syn_url_dict.keys())])
+                sink.write(host, "skipped", sets=skipped)
+                sink.write(host, "synfetch", fails=fails, untested=sanity_untested,
+                           succs_no_match=succs_no_match, succs_w_match=succs_w_match,
+                           skipped=len(skipped), fetches=budget.fetches,
+                           seconds=round(budget.secs, 1))
 
         # Return for potential additional processing
         return res_syn_url_dict
 
 
+# Fetches url with fetchsyn.js into the cache file share_file and returns the
+# results. The browser writes to a temporary file, and only a complete,
+# successful fetch is renamed into the cache, so an interrupted run never
+# leaves a truncated entry for a resumed run to trust, and failed fetches are
+# retried rather than read back
+# The browser runs under supervise.run, which kills it after fetch_timeout
+# seconds; timeouts are logged to <outdir>/timeouts.jsonl
+# Resources are hashed with alg (hashalg.py), and their hashes tagged
+def fetch_to_cache(url, share_file, alg=hashalg.default):
+        global browser_launches
+        browser_launches += 1
+        tmp_file = share_file+".tmp"
+        cmd = ['slimerjs', 'fetchsyn.js', url, tmp_file]
+        if alg != hashalg.default:
+                cmd.append(alg)
+        # Through a proxy (replay.py), its X-Replay-Hash headers are trusted
+        if fetch_proxy is not None:
+                cmd.insert(1, '--proxy='+fetch_proxy)
+                cmd.append('-replay')
+        supervise.run(cmd, fetch_timeout, fetch_mem_limit, None,
+                      outdir+"/"+supervise.log_file, url)
+        try:
+                with open(tmp_file) as data_file:
+                        results = json.load(data_file)
+        except (IOError, ValueError):
+                results = {'status': 'fail', 'resources': []}
+        if results['status'] == 'success':
+                os.rename(tmp_file, share_file)
+        elif os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return hashalg.tag_results(results)
+
+
+# Verifies url with a direct HTTP fetch into the cache file share_file;
+# returns the results, or None if the browser has to decide
+def http_fetch_to_cache(orig_h, url, share_file):
+        results = httpverify.fetch_result(orig_h, url, http_pool)
+        if results is not None:
+                with open(share_file+".tmp", 'w') as f:
+                        json.dump(results, f)
+                os.rename(share_file+".tmp", share_file)
+        return results
+
+
 # fetches url, compares result with original hash, updates value of fail, swm (success_w_match)
 # snm (success_no_match) in response
 # If sanity_check true, don't add result to reduced_url_map or update counter, just print
@@ -186,57 +419,65 @@ def fetch_and_compare(orig_h, url, out_dir, reduced_url_map, \
         # If JSON file corresponding to url exists, read information about its
         # fetch from the file rather than performing the fetch again
         # Unless refetch all is specified in top-script invocation
-        if refetch_all or not helper.file_accessible(share_file,'r'):
-                proc_fetch = subprocess.call(['slimerjs', 'fetchsyn.js', \
-                                              url, share_file])
-
-        with open(share_file) as data_file:
-                results = json.load(data_file)
-                
-                if results['status'] != 'success':
-                        # Initially retry upon failure
-                        if retry_count > 0:
-                                retry_count -= 1
-                                return fetch_and_compare(orig_h, url, out_dir, \
-                                                         reduced_url_map, fail, snm, \
-                                                         swm, sanity_check, retry_count,\
-                                                         refetch_all)
-                        else:
-                                fail += 1
-                                reduced_url_map[url] = (False,'')
-                                return (fail,0,snm,swm)
-
-                # Search for synonym set hash in resources of fetched page
-                # This is necessary because the reduced URL might redirect to a different
-                # URL or "fill in" missing parameters, but the hash still might be the same
-                for resource in results['resources']:
-                        ret_url = resource['url']
-                        ret_hash = resource['hash']
-                        if (ret_hash == orig_h):
-                                if sanity_check:
-                                        helper.printd("Sanity_check passed: \n"\
-                                                      +"Orig URL: "+url+"\n"\
-                                                      +"Matching URL: "+ret_url+"\n")
-                                        return (0,0,0,0)
-                                else:
-                                        helper.printd("Reduced URL match found: \n"\
-                                                      +"Orig URL: "+url+"\n"\
-                                                      +"Matching URL: "+ret_url+"\n")
-                                        swm += 1
-                                        reduced_url_map[url] = (True,ret_url)
-                                        return (fail,0,snm,swm)
-                
-                # No match found in resources of requested website
-                if sanity_check:
-                        #assert False,"sanity check failed; no resource with matching hash found"
-                        helper.printd("Sanity check failed: \n"\
-                                      +"Orig URL: "+url+"\n")
-                        return (0,1,0,0)
+        # The fetch hashes with the algorithm of the original hash, and a
+        # cached fetch hashed with another one is fetched again
+        alg = hashalg.alg_of(orig_h)
+        results = None
+        if not refetch_all and helper.file_accessible(share_file,'r'):
+                with open(share_file) as data_file:
+                        results = hashalg.tag_results(json.load(data_file))
+                if hashalg.results_alg(results) != alg:
+                        results = None
+        if results is None:
+                if verify_engine == "http":
+                        results = http_fetch_to_cache(orig_h, url, share_file)
+                if results is None:
+                        results = fetch_to_cache(url, share_file, alg)
+
+        if results['status'] != 'success':
+                # Initially retry upon failure
+                if retry_count > 0:
+                        retry_count -= 1
+                        return fetch_and_compare(orig_h, url, out_dir, \
+                                                 reduced_url_map, fail, snm, \
+                                                 swm, sanity_check, retry_count,\
+                                                 refetch_all)
                 else:
-                        helper.printd("No match found for reduced URL: "\
-                                      +url)
-                        snm += 1
-                        reduced_url_map[url] = (True,'')
+                        fail += 1
+                        reduced_url_map[url] = (False,'')
                         return (fail,0,snm,swm)
 
+        # Search for synonym set hash in resources of fetched page
+        # This is necessary because the reduced URL might redirect to a different
+        # URL or "fill in" missing parameters, but the hash still might be the same
+        for resource in results['resources']:
+                ret_url = resource['url']
+                ret_hash = resource['hash']
+                if (ret_hash == orig_h):
+                        if sanity_check:
+                                helper.printd("Sanity_check passed: \n"\
+                                              +"Orig URL: "+url+"\n"\
+                                              +"Matching URL: "+ret_url+"\n")
+                                return (0,0,0,0)
+                        else:
+                                helper.printd("Reduced URL match found: \n"\
+                                              +"Orig URL: "+url+"\n"\
+                                              +"Matching URL: "+ret_url+"\n")
+                                swm += 1
+                                reduced_url_map[url] = (True,ret_url)
+                                return (fail,0,snm,swm)
+        
+        # No match found in resources of requested website
+        if sanity_check:
+                #assert False,"sanity check failed; no resource with matching hash found"
+                helper.printd("Sanity check failed: \n"\
+                              +"Orig URL: "+url+"\n")
+                return (0,1,0,0)
+        else:
+                helper.printd("No match found for reduced URL: "\
+                              +url)
+                snm += 1
+                reduced_url_map[url] = (True,'')
+                return (fail,0,snm,swm)
+
 
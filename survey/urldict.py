@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+  Sorted, front-coded URL dictionary.
+
+  Resource URLs share long prefixes (scheme and netloc, CDN paths, the
+  fixed part of query strings), and sorted URLs share most of them with
+  their neighbour. A URLDict stores a sorted set of URLs (as UTF-8) in blocks
+  of block_size: the first URL of a block in full, every other one as the
+  length of the prefix it shares with the previous URL and the rest of it,
+  each length as a varint. The offset of each block is kept, so
+
+      url(i)              decodes at most one block
+      id(url)             binary-searches the first URLs of the blocks, then
+                          scans one block (None if the URL isn't there)
+      prefix_range(p)     the ids [lo, hi) of the URLs starting with p
+
+  A URL's id is its rank in the sorted order. The dictionary is saved as
+  one file ("FCD1", then URL count, block size and block count as
+  little-endian 32-bit ints, the block offsets, and the blocks) that is
+  memory-mapped when loaded.
+
+  invindex.py uses it as the table of every URL of the survey. "measure"
+  prints the memory per URL of the corpus's URLs as a URLDict versus as
+  Python strings:
+
+      python urldict.py measure [-results dir] [-block n]
+"""
+
+import array
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+magic = "FCD1"
+header = struct.Struct('<III')
+block_size = 16
+
+
+def encode_varint(n):
+    out = []
+    while n >= 0x80:
+        out.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+
+# Returns (value, position after it)
+def decode_varint(data, i):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(data[i])
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (n, i)
+        shift += 7
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def utf8(url):
+    if isinstance(url, unicode):
+        return url.encode('utf-8')
+    return url
+
+
+class URLDict(object):
+
+    def __init__(self, data, offsets, n, block=block_size):
+        self.data = data
+        self.offsets = offsets
+        self.n = n
+        self.block = block
+
+    # Builds the dictionary from any iterable of URLs (duplicates are dropped)
+    @classmethod
+    def build(cls, urls, block=block_size):
+        keys = sorted(set(utf8(u) for u in urls))
+        out = []
+        offsets = array.array('I')
+        pos = 0
+        prev = ""
+        for i, key in enumerate(keys):
+            if i % block == 0:
+                offsets.append(pos)
+                lcp = 0
+            else:
+                lcp = common_prefix_length(prev, key)
+            entry = encode_varint(lcp) + encode_varint(len(key) - lcp) + key[lcp:]
+            out.append(entry)
+            pos += len(entry)
+            prev = key
+        return cls(''.join(out), offsets, len(keys), block)
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        if data[:4] != magic:
+            raise ValueError(path + " is not a URL dictionary")
+        (n, block, n_blocks) = header.unpack_from(data, 4)
+        start = 4 + header.size
+        offsets = array.array('I')
+        offsets.fromstring(data[start:start + 4 * n_blocks])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        base = start + 4 * n_blocks
+        return cls(data, array.array('I', [o + base for o in offsets]), n, block)
+
+    def save(self, path):
+        offsets = array.array('I', [o - self.offsets[0] for o in self.offsets]) \
+            if len(self.offsets) > 0 else array.array('I')
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        base = self.offsets[0] if len(self.offsets) > 0 else 0
+        with open(path + ".tmp", 'wb') as f:
+            f.write(magic)
+            f.write(header.pack(self.n, self.block, len(self.offsets)))
+            f.write(offsets.tostring())
+            f.write(self.data[base:])
+        os.rename(path + ".tmp", path)
+
+    def __len__(self):
+        return self.n
+
+    # Bytes taken by the encoded URLs and the block offsets
+    def size_bytes(self):
+        base = self.offsets[0] if len(self.offsets) > 0 else 0
+        return len(self.data) - base + self.offsets.itemsize * len(self.offsets)
+
+    # Decoded UTF-8 keys of block b, up to and including index `last` in it
+    def _block_keys(self, b, last=None):
+        if last is None:
+            last = min(self.block, self.n - b * self.block) - 1
+        keys = []
+        i = self.offsets[b]
+        prev = ""
+        for k in xrange(last + 1):
+            (lcp, i) = decode_varint(self.data, i)
+            (rest, i) = decode_varint(self.data, i)
+            prev = prev[:lcp] + self.data[i:i + rest]
+            i += rest
+            keys.append(prev)
+        return keys
+
+    def _head(self, b):
+        i = self.offsets[b]
+        (lcp, i) = decode_varint(self.data, i)
+        (rest, i) = decode_varint(self.data, i)
+        return self.data[i:i + rest]
+
+    def _key(self, i):
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return self._block_keys(i // self.block, i % self.block)[-1]
+
+    def url(self, i):
+        return self._key(i).decode('utf-8')
+
+    __getitem__ = url
+
+    def __iter__(self):
+        for b in xrange(len(self.offsets)):
+            for key in self._block_keys(b):
+                yield key.decode('utf-8')
+
+    # Id of the first URL >= the given UTF-8 key
+    def _lower_bound(self, key):
+        lo = 0
+        hi = len(self.offsets)
+        # Last block whose first URL is <= key
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._head(mid) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return 0
+        b = lo - 1
+        keys = self._block_keys(b)
+        return b * self.block + bisect.bisect_left(keys, key)
+
+    def id(self, url):
+        key = utf8(url)
+        i = self._lower_bound(key)
+        if i < self.n and self._key(i) == key:
+            return i
+        return None
+
+    def __contains__(self, url):
+        return self.id(url) is not None
+
+    # Ids [lo, hi) of the URLs starting with prefix ('\xff' never occurs in
+    # UTF-8, so it sorts after every URL starting with prefix)
+    def prefix_range(self, prefix):
+        key = utf8(prefix)
+        return (self._lower_bound(key), self._lower_bound(key + '\xff'))
+
+    def with_prefix(self, prefix):
+        (lo, hi) = self.prefix_range(prefix)
+        return [self.url(i) for i in xrange(lo, hi)]
+
+
+def corpus_urls(results_dir):
+    urls = set()
+    for target in glob.glob(os.path.join(results_dir, "*", "*", "results.json")):
+        with open(target) as f:
+            results = json.load(f)
+        for r in results['resources']:
+            urls.add(r['url'])
+    return urls
+
+
+# Memory of the URLs as Python strings: the string objects plus one pointer
+# each in a list (a dict or set costs more)
+def string_bytes(urls):
+    return sum(sys.getsizeof(u) for u in urls) + 8 * len(urls)
+
+
+def measure(results_dir, block):
+    urls = corpus_urls(results_dir)
+    d = URLDict.build(urls, block)
+    raw = sum(len(utf8(u)) for u in urls)
+    strings = string_bytes(urls)
+    print "URLs:", len(urls), "distinct,", raw, "bytes of UTF-8 (%.1f per URL)" % \
+        (float(raw) / max(len(urls), 1))
+    print "Python unicode strings: %d bytes (%.1f per URL)" % \
+        (strings, float(strings) / max(len(urls), 1))
+    utf8_strings = string_bytes([utf8(u) for u in urls])
+    print "Python UTF-8 str: %d bytes (%.1f per URL)" % \
+        (utf8_strings, float(utf8_strings) / max(len(urls), 1))
+    print "URLDict (block %d): %d bytes (%.1f per URL, %.1f%% of the strings)" % \
+        (block, d.size_bytes(), float(d.size_bytes()) / max(len(urls), 1),
+         100.0 * d.size_bytes() / max(strings, 1))
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != "measure":
+        print "Usage: python urldict.py measure [-results dir] [-block n]"
+        exit()
+    args = sys.argv[2:]
+    results_dir = "results"
+    block = block_size
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '-results' and len(args) > 0:
+            results_dir = args.pop(0)
+        elif arg == '-block' and len(args) > 0:
+            block = int(args.pop(0))
+        else:
+            print "Usage: python urldict.py measure [-results dir] [-block n]"
+            exit()
+    measure(results_dir, block)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,11 +31,15 @@
   variations of the segment text will be stored in the list corresponding to that
   key value pair.
 
-  NB. Currently in the case of non-empty variation lists, the data structure just 
-  lists all possible variations with no repetition, and therefore says nothing about
-  the number of occurrences of each variation. This might be useful to add, but 
-  considering the things that vary are often things like access ids, and they
-  are always different, it might not be necessary.
+  The variations of a wildcard segment are kept in a VariationCounter rather
+  than a plain list: it counts the occurrences of each variation exactly until
+  the segment has seen max_exact_variations distinct values, then switches to a
+  count-min sketch plus the top_k most frequent variations, with a HyperLogLog
+  estimate of the number of distinct values (see sketch.py). Segments holding
+  access ids or timestamps can take a new value in every URL, so this keeps
+  adding a variation O(1) and the memory per segment bounded. A VariationCounter
+  iterates like the old list: over the variations in order of appearance, or
+  over the top_k variations once it has switched to the sketch.
 
   list of similar URLs
   -------------------------------------------------------------
@@ -44,19 +48,20 @@
    |
    |   Dict of URL parts
    |   Key: (Segment # in URL, Segment Text or wildcard, segment type)
-   |   Value: [list of possible variations on segment text or empty list]
+   |   Value: VariationCounter of possible variations on segment text or empty list
    |  
    |   ---------------------------------------------------------
    +-->|(Seg #, seg text, seg ty)|  |  |  |  |  |  |  |  |  |  |
        ---------------------------------------------------------
         |
         |
-        +-->[] or list of variations in order of appearance
+        +-->[] or VariationCounter of variations in order of appearance
  
 """
 
 import urlparse
 import helper
+import sketch
 import sys
 
 wild_sym = '##!!##'
@@ -71,37 +76,131 @@ frag_code = 5
 # Weight array for similarity test; weights correspond by index to codes
 wt_arr = [1,2,1,1,1,1]
 
+# Distinct variations counted exactly per wildcard segment before switching to
+# a count-min sketch, and number of top variations kept after that
+max_exact_variations = 1000
+top_k = 10
+
+
+class TabURL(dict):
+    count = 0
+
+
+class VariationCounter(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.order = []
+        self.cms = None
+        self.hll = None
+        self.top = None
+        self.total = 0
+
+    def add(self, txt, count=1):
+        self.total += count
+        if self.cms is None:
+            if txt in self.counts:
+                self.counts[txt] += count
+                return
+            self.counts[txt] = count
+            self.order.append(txt)
+            if len(self.order) > max_exact_variations:
+                self._to_sketch()
+            return
+        self.hll.add(txt)
+        est = self.cms.add(txt, count)
+        if txt in self.top or len(self.top) < top_k:
+            self.top[txt] = est
+        else:
+            low = min(self.top, key=self.top.get)
+            if est > self.top[low]:
+                del self.top[low]
+                self.top[txt] = est
+
+    def _to_sketch(self):
+        self.top = dict(self.most_common(top_k))
+        self.cms = sketch.CountMinSketch()
+        self.hll = sketch.HyperLogLog()
+        for txt in self.order:
+            self.cms.add(txt, self.counts[txt])
+            self.hll.add(txt)
+        self.counts = None
+        self.order = None
+
+    def exact(self):
+        return self.cms is None
+
+    def distinct(self):
+        if self.cms is None:
+            return len(self.order)
+        return int(round(self.hll.count()))
+
+    # (variation, count) pairs, most frequent first; counts are estimates
+    # (never too low) once the counter has switched to the sketch
+    def most_common(self, n=None):
+        if self.cms is None:
+            pairs = [(txt, self.counts[txt]) for txt in self.order]
+        else:
+            pairs = self.top.items()
+        pairs.sort(key=lambda (txt, c): -c)
+        if n is not None:
+            pairs = pairs[:n]
+        return pairs
+
+    def __contains__(self, txt):
+        if self.cms is None:
+            return txt in self.counts
+        return txt in self.top or self.cms.estimate(txt) > 0
+
+    def __iter__(self):
+        if self.cms is None:
+            return iter(self.order)
+        return iter([txt for (txt, c) in self.most_common()])
+
+    def __len__(self):
+        if self.cms is None:
+            return len(self.order)
+        return len(self.top)
+
 
 # Similarity threshold expressed as a percent of varying elements
 # within a URL
-def create_sim_url_tab(url_list, sim_thresh):
+# url_counts optionally maps each URL to its number of occurrences, which the
+# wildcard segment counters then count it for
+def create_sim_url_tab(url_list, sim_thresh, url_counts=None):
     sim_url_table = []
     for url in url_list:
-        insert_url(sim_url_table, url, sim_thresh)
+        count = 1
+        if url_counts is not None:
+            count = url_counts[url]
+        insert_url(sim_url_table, url, sim_thresh, count)
 
     return sim_url_table
 
 
 # Insert Url into one of the existing similarity sets or have it establish 
 # its own
-def insert_url(sim_url_table, new_url, sim_thresh):
+def insert_url(sim_url_table, new_url, sim_thresh, count=1):
     new_url_list = split_url(new_url)
     for tab_url in sim_url_table:
         tab_url_list = sorted(tab_url.keys())
         if check_urls_sim(tab_url_list, 
                           new_url_list,
                           sim_thresh) == True:
-            update_tab_url(tab_url, new_url_list)
+            update_tab_url(tab_url, new_url_list, count)
             return
-    new_tab_url = create_tab_url(new_url_list)
+    new_tab_url = create_tab_url(new_url_list, count)
     sim_url_table.append(new_tab_url)
     return
 
 
 # Tab URL keys are tuples of the form (seg #, seg text, seg type)
-# values are lists, either empty or containing the list of possible values
+# values are either empty lists or VariationCounters of the possible values
 # for the segment among similar URLs
-def update_tab_url(tab_url, new_url_list):
+def update_tab_url(tab_url, new_url_list, count=1):
+    # The URLs merged into the set so far, for the old text of segments that
+    # become wild now
+    n_merged = tab_url.count
     tab_url_segs = sorted(tab_url.keys())
     assert len(tab_url_segs) == len(new_url_list)
     for i in xrange(0,len(tab_url_segs)):
@@ -117,27 +216,30 @@ def update_tab_url(tab_url, new_url_list):
         new_url_ty = new_url_seg[2]
 
         if tab_url_txt == wild_sym: #seg text
-            #if this text variant isn't already in list add it
-            if not new_url_txt in tab_url[tab_url_seg]: 
-                tab_url[tab_url_seg].append(new_url_txt)
+            tab_url[tab_url_seg].add(new_url_txt, count)
         #Otherwise, need to change top-level text to wild, and update variation list with old text
         elif tab_url_txt != new_url_txt:
             del(tab_url[tab_url_seg])
-            tab_url[(tab_url_n,wild_sym,tab_url_ty)] = []
-            tab_url[(tab_url_n,wild_sym,tab_url_ty)].append(tab_url_txt)
-            tab_url[(tab_url_n,wild_sym,tab_url_ty)].append(new_url_txt)
+            counter = VariationCounter()
+            counter.add(tab_url_txt, n_merged)
+            counter.add(new_url_txt, count)
+            tab_url[(tab_url_n,wild_sym,tab_url_ty)] = counter
+
+    tab_url.count = n_merged + count
 
 
 
-# New table URL is stored as a dictionary
+# New table URL is stored as a dictionary (a TabURL, which also remembers the
+# number of URLs merged into it)
 # Keys are tuples of the form (segment #, segment text, segment ty)
 # Values are initially empty lists; if value is a variation, segment text
 # will be replaced by wild_sym and value will hold a list of the possible
 # actual values of the segment text
-def create_tab_url(new_url_list):
-    new_tab_url = {}
+def create_tab_url(new_url_list, count=1):
+    new_tab_url = TabURL()
     for seg in new_url_list:
         new_tab_url[seg] = []
+    new_tab_url.count = count
     return new_tab_url
 
 
@@ -181,6 +283,16 @@ def check_urls_sim(tab_url, new_url, sim_thresh):
     assert (sim_thresh <= 1)
     if len(tab_url) != len(new_url):
         return False
+    elif url_sim_score(tab_url, new_url) < sim_thresh:
+        return False
+    else:
+        return True
+
+# Weighted fraction of segments that match between two URLs of the same
+# length (see check_urls_sim); URLs of different lengths score 0
+def url_sim_score(tab_url, new_url):
+    if len(tab_url) != len(new_url):
+        return 0.0
     else:
         tab_url_texts = helper.strip(tab_url,1)
         tab_url_stypes = helper.strip(tab_url,2)
@@ -213,10 +325,7 @@ def check_urls_sim(tab_url, new_url, sim_thresh):
                     if t_param_name == n_param_name:
                         sim_score += wt_arr[param_code]
 
-        if ((float(sim_score)/max_score) < sim_thresh):
-            return False
-        else:
-            return True
+        return float(sim_score)/max_score
         
 def print_sim_url_tab(sim_url_tab):
     print '-'*40
@@ -229,11 +338,36 @@ def print_sim_url_tab(sim_url_tab):
         for (seg_n,seg_text,seg_type) in sorted(tab_url.keys()):
             variation_list = tab_url[(seg_n,seg_text,seg_type)]
             if len(variation_list) > 0:
-                print "Seg",seg_n,
-                for seg_variation in variation_list:
-                    print "\t",seg_variation
+                distinct = variation_list.distinct()
+                if variation_list.exact():
+                    print "Seg",seg_n,"("+str(distinct),"variations)",
+                else:
+                    print "Seg",seg_n,"(~"+str(distinct),"variations, top",\
+                        len(variation_list),"shown)",
+                for (seg_variation,count) in variation_list.most_common(top_k):
+                    print "\t",count,"\t",seg_variation
+                if variation_list.exact() and distinct > top_k:
+                    print "\t...",distinct - top_k,"more"
         print '-'*40
 
+# Structured form of a similarity set for records.RecordWriter: the
+# reconstructed template plus, for each wild segment, its variations (all of
+# them, or the top_k most common once its counter has switched to the
+# sketch), the top_k [variation, count] pairs and the distinct estimate
+def tab_url_record(tab_url):
+    variations = {}
+    top = {}
+    distinct = {}
+    for (seg_n,seg_text,seg_type) in sorted(tab_url.keys()):
+        variation_list = tab_url[(seg_n,seg_text,seg_type)]
+        if len(variation_list) > 0:
+            variations[seg_n] = list(variation_list)
+            top[seg_n] = variation_list.most_common(top_k)
+            distinct[seg_n] = variation_list.distinct()
+    return {"template": reconstruct_url(sorted(tab_url.keys())),
+            "urls": tab_url.count, "variations": variations, "top": top,
+            "distinct": distinct}
+
 # Input is a url as a list of segments, output is a single reconstructed URL string
 def reconstruct_url(tab_url_list):
 